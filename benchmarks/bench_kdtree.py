@@ -0,0 +1,35 @@
+import numpy as np
+
+from qtree import ParticleProjectionKDTree, ParticleSliceKDTree
+
+from .common import DISTRIBUTIONS, NPARTICLES, TIMEOUT, make_positions
+
+LEFT_EDGE = np.zeros(3)
+RIGHT_EDGE = np.ones(3)
+
+
+class KDTreeBuild(object):
+    params = (NPARTICLES, DISTRIBUTIONS)
+    param_names = ['nparticles', 'distribution']
+    timeout = TIMEOUT
+
+    def setup(self, nparticles, distribution):
+        self.positions = make_positions(nparticles, distribution, ndim=3)
+
+    def _projection(self):
+        ParticleProjectionKDTree(self.positions, 'z', LEFT_EDGE, RIGHT_EDGE)
+
+    def _slice(self):
+        ParticleSliceKDTree(self.positions, 'z', 0.5, LEFT_EDGE, RIGHT_EDGE)
+
+    def time_projection_kdtree(self, nparticles, distribution):
+        self._projection()
+
+    def peakmem_projection_kdtree(self, nparticles, distribution):
+        self._projection()
+
+    def time_slice_kdtree(self, nparticles, distribution):
+        self._slice()
+
+    def peakmem_slice_kdtree(self, nparticles, distribution):
+        self._slice()
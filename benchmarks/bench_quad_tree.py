@@ -0,0 +1,131 @@
+import pickle
+
+import numpy as np
+
+from qtree import ParticleLinearQuadTree, ParticleQuadTreeNode
+
+from .common import (
+    DISTRIBUTIONS,
+    LEAF_SIZES,
+    NPARTICLES,
+    RESOLUTIONS,
+    TIMEOUT,
+    cache_path,
+    make_masses,
+    make_positions,
+    traced_peak,
+)
+
+
+class QuadTreeBuild(object):
+    params = (NPARTICLES, DISTRIBUTIONS, LEAF_SIZES)
+    param_names = ['nparticles', 'distribution', 'leaf_size']
+    timeout = TIMEOUT
+
+    tree_class = ParticleQuadTreeNode
+
+    def setup(self, nparticles, distribution, leaf_size):
+        self.positions = make_positions(nparticles, distribution)
+        self.masses = make_masses(nparticles)
+
+    def _build(self, leaf_size):
+        tree = self.tree_class([0.5, 0.5], 0.5, leaf_size=leaf_size)
+        tree.insert(self.positions, self.masses)
+        return tree
+
+    def time_insert(self, nparticles, distribution, leaf_size):
+        self._build(leaf_size)
+
+    def peakmem_insert(self, nparticles, distribution, leaf_size):
+        self._build(leaf_size)
+
+
+class LinearQuadTreeBuild(QuadTreeBuild):
+    tree_class = ParticleLinearQuadTree
+
+
+class QuadTreeTraversal(object):
+    params = (NPARTICLES, DISTRIBUTIONS, LEAF_SIZES)
+    param_names = ['nparticles', 'distribution', 'leaf_size']
+    timeout = TIMEOUT
+
+    tree_class = ParticleQuadTreeNode
+
+    def setup(self, nparticles, distribution, leaf_size):
+        self.tree = self.tree_class([0.5, 0.5], 0.5, leaf_size=leaf_size)
+        self.tree.insert(make_positions(nparticles, distribution),
+                         make_masses(nparticles))
+
+    def time_leaves(self, nparticles, distribution, leaf_size):
+        for leaf in self.tree.leaves:
+            pass
+
+    def peakmem_leaves(self, nparticles, distribution, leaf_size):
+        for leaf in self.tree.leaves:
+            pass
+
+
+class LinearQuadTreeTraversal(QuadTreeTraversal):
+    tree_class = ParticleLinearQuadTree
+
+
+class QuadTreePixelize(object):
+    params = (NPARTICLES, DISTRIBUTIONS, RESOLUTIONS, [False, True])
+    param_names = ['nparticles', 'distribution', 'resolution',
+                   'area_weighted']
+    timeout = TIMEOUT
+
+    tree_class = ParticleQuadTreeNode
+
+    def setup_cache(self):
+        # build each tree once rather than before every repeat, so the
+        # benchmarks only measure pixelization
+        paths = {}
+        for nparticles in NPARTICLES:
+            for distribution in DISTRIBUTIONS:
+                tree = self.tree_class([0.5, 0.5], 0.5)
+                tree.insert(make_positions(nparticles, distribution),
+                            make_masses(nparticles))
+                path = cache_path(nparticles, distribution)
+                self._save(tree, path)
+                paths[nparticles, distribution] = path
+        return paths
+
+    setup_cache.timeout = len(DISTRIBUTIONS) * TIMEOUT
+
+    def _save(self, tree, path):
+        tree.save(path)
+
+    def _load(self, path):
+        return self.tree_class.load(path)
+
+    def setup(self, paths, nparticles, distribution, resolution,
+              area_weighted):
+        self.tree = self._load(paths[nparticles, distribution])
+
+    def _pixelize(self, resolution, area_weighted):
+        image = np.zeros((resolution, resolution))
+        self.tree.pixelize(image, area_weighted=area_weighted)
+
+    def time_pixelize(self, paths, nparticles, distribution, resolution,
+                      area_weighted):
+        self._pixelize(resolution, area_weighted)
+
+    def track_pixelize_peak_bytes(self, paths, nparticles, distribution,
+                                  resolution, area_weighted):
+        return traced_peak(self._pixelize, resolution, area_weighted)
+
+    track_pixelize_peak_bytes.unit = 'bytes'
+
+
+class LinearQuadTreePixelize(QuadTreePixelize):
+    tree_class = ParticleLinearQuadTree
+
+    # the flat arrays of the linear tree pickle cheaply, it has no save
+    def _save(self, tree, path):
+        with open(path, 'wb') as f:
+            pickle.dump(tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _load(self, path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
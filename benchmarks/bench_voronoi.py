@@ -0,0 +1,77 @@
+import numpy as np
+
+from qtree import ParticleVoronoiMesh
+
+from .common import (
+    DISTRIBUTIONS,
+    MAX_VORONOI_NPARTICLES,
+    NPARTICLES,
+    RESOLUTIONS,
+    TIMEOUT,
+    cache_path,
+    make_masses,
+    make_positions,
+    traced_peak,
+)
+
+BOUNDS = [[0, 0], [1, 1]]
+
+
+class VoronoiBuild(object):
+    params = (NPARTICLES, DISTRIBUTIONS)
+    param_names = ['nparticles', 'distribution']
+    timeout = TIMEOUT
+
+    def setup(self, nparticles, distribution):
+        self.positions = make_positions(nparticles, distribution)
+        self.masses = make_masses(nparticles)
+
+    def time_build(self, nparticles, distribution):
+        ParticleVoronoiMesh(self.positions, self.masses, BOUNDS)
+
+    def peakmem_build(self, nparticles, distribution):
+        ParticleVoronoiMesh(self.positions, self.masses, BOUNDS)
+
+
+class VoronoiPixelize(object):
+    params = (NPARTICLES, DISTRIBUTIONS, RESOLUTIONS, ['nearest', 'polygon'])
+    param_names = ['nparticles', 'distribution', 'resolution', 'method']
+    timeout = TIMEOUT
+
+    def setup_cache(self):
+        # build each mesh once rather than before every repeat, so the
+        # benchmarks only measure pixelization
+        paths = {}
+        for nparticles in NPARTICLES:
+            if nparticles > MAX_VORONOI_NPARTICLES:
+                continue
+            for distribution in DISTRIBUTIONS:
+                mesh = ParticleVoronoiMesh(
+                    make_positions(nparticles, distribution),
+                    make_masses(nparticles), BOUNDS)
+                path = cache_path(nparticles, distribution)
+                mesh.save(path)
+                paths[nparticles, distribution] = path
+        return paths
+
+    setup_cache.timeout = len(DISTRIBUTIONS) * TIMEOUT
+
+    def setup(self, paths, nparticles, distribution, resolution, method):
+        if (nparticles, distribution) not in paths:
+            raise NotImplementedError(
+                "building the mesh does not finish in time")
+        self.mesh = ParticleVoronoiMesh.load(paths[nparticles, distribution])
+
+    def _pixelize(self, resolution, method):
+        image = np.zeros((resolution, resolution))
+        self.mesh.pixelize(image, method=method)
+
+    def time_pixelize(self, paths, nparticles, distribution, resolution,
+                      method):
+        self._pixelize(resolution, method)
+
+    def track_pixelize_peak_bytes(self, paths, nparticles, distribution,
+                                  resolution, method):
+        return traced_peak(self._pixelize, resolution, method)
+
+    track_pixelize_peak_bytes.unit = 'bytes'
@@ -0,0 +1,79 @@
+import os
+import tracemalloc
+
+import numpy as np
+
+NPARTICLES = [10**3, 10**4, 10**5, 10**6, 10**7]
+
+DISTRIBUTIONS = ['uniform', 'gaussian', 'powerlaw']
+
+LEAF_SIZES = [4, 16, 64]
+
+RESOLUTIONS = [256, 1024, 4096]
+
+# building the largest object-per-node trees takes minutes
+TIMEOUT = 1800
+
+# building the largest voronoi meshes does not finish in TIMEOUT
+MAX_VORONOI_NPARTICLES = 10**6
+
+# keep particles strictly inside the unit square, insert rejects particles
+# on the domain boundary
+_EPS = 1e-12
+
+
+def make_positions(nparticles, distribution, ndim=2):
+    """Particle positions in the unit cube
+
+    Parameters
+    ----------
+    nparticles : int
+        The number of particles.
+    distribution : string
+        One of ``'uniform'``, ``'gaussian'`` (a clipped gaussian blob as
+        used in the qtree tests) or ``'powerlaw'`` (a radial power law
+        concentrated towards the center of the domain).
+    ndim : int
+        The number of dimensions.
+    """
+    prng = np.random.RandomState(0x4d3d3d3)
+    if distribution == 'uniform':
+        positions = prng.random_sample((nparticles, ndim))
+    elif distribution == 'gaussian':
+        positions = prng.normal(loc=0.5, scale=0.1, size=(nparticles, ndim))
+    elif distribution == 'powerlaw':
+        direction = prng.normal(size=(nparticles, ndim))
+        direction /= np.sqrt((direction**2).sum(axis=-1))[:, None]
+        radius = 0.5 * prng.random_sample(nparticles)**3
+        positions = 0.5 + radius[:, None] * direction
+    else:
+        raise RuntimeError("Unknown distribution '%s'" % (distribution,))
+    return np.clip(positions, _EPS, 1 - _EPS)
+
+
+def make_masses(nparticles):
+    return np.ones(nparticles)
+
+
+def cache_path(nparticles, distribution):
+    """The path a setup_cache method saves a tree or mesh to
+
+    setup_cache runs in a directory kept for the benchmarks of the class,
+    so the absolute path is returned for setup to load from.
+    """
+    return os.path.abspath('%d-%s' % (nparticles, distribution))
+
+
+def traced_peak(func, *args):
+    """The peak memory allocated while calling func, in bytes
+
+    asv's peakmem benchmarks report the peak resident size of the whole
+    process, including setup. This only counts the python and numpy
+    allocations traced by tracemalloc while func runs.
+    """
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
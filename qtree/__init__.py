@@ -1,6 +1,36 @@
-from qtree.quad_tree import ParticleQuadTreeNode  # NOQA
-from qtree.voronoi import ParticleVoronoiMesh  # NOQA
-from qtree.kdtree import (  # NOQA
-    ParticleProjectionKDTree,
-    ParticleSliceKDTree
-)
+"""Particle quadtrees, voronoi meshes and KDTrees
+
+The classes are imported lazily on first attribute access, so importing
+qtree does not load matplotlib, scipy or cykdtree.
+"""
+import importlib
+
+_LAZY_ATTRIBUTES = {
+    'ParticleQuadTreeNode': 'qtree.quad_tree',
+    'ParticleLinearQuadTree': 'qtree.linear_quad_tree',
+    'ParticleVoronoiMesh': 'qtree.voronoi',
+    'ParticleKDTree': 'qtree.kdtree',
+    'build_kdtree': 'qtree.kdtree',
+    'ParticleProjectionKDTree': 'qtree.kdtree',
+    'ParticleSliceKDTree': 'qtree.kdtree',
+    'add_timing_hook': 'qtree.instrumentation',
+    'remove_timing_hook': 'qtree.instrumentation',
+    'log_timings': 'qtree.instrumentation',
+}
+
+__all__ = sorted(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    try:
+        module = _LAZY_ATTRIBUTES[name]
+    except KeyError:
+        raise AttributeError(
+            "module 'qtree' has no attribute '%s'" % (name,))
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,72 @@
+"""Least recently used caches
+
+ParticleQuadTreeNode and ParticleVoronoiMesh can memoize the images and
+pixel assignments they compute for a given image shape and window, see
+their ``enable_cache`` methods, and ``qtree.kdtree.build_kdtree`` reuses
+recently built trees. Entries are evicted least recently used first once
+the cache exceeds its budget.
+"""
+from collections import OrderedDict
+
+# the default byte budget of a pixelization cache
+_CACHE_BYTES = 256 * 2**20
+
+
+class _LRUCache(object):
+
+    def __init__(self, max_size):
+        """A least recently used cache of values with a size budget
+
+        The size of a value is given by ``_sizeof``, one per value by
+        default so ``max_size`` is the number of cached values. Values
+        larger than the whole budget are not cached.
+        """
+        self.max_size = max_size
+        self.size = 0
+        self._values = OrderedDict()
+
+    def _sizeof(self, value):
+        return 1
+
+    def get(self, key):
+        value = self._values.pop(key, None)
+        if value is not None:
+            self._values[key] = value
+        return value
+
+    def put(self, key, value):
+        old = self._values.pop(key, None)
+        if old is not None:
+            self.size -= self._sizeof(old)
+        if self._sizeof(value) > self.max_size:
+            return
+        self._values[key] = value
+        self.size += self._sizeof(value)
+        while self.size > self.max_size:
+            _, evicted = self._values.popitem(last=False)
+            self.size -= self._sizeof(evicted)
+
+    def clear(self):
+        self._values.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._values)
+
+
+class _ArrayCache(_LRUCache):
+
+    def __init__(self, max_bytes=_CACHE_BYTES):
+        """A least recently used cache of arrays with a byte budget
+
+        Cached arrays are made read-only so callers cannot modify them by
+        accident.
+        """
+        super(_ArrayCache, self).__init__(max_bytes)
+
+    def _sizeof(self, array):
+        return array.nbytes
+
+    def put(self, key, array):
+        array.setflags(write=False)
+        super(_ArrayCache, self).put(key, array)
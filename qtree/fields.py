@@ -0,0 +1,128 @@
+"""Handling of single and multiple deposit fields
+
+A deposit field is either a single ``(nparticles,)`` array, a
+``(nparticles, nfields)`` array or a dict of named ``(nparticles,)``
+arrays. Internally fields are stored as one array per field
+(struct-of-arrays) and identified by their names, the column numbers of a
+2D array or the keys of a dict. A single 1D field has no name.
+"""
+import numpy as np
+
+
+def _field_columns(deposit_field, nparticles):
+    """Split a deposit field into one 1D array per field
+
+    Columns are views of the input where possible, so memory-mapped fields
+    are not read.
+
+    Returns
+    -------
+    names : tuple or None
+        The field names, None for a single 1D field or if ``deposit_field``
+        is None.
+    columns : list of ndarray or None
+        The ``(nparticles,)`` values of each field.
+    """
+    if deposit_field is None:
+        return None, None
+
+    if isinstance(deposit_field, dict):
+        names = tuple(deposit_field)
+        columns = [np.asarray(deposit_field[name]) for name in names]
+    else:
+        deposit_field = np.asarray(deposit_field)
+        if len(deposit_field.shape) == 1:
+            names = None
+            columns = [deposit_field]
+        elif len(deposit_field.shape) == 2:
+            names = tuple(range(deposit_field.shape[1]))
+            columns = [deposit_field[:, i] for i in names]
+        else:
+            raise RuntimeError(
+                "Received a %sD deposit_field but expected a 1D or 2D array "
+                "or a dict of 1D arrays" % (len(deposit_field.shape),))
+
+    for column in columns:
+        if column.shape != (nparticles,):
+            raise RuntimeError(
+                "Received %s deposit_field entries but received %s particle "
+                "positions" % (column.shape[0], nparticles))
+
+    return names, columns
+
+
+def _num_fields(names):
+    return 1 if names is None else len(names)
+
+
+def _check_image(image, names):
+    """Check an image is 2D for a single field or a stack of field images"""
+    image = np.asarray(image)
+    if names is None:
+        if len(image.shape) != 2:
+            raise RuntimeError("Must pixelize onto 2D image")
+    elif len(image.shape) != 3 or image.shape[0] != len(names):
+        raise RuntimeError(
+            "Must pixelize %s fields onto an image stack of shape "
+            "(%s, nx, ny)" % (len(names), len(names)))
+    return image
+
+
+def _weight_indices(names, weights):
+    """The index of the weight field of each field, -1 if unweighted
+
+    ``weights`` maps field names to the names of the fields they are
+    averaged with, e.g. ``{'temperature': 'mass'}``.
+    """
+    index = np.full(_num_fields(names), -1, dtype=np.intp)
+    if not weights:
+        return index
+    if names is None:
+        raise RuntimeError("Weighted fields require named deposit fields")
+    for name, weight in weights.items():
+        for field in (name, weight):
+            if field not in names:
+                raise RuntimeError(
+                    "Unknown field %r, expected one of %s" % (field, names))
+        index[names.index(name)] = names.index(weight)
+    return index
+
+
+def _apply_weights(fields, weight_index):
+    """Multiply weighted fields by their weights and append the weights
+
+    Parameters
+    ----------
+    fields : ndarray
+        The ``(nfields, n)`` field values.
+    weight_index : ndarray
+        The weight field of each field, see _weight_indices.
+
+    Returns
+    -------
+    The ``(nfields + nweights, n)`` weighted fields followed by every
+    distinct weight field.
+    """
+    weighted = weight_index >= 0
+    if not weighted.any():
+        return fields
+    values = fields.copy()
+    values[weighted] *= fields[weight_index[weighted]]
+    return np.concatenate(
+        (values, fields[np.unique(weight_index[weighted])]))
+
+
+def _resolve_weights(stack, image, weight_index):
+    """Add images deposited from _apply_weights values to an image stack
+
+    Weighted fields are divided by the deposited weight, pixels without
+    any weight are left untouched.
+    """
+    weights = np.unique(weight_index[weight_index >= 0])
+    for f, w in enumerate(weight_index):
+        if w < 0:
+            image[f] += stack[f]
+            continue
+        weight = stack[weight_index.shape[0] + np.searchsorted(weights, w)]
+        nonzero = weight != 0
+        image[f][nonzero] += stack[f][nonzero] / weight[nonzero]
@@ -0,0 +1,78 @@
+"""Optional timing hooks around the expensive phases of qtree
+
+Builds, traversals and pixelizations report how long they took to every
+registered hook as ``hook(phase, elapsed, info)``, where ``phase`` is a
+string like ``'quadtree.insert'``, ``elapsed`` is the wall time in seconds
+and ``info`` is a dict describing the work, e.g. the number of particles
+or the image shape. Without registered hooks the phases are not timed.
+
+    >>> from qtree.instrumentation import add_timing_hook, log_timings
+    >>> hook = add_timing_hook(lambda phase, elapsed, info: print(phase))
+    >>> handler = log_timings()  # report to the 'qtree' logger
+"""
+import contextlib
+import logging
+import time
+
+logger = logging.getLogger('qtree')
+
+_hooks = []
+
+
+def add_timing_hook(hook):
+    """Call ``hook(phase, elapsed, info)`` after every timed phase
+
+    Returns the hook, so it can later be passed to remove_timing_hook.
+    """
+    _hooks.append(hook)
+    return hook
+
+
+def remove_timing_hook(hook):
+    """Stop calling a hook registered with add_timing_hook"""
+    try:
+        _hooks.remove(hook)
+    except ValueError:
+        raise RuntimeError("Timing hook %r is not registered" % (hook,))
+
+
+def log_timings(log=None, level=logging.INFO):
+    """Report the timing of every phase to a logger
+
+    Parameters
+    ----------
+    log : logging.Logger, optional
+        The logger to report to, defaults to the ``'qtree'`` logger.
+    level : int, optional
+        The level of the log records. Defaults to ``logging.INFO``.
+
+    Returns
+    -------
+    The registered hook, see remove_timing_hook.
+    """
+    if log is None:
+        log = logger
+
+    def hook(phase, elapsed, info):
+        log.log(level, "%s took %.6f s %s", phase, elapsed, info)
+
+    return add_timing_hook(hook)
+
+
+@contextlib.contextmanager
+def _timed(phase, **info):
+    """Time a block of code and report it to the registered hooks
+
+    The yielded dict may be updated with information only known once the
+    block has run.
+    """
+    if not _hooks:
+        yield info
+        return
+    start = time.perf_counter()
+    try:
+        yield info
+    finally:
+        elapsed = time.perf_counter() - start
+        for hook in list(_hooks):
+            hook(phase, elapsed, info)
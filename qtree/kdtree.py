@@ -1,7 +1,13 @@
 
+import hashlib
+
 import numpy as np
 
-from cykdtree import PyKDTree
+from qtree.cache import _LRUCache
+from qtree.instrumentation import _timed
+from qtree.plotting import _box_segments, _rasterize_rgba, _save_rgba
+from qtree.serialization import _load_arrays, _save_arrays
+from qtree.tiling import _deposit_leaves
 
 DIRECTION_MAPPING = {
     'x': 0,
@@ -10,10 +16,23 @@ DIRECTION_MAPPING = {
 }
 
 
-def _plot(plot_nodes, filename, outlines_only=False):
+def _plot(left_edge, right_edge, npts, filename, outlines_only=False,
+          rgba=False, shape=(1024, 1024)):
+    """Plot 2D leaf boxes as a single collection, colored by their number
+    of points unless ``outlines_only``
+
+    If ``rgba`` is True the outlines are rasterized into an RGBA array of
+    ``shape`` pixels instead, see qtree.plotting._rasterize_rgba.
+    """
+    if rgba:
+        bounds = (left_edge.min(axis=0), right_edge.max(axis=0))
+        return _save_rgba(
+            _rasterize_rgba(bounds, shape,
+                            _box_segments(left_edge, right_edge)),
+            filename)
+
     from matplotlib import pyplot as plt
-    from matplotlib.patches import Rectangle
-    from matplotlib.collections import PatchCollection
+    from matplotlib.collections import PolyCollection
 
     if outlines_only:
         cb_pad = 0
@@ -32,16 +51,10 @@ def _plot(plot_nodes, filename, outlines_only=False):
     axes.xaxis.set_visible(False)
     axes.yaxis.set_visible(False)
 
-    patches = []
-    npts_a = []
-
-    for le, re, npts in plot_nodes:
-        patches.append(Rectangle(le, re[0] - le[0], re[1] - le[1]))
-        npts_a.append(npts)
-
-    pc = PatchCollection(patches, edgecolors='k')
+    boxes = _box_segments(left_edge, right_edge)[:, 0].reshape(-1, 4, 2)
+    pc = PolyCollection(boxes, edgecolors='k')
     if outlines_only is False:
-        pc.set_array(np.array(npts_a))
+        pc.set_array(np.asarray(npts))
         pc.set_clim(0, 16)
     else:
         pc.set_facecolor('red')
@@ -58,10 +71,380 @@ def _plot(plot_nodes, filename, outlines_only=False):
         plt.savefig(filename)
 
 
-class ParticleProjectionKDTree(object):
+def _leaf_arrays(kdtree):
+    """Gather the edges and particle ranges of all leaves of a PyKDTree
+
+    cykdtree keeps the leaf edges in its C++ tree but only exposes them
+    through the ``left_edge`` and ``right_edge`` properties of each leaf,
+    which build a new array on every access, and it does not install the
+    Cython declarations needed to read the C++ arrays directly. The edges
+    are therefore gathered leaf by leaf, which dominates the cost, once
+    per tree: the arrays are cached by ParticleKDTree and saved with it.
+    """
+    leaves = kdtree.leaves
+    left_edge = np.array([leaf.left_edge for leaf in leaves])
+    right_edge = np.array([leaf.right_edge for leaf in leaves])
+    start = np.fromiter((leaf.start_idx for leaf in leaves), dtype=np.intp,
+                        count=len(leaves))
+    npts = np.fromiter((leaf.npts for leaf in leaves), dtype=np.intp,
+                       count=len(leaves))
+    return left_edge, right_edge, start, npts
+
+
+class _SlabIndex(object):
+
+    def __init__(self, left_edge, right_edge):
+        """An index of the leaves intersecting slices along one axis
+
+        The sorted, unique leaf edges along the axis split it into slabs,
+        and every slab intersects a fixed set of leaves. The leaves are
+        stored in a segment tree over the slabs: each leaf is listed on the
+        O(log n) tree nodes that exactly cover its range of slabs, so the
+        leaves intersecting any slice are found with a binary search and a
+        walk from one slab up to the root.
+
+        Parameters
+        ----------
+        left_edge, right_edge : ndarray
+            The extents of the leaves along the axis.
+        """
+        self.breakpoints = bp = np.unique(
+            np.concatenate((left_edge, right_edge)))
+        nslabs = max(bp.shape[0] - 1, 1)
+        self.size = size = 1 << int(np.ceil(np.log2(nslabs)))
+
+        # decompose the slab range [first, last) of every leaf into
+        # segment tree nodes, bottom-up for all leaves at once
+        leaf = np.arange(left_edge.shape[0])
+        lo = np.searchsorted(bp, left_edge) + size
+        hi = np.searchsorted(bp, right_edge) + size
+        node_lists = []
+        leaf_lists = []
+        while leaf.shape[0] > 0:
+            take = (lo & 1).astype(bool) & (lo < hi)
+            node_lists.append(lo[take])
+            leaf_lists.append(leaf[take])
+            lo = lo + take
+            take = (hi & 1).astype(bool) & (lo < hi)
+            hi = hi - take
+            node_lists.append(hi[take])
+            leaf_lists.append(leaf[take])
+            lo >>= 1
+            hi >>= 1
+            keep = lo < hi
+            leaf, lo, hi = leaf[keep], lo[keep], hi[keep]
+
+        nodes = np.concatenate(node_lists)
+        self.offsets = np.zeros(2*size + 1, dtype=np.intp)
+        self.offsets[1:] = np.cumsum(np.bincount(nodes, minlength=2*size))
+        self.leaves = np.concatenate(leaf_lists)[
+            np.argsort(nodes, kind='stable')]
+
+    def query(self, coord):
+        """The leaves with ``left_edge < coord <= right_edge``"""
+        slab = np.searchsorted(self.breakpoints, coord) - 1
+        if slab < 0 or slab >= self.breakpoints.shape[0] - 1:
+            return self.leaves[:0]
+        node = slab + self.size
+        found = []
+        while node > 0:
+            found.append(
+                self.leaves[self.offsets[node]:self.offsets[node + 1]])
+            node >>= 1
+        return np.sort(np.concatenate(found))
+
+
+def _leaf_sums(field, idx, start, npts):
+    """Sum a per-particle field over the particles in each leaf"""
+    sums = np.zeros(start.shape[0])
+    occupied = np.nonzero(npts)[0]
+    if occupied.size == 0:
+        return sums
+    # leaves own contiguous, non-overlapping ranges of the sorted index
+    occupied = occupied[np.argsort(start[occupied], kind='stable')]
+    sums[occupied] = np.add.reduceat(field[idx], start[occupied])
+    return sums
+
+
+class ParticleKDTree(object):
+
+    def __init__(self, positions, left_edge, right_edge, leafsize=16,
+                 periodic=(True, True, True), amr_nested=True):
+        """A KDTree over 3D particle positions
+
+        The tree is shared by any number of projection and slice views,
+        see ``projection_view`` and ``slice_view``, so it only needs to be
+        built once per snapshot. Leaf arrays and slab indices are computed
+        on first use and cached.
+
+        Parameters
+        ----------
+        positions : ndarray
+            The particle positions, of shape ``(nparticles, 3)``.
+        left_edge : ndarray
+            The 3D coordinates of the lower left bounding box corner.
+        right_edge : ndarray
+            The 3D coordinates of the upper right bounding box corner.
+        leafsize : int
+            The maximum number of particles in a leaf.
+        periodic : 3-element iterable of bools
+            Whether the domain is periodic along each axis.
+        amr_nested : bool
+            Force the kdtree to split at nearest AMR cell boundary for
+            KDTree level
+        """
+        from cykdtree import PyKDTree
+
+        self.left_edge = np.asarray(left_edge, dtype='float64')
+        self.right_edge = np.asarray(right_edge, dtype='float64')
+        self.leafsize = leafsize
+        self.periodic = tuple(periodic)
+        with _timed('kdtree.build', num_particles=len(positions)):
+            self.kdtree = PyKDTree(positions, left_edge, right_edge,
+                                   periodic=self.periodic,
+                                   leafsize=leafsize, amr_nested=amr_nested)
+        self._leaves = None
+        self._idx = None
+        self._slab_indices = {}
+
+    @property
+    def num_particles(self):
+        return self.idx.shape[0]
+
+    @property
+    def idx(self):
+        """The particle index of the tree, the particles of a leaf are
+        ``idx[start:start + npts]``"""
+        if self._idx is None:
+            self._idx = self.kdtree.idx.astype(np.intp)
+        return self._idx
+
+    def leaf_arrays(self):
+        """The left edges, right edges, start indices and particle counts
+        of all leaves"""
+        if self._leaves is None:
+            with _timed('kdtree.traverse') as info:
+                self._leaves = _leaf_arrays(self.kdtree)
+                info['num_leaves'] = self._leaves[0].shape[0]
+        return self._leaves
+
+    def leaf_sums(self, field):
+        """Sum a per-particle field over the particles of each leaf"""
+        _, _, start, npts = self.leaf_arrays()
+        return _leaf_sums(field, self.idx, start, npts)
+
+    def slab_index(self, axis):
+        """The index of leaves intersecting slices along an axis
+
+        Parameters
+        ----------
+        axis : string
+            One of 'x', 'y', or 'z'.
+        """
+        if axis not in self._slab_indices:
+            left_edge, right_edge, _, _ = self.leaf_arrays()
+            d = DIRECTION_MAPPING[axis]
+            self._slab_indices[axis] = _SlabIndex(left_edge[:, d],
+                                                  right_edge[:, d])
+        return self._slab_indices[axis]
+
+    def stats(self):
+        """Summarize the structure and memory use of the tree
+
+        cykdtree does not record the depth of its leaves, so unlike
+        ParticleQuadTreeNode.stats there is no depth histogram, and the
+        particle positions are owned by cykdtree rather than this tree.
+
+        Returns
+        -------
+        dict
+            ``num_particles``, ``num_nodes`` and ``num_leaves``;
+            ``occupancy_histogram``, the number of leaves holding 0, 1,
+            2, ... particles; and the bytes used by the ``index_bytes``
+            (the particle index) and ``geometry_bytes`` (leaf arrays and
+            slab indices) buffers.
+        """
+        leaf_arrays = self.leaf_arrays()
+        geometry = list(leaf_arrays)
+        for index in self._slab_indices.values():
+            geometry.extend((index.breakpoints, index.offsets, index.leaves))
+        num_leaves = leaf_arrays[0].shape[0]
+        return {
+            'num_particles': self.num_particles,
+            'num_nodes': 2*num_leaves - 1,
+            'num_leaves': num_leaves,
+            'occupancy_histogram': np.bincount(leaf_arrays[3]),
+            'index_bytes': self.idx.nbytes,
+            'geometry_bytes': sum(array.nbytes for array in geometry),
+        }
+
+    def save(self, path):
+        """Save the leaves and particle index to a directory of flat arrays
+
+        Parameters
+        ----------
+        path : string
+            The directory to save the tree to, created if needed.
+        """
+        left_edge, right_edge, start, npts = self.leaf_arrays()
+        _save_arrays(path, 'ParticleKDTree',
+                     {'domain_left_edge': self.left_edge,
+                      'domain_right_edge': self.right_edge,
+                      'leaf_left_edge': left_edge,
+                      'leaf_right_edge': right_edge,
+                      'leaf_start': start,
+                      'leaf_npts': npts,
+                      'idx': self.idx},
+                     leafsize=int(self.leafsize),
+                     periodic=[bool(p) for p in self.periodic])
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a tree saved with ``save``
+
+        The loaded tree supports projections and slices without cykdtree,
+        its ``kdtree`` attribute is None.
+
+        Parameters
+        ----------
+        path : string
+            The directory the tree was saved to.
+        mmap : bool, optional
+            If True (the default) the arrays are memory-mapped read-only,
+            otherwise they are read into memory.
+        """
+        metadata, arrays = _load_arrays(path, 'ParticleKDTree', mmap)
+        tree = cls.__new__(cls)
+        tree.left_edge = np.array(arrays['domain_left_edge'])
+        tree.right_edge = np.array(arrays['domain_right_edge'])
+        tree.leafsize = metadata['leafsize']
+        tree.periodic = tuple(metadata['periodic'])
+        tree.kdtree = None
+        tree._leaves = (arrays['leaf_left_edge'], arrays['leaf_right_edge'],
+                        arrays['leaf_start'], arrays['leaf_npts'])
+        tree._idx = arrays['idx']
+        tree._slab_indices = {}
+        return tree
+
+    def projection_view(self, direction):
+        """A ParticleProjectionKDTree along ``direction`` using this tree"""
+        return ParticleProjectionKDTree.from_kdtree(self, direction)
+
+    def slice_view(self, direction, coord):
+        """A ParticleSliceKDTree through ``coord`` using this tree"""
+        return ParticleSliceKDTree.from_kdtree(self, direction, coord)
+
+
+# the most recently built trees, see build_kdtree
+_kdtree_cache = _LRUCache(4)
+
+
+def _positions_key(positions):
+    positions = np.ascontiguousarray(positions)
+    digest = hashlib.sha1(positions.view(np.uint8)).hexdigest()
+    return (positions.shape, positions.dtype.str, digest)
+
+
+def build_kdtree(positions, left_edge, right_edge, leafsize=16,
+                 periodic=(True, True, True), amr_nested=True, cache=True):
+    """Build a ParticleKDTree, reusing a cached tree when possible
+
+    Trees are cached by the content hash of ``positions`` together with the
+    bounding box and build parameters. The cache keeps the most recently
+    used trees and evicts the least recently used one once it holds
+    ``qtree.kdtree._kdtree_cache.max_size`` trees.
+
+    Parameters
+    ----------
+    positions, left_edge, right_edge, leafsize, periodic, amr_nested
+        See ParticleKDTree.
+    cache : bool
+        Whether to look up and store the tree in the cache.
+    """
+    if not cache:
+        return ParticleKDTree(positions, left_edge, right_edge, leafsize,
+                              periodic, amr_nested)
+
+    key = (_positions_key(positions),
+           tuple(np.asarray(left_edge, dtype='float64')),
+           tuple(np.asarray(right_edge, dtype='float64')),
+           leafsize, tuple(periodic), amr_nested)
+    tree = _kdtree_cache.get(key)
+    if tree is None:
+        tree = ParticleKDTree(positions, left_edge, right_edge, leafsize,
+                              periodic, amr_nested)
+        _kdtree_cache.put(key, tree)
+    return tree
+
+
+class _KDTreeView(object):
+    """Common functionality of the projection and slice KDTrees"""
+
+    @classmethod
+    def _from_tree(cls, tree, direction):
+        view = cls.__new__(cls)
+        view.tree = tree
+        view.direction = direction
+        return view
+
+    @property
+    def kdtree(self):
+        return self.tree.kdtree
+
+    @property
+    def left_edge(self):
+        return self.tree.left_edge
+
+    @property
+    def right_edge(self):
+        return self.tree.right_edge
+
+    def _leaf_arrays(self):
+        return self.tree.leaf_arrays()
+
+    def _plane_bounds(self):
+        d = DIRECTION_MAPPING[self.direction]
+        return np.array([np.delete(self.left_edge, d),
+                         np.delete(self.right_edge, d)])
+
+    def _check_field(self, field):
+        field = np.asarray(field)
+        if field.shape[0] != self.tree.num_particles:
+            raise RuntimeError(
+                "Received %s field entries but the tree contains %s "
+                "particles" % (field.shape[0], self.tree.num_particles))
+        return field
+
+    def _leaf_field_sums(self, field):
+        return self.tree.leaf_sums(field)
+
+    def stats(self):
+        """Summarize the underlying ParticleKDTree, see its ``stats``"""
+        return self.tree.stats()
+
+    def _deposit(self, values, leaves, image, nthreads):
+        """Deposit per-leaf values of the given leaves onto the plane"""
+        left_edge, right_edge, _, _ = self._leaf_arrays()
+        d = DIRECTION_MAPPING[self.direction]
+        left_edge = np.delete(left_edge[leaves], d, axis=-1)
+        right_edge = np.delete(right_edge[leaves], d, axis=-1)
+
+        bounds = self._plane_bounds()
+        dd = (bounds[1] - bounds[0])/np.array(image.shape)
+
+        with _timed('kdtree.pixelize', shape=image.shape,
+                    num_leaves=left_edge.shape[0], nthreads=nthreads):
+            _deposit_leaves(image, (left_edge - bounds[0])/dd,
+                            (right_edge - bounds[0])/dd, values[leaves], True,
+                            nthreads)
+        return image
+
+
+class ParticleProjectionKDTree(_KDTreeView):
 
     def __init__(self, positions, direction, left_edge, right_edge,
-                 amr_nested=True):
+                 amr_nested=True, leafsize=16, periodic=(True, True, True),
+                 cache=False):
         """A data structure for projecting particles using a KDTree
 
         Parameters
@@ -80,31 +463,96 @@ class ParticleProjectionKDTree(object):
         amr_nested : bool
             Force the kdtree to split at nearest AMR cell boundary for
             KDTree level
+        leafsize : int
+            The maximum number of particles in a KDTree leaf.
+        periodic : 3-element iterable of bools
+            Whether the domain is periodic along each axis.
+        cache : bool
+            If True, reuse a tree built from the same positions and
+            parameters by ``build_kdtree``. To share one tree between
+            several views without hashing the positions, build a
+            ParticleKDTree and use its ``projection_view`` method.
         """
         self.direction = direction
-        self.kdtree = PyKDTree(positions, left_edge, right_edge,
-                               periodic=(True, True, True), leafsize=16,
-                               amr_nested=amr_nested)
+        self.tree = build_kdtree(positions, left_edge, right_edge, leafsize,
+                                 periodic, amr_nested, cache=cache)
+
+    @classmethod
+    def from_kdtree(cls, tree, direction):
+        """Create a projection view of an existing ParticleKDTree"""
+        return cls._from_tree(tree, direction)
+
+    def project(self, field, image, weight=None, nthreads=1):
+        """Project a particle field along the projection direction
+
+        The particles of each leaf are spread uniformly over the leaf, so
+        each leaf contributes its summed field divided by its extent in the
+        image plane, weighted by its fractional overlap with every pixel.
+        The image covers the bounding box of the tree.
 
-    def plot(self, filename=None):
+        Parameters
+        ----------
+        field : ndarray
+            The per-particle field to project, in the order of the positions
+            used to build the tree.
+        image : 2D array
+            Image to project onto. The projection is added to the image.
+        weight : ndarray, optional
+            If given, the image receives the weighted average of ``field``
+            along each line of sight, i.e. the projection of
+            ``field*weight`` divided by the projection of ``weight``.
+            Pixels with no weight are left untouched.
+        nthreads : int, optional
+            The number of threads used to render tiles of the image
+            concurrently. Defaults to 1.
+        """
+        image = np.asarray(image)
 
-        plot_nodes = []
+        if len(image.shape) != 2:
+            raise RuntimeError("Must project onto 2D image")
 
-        for leaf in self.kdtree.leaves:
-            le = leaf.left_edge
-            re = leaf.right_edge
-            d = DIRECTION_MAPPING[self.direction]
-            le = np.hstack([le[:d], le[d+1:]])
-            re = np.hstack([re[:d], re[d+1:]])
-            plot_nodes.append((le, re, leaf.npts))
+        field = self._check_field(field)
 
-        _plot(plot_nodes, filename, outlines_only=True)
+        if weight is None:
+            self._project(field, image, nthreads)
+            return image
 
+        weight = self._check_field(weight)
 
-class ParticleSliceKDTree(object):
+        weighted = self._project(field*weight, np.zeros(image.shape),
+                                 nthreads)
+        total_weight = self._project(weight, np.zeros(image.shape),
+                                     nthreads)
+        nonzero = total_weight != 0
+        image[nonzero] += weighted[nonzero] / total_weight[nonzero]
+        return image
+
+    def _project(self, field, image, nthreads):
+        left_edge, right_edge, _, _ = self._leaf_arrays()
+        d = DIRECTION_MAPPING[self.direction]
+        area = np.delete(right_edge - left_edge, d, axis=-1).prod(axis=-1)
+        values = self._leaf_field_sums(field) / area
+        return self._deposit(values, slice(None), image, nthreads)
+
+    def plot(self, filename=None, rgba=False, shape=(1024, 1024)):
+        """Plot the outlines of the projected leaves
+
+        If ``rgba`` is True the outlines are rasterized into a
+        ``(ny, nx, 4)`` uint8 RGBA array of ``shape`` pixels which is
+        returned, and saved with ``imsave`` if ``filename`` is given.
+        """
+        left_edge, right_edge, _, npts = self._leaf_arrays()
+        d = DIRECTION_MAPPING[self.direction]
+        return _plot(np.delete(left_edge, d, axis=-1),
+                     np.delete(right_edge, d, axis=-1), npts, filename,
+                     outlines_only=True, rgba=rgba, shape=shape)
+
+
+class ParticleSliceKDTree(_KDTreeView):
 
     def __init__(self, positions, direction, coord, left_edge, right_edge,
-                 amr_nested=True):
+                 amr_nested=True, leafsize=16, periodic=(True, True, True),
+                 cache=False):
         """A data structure for projecting particles using a KDTree
 
         Parameters
@@ -125,28 +573,120 @@ class ParticleSliceKDTree(object):
         amr_nested : bool
             Force the kdtree to split at nearest AMR cell boundary for
             KDTree level
+        leafsize : int
+            The maximum number of particles in a KDTree leaf.
+        periodic : 3-element iterable of bools
+            Whether the domain is periodic along each axis.
+        cache : bool
+            If True, reuse a tree built from the same positions and
+            parameters by ``build_kdtree``. To share one tree between
+            several views without hashing the positions, build a
+            ParticleKDTree and use its ``slice_view`` method.
         """
         self.coord = coord
         self.direction = direction
-        self.kdtree = PyKDTree(positions, left_edge, right_edge,
-                               periodic=(True, True, True), leafsize=16,
-                               amr_nested=amr_nested)
+        self.tree = build_kdtree(positions, left_edge, right_edge, leafsize,
+                                 periodic, amr_nested, cache=cache)
+
+    @classmethod
+    def from_kdtree(cls, tree, direction, coord):
+        """Create a slice view of an existing ParticleKDTree"""
+        view = cls._from_tree(tree, direction)
+        view.coord = coord
+        return view
+
+    def slab_index(self, axis=None):
+        """The index of leaves intersecting slices along an axis
+
+        The index is built on first use and cached on the shared
+        ParticleKDTree.
+
+        Parameters
+        ----------
+        axis : string, optional
+            One of 'x', 'y', or 'z'. Defaults to the slice direction.
+        """
+        if axis is None:
+            axis = self.direction
+        return self.tree.slab_index(axis)
+
+    def _leaf_densities(self, field):
+        left_edge, right_edge, _, _ = self._leaf_arrays()
+        volume = (right_edge - left_edge).prod(axis=-1)
+        return self._leaf_field_sums(field) / volume
+
+    def slice(self, coord, field, image, nthreads=1):
+        """Deposit a slice of a particle field through ``coord``
 
-    def plot(self, filename):
+        Every leaf intersecting the slice contributes the density of the
+        field inside the leaf, weighted by its fractional overlap with each
+        pixel. The image covers the bounding box of the tree.
 
-        plot_nodes = []
+        Parameters
+        ----------
+        coord : float
+            The coordinate along the slice direction.
+        field : ndarray
+            The per-particle field to slice, in the order of the positions
+            used to build the tree.
+        image : 2D array
+            Image to deposit onto. The slice is added to the image.
+        nthreads : int, optional
+            The number of threads used to render tiles of the image
+            concurrently. Defaults to 1.
+        """
+        image = np.asarray(image)
 
-        for leaf in self.kdtree.leaves:
-            le = leaf.left_edge
-            re = leaf.right_edge
-            d = DIRECTION_MAPPING[self.direction]
-            if not le[d] < self.coord <= re[d]:
-                continue
-            le = np.hstack([le[:d], le[d+1:]])
-            re = np.hstack([re[:d], re[d+1:]])
-            plot_nodes.append((le, re, leaf.npts))
+        if len(image.shape) != 2:
+            raise RuntimeError("Must slice onto 2D image")
 
-        _plot(plot_nodes, filename)
+        values = self._leaf_densities(self._check_field(field))
+        return self._deposit(values, self.slab_index().query(coord), image,
+                             nthreads)
+
+    def slice_stack(self, coords, field, shape, nthreads=1):
+        """Deposit slices through several coordinates at once
+
+        The leaf densities are computed once and reused for every slice.
+
+        Parameters
+        ----------
+        coords : iterable of floats
+            The coordinates along the slice direction.
+        field : ndarray
+            The per-particle field to slice.
+        shape : 2-element tuple
+            The shape of each slice.
+        nthreads : int, optional
+            The number of threads used to render each slice.
+
+        Returns
+        -------
+        ndarray of shape ``(len(coords),) + shape``
+        """
+        coords = np.asarray(coords)
+        values = self._leaf_densities(self._check_field(field))
+        index = self.slab_index()
+
+        stack = np.zeros((coords.shape[0],) + tuple(shape))
+        for image, coord in zip(stack, coords):
+            self._deposit(values, index.query(coord), image, nthreads)
+        return stack
+
+    def plot(self, filename, rgba=False, shape=(1024, 1024)):
+        """Plot the leaves intersecting the slice colored by their number
+        of points
+
+        If ``rgba`` is True the outlines are rasterized into a
+        ``(ny, nx, 4)`` uint8 RGBA array of ``shape`` pixels which is
+        returned, and saved with ``imsave`` if ``filename`` is given.
+        """
+        left_edge, right_edge, _, npts = self._leaf_arrays()
+        leaves = self.slab_index().query(self.coord)
+        d = DIRECTION_MAPPING[self.direction]
+        return _plot(np.delete(left_edge[leaves], d, axis=-1),
+                     np.delete(right_edge[leaves], d, axis=-1),
+                     npts[leaves], filename, rgba=rgba, shape=shape)
 
 
 def natural_pow2_resolution(vals):
@@ -0,0 +1,347 @@
+import numpy as np
+
+from qtree.plotting import (_box_segments, _plot_segments,
+                            _rasterize_rgba, _save_rgba)
+from qtree.quad_tree import _NODE_CAPACITY
+from qtree.tiling import _deposit_leaves
+
+# number of bits per axis in the morton keys, this is also the maximum
+# depth of the tree
+_MAX_LEVEL = 32
+
+_MORTON_MASKS = (
+    (16, np.uint64(0x0000FFFF0000FFFF)),
+    (8, np.uint64(0x00FF00FF00FF00FF)),
+    (4, np.uint64(0x0F0F0F0F0F0F0F0F)),
+    (2, np.uint64(0x3333333333333333)),
+    (1, np.uint64(0x5555555555555555)),
+)
+
+# child quadrant offsets in morton order, this matches the iteration
+# order of quad_tree._Direction
+_CHILD_OFFSETS = np.array([(-1, -1), (1, -1), (-1, 1), (1, 1)])
+
+
+def _spread_bits(keys):
+    keys = keys & np.uint64(0x00000000FFFFFFFF)
+    for shift, mask in _MORTON_MASKS:
+        keys = (keys | (keys << np.uint64(shift))) & mask
+    return keys
+
+
+def _morton_keys(positions, left_edge, width):
+    """Compute morton keys for positions inside a square domain
+
+    Particles that lie exactly on a quadrant boundary are assigned to the
+    lower quadrant, matching the ``positions > center`` convention used by
+    ParticleQuadTreeNode.
+    """
+    scaled = (positions - left_edge) / width * float(2**_MAX_LEVEL)
+    ikeys = np.clip(np.ceil(scaled) - 1, 0, 2**_MAX_LEVEL - 1)
+    ikeys = ikeys.astype(np.uint64)
+    return _spread_bits(ikeys[:, 0]) | (_spread_bits(ikeys[:, 1]) <<
+                                        np.uint64(1))
+
+
+class _LinearQuadTreeLeaf(object):
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree, index):
+        """A lightweight view of a single leaf of a ParticleLinearQuadTree"""
+        self.tree = tree
+        self.index = index
+
+    @property
+    def num_particles(self):
+        return int(self.tree.node_count[self.index])
+
+    @property
+    def positions(self):
+        start = self.tree.node_start[self.index]
+        return self.tree.positions[start:start + self.num_particles]
+
+    @property
+    def deposit_field(self):
+        start = self.tree.node_start[self.index]
+        return self.tree.deposit_field[start:start + self.num_particles]
+
+    @property
+    def center(self):
+        return self.tree.node_center[self.index]
+
+    @property
+    def half_width(self):
+        return self.tree.node_half_width[self.index]
+
+    @property
+    def left_edge(self):
+        return self.center - self.half_width
+
+    @property
+    def right_edge(self):
+        return self.center + self.half_width
+
+    @property
+    def area(self):
+        return (self.right_edge - self.left_edge).prod()
+
+
+class ParticleLinearQuadTree(object):
+
+    def __init__(self, center, half_width, leaf_size=_NODE_CAPACITY):
+        """A QuadTree stored in flat arrays of morton-sorted particles
+
+        This is an array-backed alternative to ParticleQuadTreeNode. Rather
+        than allocating a python object for every node, the tree is
+        described by per-node arrays and the particles are stored in a
+        single array sorted along a morton curve, so every node owns a
+        contiguous range of particles.
+
+        Parameters
+        ----------
+        center : 2-element iterable
+            The center of the root node
+        half_width : float
+            The half-width of the root node. Currently only square nodes are
+            supported.
+        leaf_size : int, optional
+            The maximum number of particles stored in a leaf before it is
+            refined.
+        """
+        center = np.array(center, dtype='float64')
+
+        if center.shape != (2,):
+            raise RuntimeError(
+                "Received center with shape %s but expected (2,)"
+                % (center.shape,))
+
+        self.center = center
+        self.half_width = half_width
+        self.leaf_size = leaf_size
+
+        self.positions = np.empty((0, 2))
+        self.deposit_field = np.empty(0)
+        self.keys = np.empty(0, dtype=np.uint64)
+
+        self._build()
+
+    def insert(self, positions, deposit_field=None):
+        """Insert particles into the quadtree
+
+        Parameters
+        ----------
+        positions : 2 element iterable or iterable of 2-element iterables
+            Positions of the particles to be inserted.
+        deposit_field : iterable, optional
+            Field to be deposited and pixelized. Must have the same number of
+            elements as the number of positions.
+        """
+        positions = np.asarray(positions, dtype='float64')
+        if len(positions.shape) == 1:
+            positions = np.asarray([positions])
+
+        nparticles = positions.shape[0]
+
+        if deposit_field is None:
+            deposit_field = np.zeros(nparticles)
+        deposit_field = np.asarray(deposit_field, dtype='float64')
+
+        if nparticles != deposit_field.shape[0]:
+            raise RuntimeError(
+                "Received %s deposit_field entries but received %s particle "
+                "positions" % (deposit_field.shape[0], nparticles))
+
+        if positions.shape[-1] != 2:
+            raise RuntimeError(
+                "Received %sD positions but expected 2D positions"
+                % (positions.shape[-1],))
+
+        if not ((positions > self.left_edge).all() and
+                (positions < self.right_edge).all()):
+            raise RuntimeError(
+                "positions outside node with left_edge=%s and right_edge=%s"
+                % (self.left_edge, self.right_edge))
+
+        keys = _morton_keys(positions, self.left_edge, 2*self.half_width)
+
+        keys = np.concatenate((self.keys, keys))
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.positions = np.concatenate((self.positions, positions))[order]
+        self.deposit_field = np.concatenate(
+            (self.deposit_field, deposit_field))[order]
+
+        self._build()
+
+    def _build(self):
+        """Build the node arrays from the sorted morton keys"""
+        keys = self.keys
+
+        level = np.zeros(1, dtype='int64')
+        prefix = np.zeros(1, dtype=np.uint64)
+        start = np.zeros(1, dtype='int64')
+        count = np.array([keys.shape[0]], dtype='int64')
+        center = self.center[None, :]
+
+        levels = [level]
+        prefixes = [prefix]
+        starts = [start]
+        counts = [count]
+        centers = [center]
+        children = []
+        nnodes = 1
+
+        for lvl in range(_MAX_LEVEL):
+            refine = count > self.leaf_size
+            child = np.full(count.shape, -1, dtype='int64')
+            nrefine = refine.sum()
+            child[refine] = nnodes + 4*np.arange(nrefine)
+            children.append(child)
+            if nrefine == 0:
+                break
+            nnodes += 4*nrefine
+
+            shift = np.uint64(2*(_MAX_LEVEL - lvl - 1))
+            child_prefix = (
+                prefix[refine, None]*np.uint64(4) +
+                np.arange(4, dtype=np.uint64)).ravel()
+
+            bounds = np.empty((nrefine, 5), dtype='int64')
+            bounds[:, 0] = start[refine]
+            bounds[:, 4] = start[refine] + count[refine]
+            bounds[:, 1:4] = np.searchsorted(
+                keys, child_prefix.reshape(nrefine, 4)[:, 1:] << shift)
+
+            child_half_width = self.half_width / 2.0**(lvl + 1)
+            center = (center[refine, None, :] +
+                      child_half_width*_CHILD_OFFSETS).reshape(-1, 2)
+            prefix = child_prefix
+            start = bounds[:, :4].ravel()
+            count = np.diff(bounds, axis=1).ravel()
+            level = np.full(start.shape, lvl + 1, dtype='int64')
+
+            levels.append(level)
+            prefixes.append(prefix)
+            starts.append(start)
+            counts.append(count)
+            centers.append(center)
+        else:
+            children.append(np.full(count.shape, -1, dtype='int64'))
+
+        self.node_level = np.concatenate(levels)
+        self.node_start = np.concatenate(starts)
+        self.node_count = np.concatenate(counts)
+        self.node_child = np.concatenate(children)
+        self.node_center = np.concatenate(centers)
+        self.node_half_width = self.half_width / 2.0**self.node_level
+
+        # the lower left corner of each node in units of the finest cells
+        corner_keys = np.concatenate(prefixes) << (
+            np.uint64(2)*(np.uint64(_MAX_LEVEL) -
+                          self.node_level.astype(np.uint64)))
+
+        # sorting leaves by the morton key of their lower left corner yields
+        # the same depth-first order as ParticleQuadTreeNode.leaves
+        leaf_indices = np.nonzero(self.node_child < 0)[0]
+        self.leaf_indices = leaf_indices[
+            np.argsort(corner_keys[leaf_indices], kind='stable')]
+
+    @property
+    def num_particles(self):
+        return self.positions.shape[0]
+
+    @property
+    def num_nodes(self):
+        return self.node_level.shape[0]
+
+    @property
+    def leaves(self):
+        for index in self.leaf_indices:
+            yield _LinearQuadTreeLeaf(self, index)
+
+    @property
+    def left_edge(self):
+        return self.center - self.half_width
+
+    @property
+    def right_edge(self):
+        return self.center + self.half_width
+
+    @property
+    def area(self):
+        return (self.right_edge - self.left_edge).prod()
+
+    def _leaf_sums(self):
+        leaves = self.leaf_indices
+        start = self.node_start[leaves]
+        count = self.node_count[leaves]
+        sums = np.zeros(leaves.shape[0])
+        occupied = count > 0
+        if self.num_particles > 0 and occupied.any():
+            sums[occupied] = np.add.reduceat(
+                self.deposit_field, start[occupied])
+        return sums
+
+    def pixelize(self, image, area_weighted=False, nthreads=1):
+        """pixelize the deposit_field onto an image
+
+        Parameters
+        ----------
+        image : 2D array
+            Image to pixelize onto
+        area_weighted : bool, optional
+            If True, leaves that only partially cover a pixel contribute in
+            proportion to the fraction of the pixel they cover. Otherwise
+            leaf edges are truncated to pixel boundaries. Defaults to False.
+        nthreads : int, optional
+            The number of threads used to render tiles of the image
+            concurrently. Defaults to 1.
+        """
+        image = np.asarray(image)
+
+        if len(image.shape) != 2:
+            raise RuntimeError("Must pixelize onto 2D image")
+
+        bounds = np.array([self.left_edge, self.right_edge])
+        dd = (bounds[1] - bounds[0])/np.array(image.shape)
+
+        leaves = self.leaf_indices
+        center = self.node_center[leaves]
+        half_width = self.node_half_width[leaves, None]
+        left_edge = center - half_width
+        right_edge = center + half_width
+        area = (right_edge - left_edge).prod(axis=-1)
+
+        _deposit_leaves(image, (left_edge - bounds[0])/dd,
+                        (right_edge - bounds[0])/dd, self._leaf_sums() / area,
+                        area_weighted, nthreads)
+
+        return image
+
+    def plot(self, filename=None, rgba=False, shape=(1024, 1024)):
+        """Plot the quadtree
+
+        The outlines of all leaves are drawn as a single line collection
+        and all particles with a single scatter call.
+
+        Parameters
+        ----------
+        filename : string, optional
+            The file to save the plot to, the plot is shown if None.
+        rgba : bool, optional
+            If True no matplotlib artists are created, instead the plot is
+            rasterized into a ``(ny, nx, 4)`` uint8 RGBA array which is
+            returned and, if ``filename`` is given, saved with ``imsave``.
+        shape : 2-element tuple, optional
+            The number of pixels along the x and y axes of the RGBA array.
+        """
+        leaves = self.leaf_indices
+        half_width = self.node_half_width[leaves, None]
+        segments = _box_segments(self.node_center[leaves] - half_width,
+                                 self.node_center[leaves] + half_width)
+        bounds = (self.left_edge, self.right_edge)
+        if rgba:
+            return _save_rgba(
+                _rasterize_rgba(bounds, shape, segments, self.positions),
+                filename)
+        _plot_segments(segments, self.positions, bounds, filename)
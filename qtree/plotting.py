@@ -0,0 +1,145 @@
+"""Batched plotting of trees and meshes
+
+Outlines are drawn from a single ``(nsegments, 2, 2)`` array of line
+segments and all particles with a single scatter call, so a plot costs a
+handful of matplotlib artists whatever the size of the tree. The same
+segments and points can be rasterized straight into an RGBA array without
+creating any matplotlib artists.
+"""
+import numpy as np
+
+_BLACK = (0, 0, 0, 255)
+
+
+def _box_segments(left_edge, right_edge):
+    """The four sides of each box as ``(4*nboxes, 2, 2)`` line segments"""
+    left_edge = np.asarray(left_edge, dtype='float64').reshape(-1, 2)
+    right_edge = np.asarray(right_edge, dtype='float64').reshape(-1, 2)
+    (x0, y0), (x1, y1) = left_edge.T, right_edge.T
+    corners = np.stack((np.column_stack((x0, y0)),
+                        np.column_stack((x1, y0)),
+                        np.column_stack((x1, y1)),
+                        np.column_stack((x0, y1))), axis=1)
+    return np.stack((corners, np.roll(corners, -1, axis=1)),
+                    axis=2).reshape(-1, 2, 2)
+
+
+def _clip_segments(segments, bounds):
+    """Clip line segments to a rectangle, dropping those outside of it
+
+    This is the Liang-Barsky algorithm applied to all segments at once.
+    """
+    start = segments[:, 0]
+    delta = segments[:, 1] - start
+    t0 = np.zeros(segments.shape[0])
+    t1 = np.ones(segments.shape[0])
+    for axis in range(2):
+        d = delta[:, axis]
+        x = start[:, axis]
+        parallel = d == 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ta = (bounds[0, axis] - x) / d
+            tb = (bounds[1, axis] - x) / d
+        t0 = np.where(parallel, t0, np.maximum(t0, np.minimum(ta, tb)))
+        t1 = np.where(parallel, t1, np.minimum(t1, np.maximum(ta, tb)))
+        outside = parallel & ((x < bounds[0, axis]) | (x > bounds[1, axis]))
+        t1[outside] = -1
+    keep = t0 <= t1
+    return np.stack((start + t0[:, None]*delta, start + t1[:, None]*delta),
+                    axis=1)[keep]
+
+
+def _set_pixels(rgba, pixels, color):
+    """Color the pixels containing ``(n, 2)`` points in pixel units"""
+    ny, nx = rgba.shape[:2]
+    i = np.clip(np.floor(pixels[:, 0]).astype(np.intp), 0, nx - 1)
+    j = np.clip(np.floor(pixels[:, 1]).astype(np.intp), 0, ny - 1)
+    rgba[ny - 1 - j, i] = color
+
+
+def _rasterize_rgba(bounds, shape, segments=None, points=None,
+                    line_color=_BLACK, point_color=_BLACK):
+    """Draw line segments and points into an RGBA image
+
+    Parameters
+    ----------
+    bounds : ndarray
+        The lower-left and upper-right corners of the area covered by the
+        image.
+    shape : 2-element tuple
+        The number of pixels along the x and y axes.
+    segments : ndarray, optional
+        ``(nsegments, 2, 2)`` line segments, sampled once per pixel along
+        their length.
+    points : ndarray, optional
+        ``(npoints, 2)`` points, each coloring the pixel it lies in.
+
+    Returns
+    -------
+    A ``(ny, nx, 4)`` uint8 array on a white background. The first row is
+    the top of the image, as expected by ``imshow`` and ``imsave``.
+    """
+    bounds = np.asarray(bounds, dtype='float64')
+    nx, ny = shape
+    rgba = np.full((ny, nx, 4), 255, dtype=np.uint8)
+    scale = np.array(shape) / (bounds[1] - bounds[0])
+
+    if segments is not None and len(segments):
+        segments = _clip_segments(np.asarray(segments, dtype='float64'),
+                                  bounds)
+        start = (segments[:, 0] - bounds[0])*scale
+        delta = (segments[:, 1] - segments[:, 0])*scale
+        nsamples = np.ceil(np.abs(delta).max(axis=-1)).astype(np.intp) + 1
+        segment = np.repeat(np.arange(segments.shape[0]), nsamples)
+        first = np.cumsum(nsamples) - nsamples
+        t = ((np.arange(nsamples.sum()) - first[segment]) /
+             np.maximum(nsamples - 1, 1)[segment])
+        _set_pixels(rgba, start[segment] + t[:, None]*delta[segment],
+                    line_color)
+
+    if points is not None and len(points):
+        points = np.asarray(points, dtype='float64')
+        inside = ((points >= bounds[0]) & (points <= bounds[1])).all(axis=-1)
+        _set_pixels(rgba, (points[inside] - bounds[0])*scale, point_color)
+
+    return rgba
+
+
+def _save_rgba(rgba, filename):
+    if filename is not None:
+        from matplotlib import pyplot as plt
+        plt.imsave(filename, rgba)
+    return rgba
+
+
+def _plot_segments(segments, points, bounds, filename=None, axes=None,
+                   linewidths=None):
+    """Plot line segments and points with one artist each
+
+    The figure is shown if ``filename`` is None and no ``axes`` are given.
+    """
+    from matplotlib import pyplot as plt
+    from matplotlib.collections import LineCollection
+
+    if axes is None:
+        fig = plt.figure(figsize=(4, 4))
+        axes = fig.add_axes([.01, .01, .98, .98])
+        axes.set_aspect('equal')
+        axes.axis('off')
+        show = filename is None
+    else:
+        fig = axes.figure
+        show = False
+
+    axes.add_collection(LineCollection(segments, color='k',
+                                       linewidths=linewidths))
+    if points is not None:
+        axes.scatter(points[:, 0], points[:, 1], s=.2, color='k',
+                     marker='o')
+    axes.set_xlim((bounds[0][0], bounds[1][0]))
+    axes.set_ylim((bounds[0][1], bounds[1][1]))
+
+    if show:
+        plt.show()
+    elif filename is not None:
+        fig.savefig(filename, dpi=400)
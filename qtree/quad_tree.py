@@ -1,12 +1,16 @@
-try:
-    import enum
-except ImportError:
-    # need enum34 on python2.7
-    import enum34 as enum
+import enum
+import tracemalloc
 
 import numpy as np
-from matplotlib import pyplot as plt
-from matplotlib.patches import Rectangle
+
+from qtree.cache import _CACHE_BYTES, _ArrayCache
+from qtree.fields import (_apply_weights, _check_image, _field_columns,
+                          _num_fields, _resolve_weights, _weight_indices)
+from qtree.instrumentation import _timed
+from qtree.plotting import (_box_segments, _plot_segments,
+                            _rasterize_rgba, _save_rgba)
+from qtree.serialization import _load_arrays, _open_array, _save_arrays
+from qtree.tiling import _deposit_leaves
 
 
 @enum.unique
@@ -19,6 +23,9 @@ class _Direction(enum.Enum):
 
 _NODE_CAPACITY = 4
 
+# number of particles read at a time when streaming particles into a tree
+_CHUNK_SIZE = 2**20
+
 _offsets = {
     _Direction.SOUTHWEST: np.array((-1, -1)),
     _Direction.SOUTHEAST: np.array((1, -1)),
@@ -26,13 +33,241 @@ _offsets = {
     _Direction.NORTHEAST: np.array((1, 1)),
 }
 
+# child attribute names indexed by quadrant, see _quadrants
+_child_names = tuple(d.name.lower() for d in _Direction)
+
+
+def _iter_chunks(source, deposit_field, chunk_size):
+    """Yield (positions, deposit_field) chunks read from a particle source"""
+    if hasattr(source, 'shape') and hasattr(source, '__getitem__'):
+        for start in range(0, source.shape[0], chunk_size):
+            stop = start + chunk_size
+            chunk_field = None
+            if isinstance(deposit_field, dict):
+                chunk_field = {name: np.asarray(field[start:stop])
+                               for name, field in deposit_field.items()}
+            elif deposit_field is not None:
+                chunk_field = np.asarray(deposit_field[start:stop])
+            yield np.asarray(source[start:stop]), chunk_field
+        return
+
+    if deposit_field is not None:
+        raise RuntimeError(
+            "deposit_field must be None when the particle source yields "
+            "(positions, deposit_field) chunks")
+    for positions, chunk_field in source:
+        if chunk_field is not None and not isinstance(chunk_field, dict):
+            chunk_field = np.asarray(chunk_field)
+        yield np.asarray(positions), chunk_field
+
+
+def _group_by(index, ngroups):
+    """The positions in ``index`` holding each value below ``ngroups``"""
+    order = np.argsort(index, kind='stable')
+    stops = np.cumsum(np.bincount(index, minlength=ngroups)).tolist()
+    return [order[start:stop] for start, stop in zip([0] + stops, stops)]
+
+
+def _group_sums(values, groups):
+    """The float64 sums of the ``(nfields, n)`` values over each group"""
+    if not groups:
+        return np.zeros((0, values.shape[0]))
+    order = np.concatenate(groups)
+    starts = np.cumsum([0] + [group.shape[0] for group in groups[:-1]])
+    return np.add.reduceat(values[:, order].astype('float64'), starts,
+                           axis=1).T
+
+
+def _leaf_centers(leaves):
+    return np.array([leaf.center for leaf in leaves]).reshape(-1, 2)
+
+
+def _as_points(points):
+    """Convert query points to a ``(n, 2)`` array"""
+    points = np.asarray(points, dtype='float64')
+    if len(points.shape) == 1:
+        points = np.asarray([points])
+    if points.shape[-1] != 2:
+        raise RuntimeError(
+            "Received %sD points but expected 2D points"
+            % (points.shape[-1],))
+    return points
+
+
+def _csr(nqueries, queries, ids):
+    """Group (query, id) pairs by query into CSR offsets and indices
+
+    The indices of each query are sorted in increasing order.
+    """
+    order = np.lexsort((ids, queries))
+    offsets = np.zeros(nqueries + 1, dtype=np.intp)
+    offsets[1:] = np.cumsum(np.bincount(queries, minlength=nqueries))
+    return offsets, ids[order]
+
+
+def _quadrants(positions, inds, center):
+    """The quadrant of each particle in ``positions[inds]``
+
+    Particles are gathered in chunks so that at most _CHUNK_SIZE positions
+    are copied at a time, even for memory-mapped positions.
+    """
+    quadrant = np.empty(inds.shape[0], dtype=np.int8)
+    for start in range(0, inds.shape[0], _CHUNK_SIZE):
+        stop = start + _CHUNK_SIZE
+        above = positions[inds[start:stop]] > center
+        quadrant[start:stop] = above[:, 0] + 2*above[:, 1]
+    return quadrant
+
+
+def _quadrant_totals(deposit_field, inds, quadrant, nfields):
+    """The sum of each field over the particles ``inds`` in each quadrant
+
+    Like _quadrants the field values are gathered in chunks.
+    """
+    totals = np.zeros((4, nfields))
+    if deposit_field is None:
+        return totals
+    for f, column in enumerate(deposit_field):
+        for start in range(0, inds.shape[0], _CHUNK_SIZE):
+            stop = start + _CHUNK_SIZE
+            totals[:, f] += np.bincount(quadrant[start:stop],
+                                        weights=column[inds[start:stop]],
+                                        minlength=4)
+    return totals
+
+
+class _SharedArrays(object):
+
+    def __init__(self):
+        """Named copies of arrays in shared memory, released on exit
+
+        ``specs`` describes the arrays so that worker processes can attach
+        to them with _attach_shared. Views of the arrays must not outlive
+        the context.
+        """
+        self.blocks = []
+        self.specs = {}
+
+    def add(self, name, array, dtype=None):
+        """Copy an array into shared memory and return the shared copy,
+        converted to ``dtype`` if given"""
+        from multiprocessing import shared_memory
+
+        dtype = array.dtype if dtype is None else np.dtype(dtype)
+        nbytes = int(np.prod(array.shape)) * dtype.itemsize
+        block = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        self.blocks.append(block)
+        self.specs[name] = (block.name, array.shape, dtype.str)
+        shared = np.ndarray(array.shape, dtype=dtype, buffer=block.buf)
+        # copy in chunks so memory-mapped arrays are never fully loaded
+        for start in range(0, array.shape[0], _CHUNK_SIZE):
+            shared[start:start + _CHUNK_SIZE] = array[start:start +
+                                                      _CHUNK_SIZE]
+        return shared
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+
+# the shared arrays of a worker process of ParticleQuadTreeNode.build
+_shared_arrays = None
+
+
+def _attach_shared(specs):
+    global _shared_arrays
+    from multiprocessing import shared_memory
+
+    _shared_arrays = {}
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _shared_arrays[name] = (
+            block, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+
+
+def _build_subtree(center, half_width, leaf_size, storage, dtype, names,
+                   start, stop, totals):
+    """Build the subtree of a node from the range ``start:stop`` of the
+    shared particle order in a worker process
+
+    Returns the subtree as the flat arrays of
+    ``ParticleQuadTreeNode._from_arrays``.
+    """
+    arrays = {name: array for name, (_, array) in _shared_arrays.items()}
+    columns = None
+    if 'field0' in arrays:
+        columns = [arrays['field%d' % f] for f in range(_num_fields(names))]
+
+    node = ParticleQuadTreeNode(center, half_width, leaf_size=leaf_size,
+                                storage=storage, dtype=dtype)
+    node._store = _ParticleStore(field_names=names)
+    node._allocate_fields(node._store.nfields)
+    node._insert_range(arrays['positions'], columns, arrays.get('ids'),
+                       arrays['order'], start, stop, totals)
+
+    # flat arrays are much cheaper to send back than the node objects
+    nodes = node._subtree_nodes()
+    subtree = node._node_arrays(nodes)
+    if storage == 'index':
+        subtree['start'] = np.array([n._start for n in nodes], dtype='int64')
+        return subtree
+    nparticles = stop - start
+    subtree['positions'] = np.empty((nparticles, 2), dtype=dtype)
+    subtree['deposit_field'] = np.empty((_num_fields(names), nparticles),
+                                        dtype=dtype)
+    subtree['ids'] = np.empty(nparticles, dtype='int64')
+    subtree['start'] = node._pack_leaves(
+        nodes, subtree['positions'], subtree['deposit_field'],
+        subtree['ids'])
+    return subtree
+
+
+class _ParticleStore(object):
+    __slots__ = ('positions', 'deposit_field', 'index', 'next_id',
+                 'locations', 'slots', 'field_names', 'mutations')
+
+    def __init__(self, positions=None, deposit_field=None, index=None,
+                 field_names=None):
+        """The particle bookkeeping shared by all nodes of a tree
+
+        With index storage ``index`` is a permutation of the particles such
+        that the particles of a leaf are
+        ``index[leaf._start:leaf._start + leaf.num_particles]``, or None if
+        the particle arrays are already sorted by leaf, and
+        ``deposit_field`` is a list with one array per field. With copy
+        storage the particle arrays live in the leaves and this only tracks
+        the next particle id and, once a dynamic update needs it, the leaf
+        holding each particle id and its slot in the leaf buffers.
+        ``mutations`` counts the changes made to the particles through any
+        node of the tree.
+        """
+        self.positions = positions
+        self.deposit_field = deposit_field
+        self.index = index
+        self.next_id = 0
+        self.locations = None
+        self.slots = None
+        self.field_names = field_names
+        self.mutations = 0
+
+    @property
+    def nfields(self):
+        return _num_fields(self.field_names)
+
 
 class ParticleQuadTreeNode(object):
-    __slots__ = ('positions', 'num_particles', 'center', 'half_width',
+    __slots__ = ('_positions', 'num_particles', 'center', 'half_width',
                  'northeast', 'northwest', 'southeast', 'southwest',
-                 'deposit_field', '_left_edge', '_right_edge')
+                 '_deposit_field', '_ids', '_totals', 'leaf_size', 'storage',
+                 '_store', '_start', '_left_edge', '_right_edge', 'dtype',
+                 '_cache')
 
-    def __init__(self, center, half_width):
+    def __init__(self, center, half_width, leaf_size=_NODE_CAPACITY,
+                 storage='copy', dtype=None):
         """A QuadTree data structure containing particles
 
         Parameters
@@ -42,10 +277,49 @@ class ParticleQuadTreeNode(object):
         half_width : float
             The half-width of the node. Currently only square nodes are
             supported.
+        leaf_size : int, optional
+            The maximum number of particles stored in a leaf node before it
+            is refined. Child nodes inherit the leaf size of their parent.
+        storage : string, optional
+            How particles are stored. With ``'copy'`` (the default) each
+            leaf copies the positions and deposit field of its particles
+            into its own buffers. With ``'index'`` the tree keeps the
+            caller's arrays, which may be memory-mapped, and a single
+            permutation index into them; leaves only record a range of that
+            index and gather ``positions`` and ``deposit_field`` on access.
+            An index-mode tree is built by a single call to ``insert`` and
+            does not support ``remove``, ``update_positions`` or
+            ``update_field``.
+        dtype : numpy dtype, optional
+            The floating point type particles are stored in, e.g.
+            ``'float32'`` to halve the memory used by particle data. With
+            copy storage this defaults to float64 and inserted particles
+            are converted to it. With index storage the caller's arrays are
+            kept in their own type unless ``dtype`` is given. Deposit
+            totals and pixelized images are always accumulated in float64.
         """
-        self.positions = np.empty((_NODE_CAPACITY, 2))
-        self.deposit_field = np.empty(_NODE_CAPACITY)
-        self.positions[:] = np.nan
+        if storage not in ('copy', 'index'):
+            raise RuntimeError(
+                "Unknown storage mode '%s', expected 'copy' or 'index'"
+                % (storage,))
+
+        self.leaf_size = leaf_size
+        self.storage = storage
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self._store = None
+        self._start = 0
+        self._totals = np.zeros(1)
+        if storage == 'copy':
+            if self.dtype is None:
+                self.dtype = np.dtype('float64')
+            self._positions = np.empty((leaf_size, 2), dtype=self.dtype)
+            self._deposit_field = np.empty((1, leaf_size), dtype=self.dtype)
+            self._ids = np.empty(leaf_size, dtype='int64')
+            self._positions[:] = np.nan
+        else:
+            self._positions = None
+            self._deposit_field = None
+            self._ids = None
         self.num_particles = 0
 
         center = np.array(center)
@@ -64,37 +338,219 @@ class ParticleQuadTreeNode(object):
         self.southwest = None
         self._left_edge = None
         self._right_edge = None
+        self._cache = None
 
-    def pixelize(self, image):
+    def pixelize(self, image, area_weighted=False, nthreads=1, weights=None,
+                 lod=False, bounds=None):
         """pixelize the deposit_field onto an image
 
         Parameters
         ----------
-        image : 2D array
-            Image to pixelize onto
+        image : 2D array or 3D array
+            Image to pixelize onto. If the tree stores several deposit
+            fields this is a ``(nfields, nx, ny)`` stack of images, filled
+            in a single pass over the leaves.
+        area_weighted : bool, optional
+            If True, leaves that only partially cover a pixel contribute in
+            proportion to the fraction of the pixel they cover. Otherwise
+            leaf edges are truncated to pixel boundaries and leaves smaller
+            than a pixel may be dropped. Defaults to False.
+        nthreads : int, optional
+            If larger than 1 the image is split into tiles that are
+            rendered concurrently on a pool of ``nthreads`` threads. Each
+            tile only visits the leaves that overlap it and the result is
+            bitwise identical to the serial result. Defaults to 1.
+        weights : dict, optional
+            Maps field names to the names of fields they are averaged
+            with, e.g. ``{'temperature': 'mass'}`` renders the
+            mass-weighted temperature instead of the projected temperature.
+            Pixels without any weight are left untouched.
+        lod : bool, optional
+            If True, nodes no larger than a pixel are not descended into,
+            their aggregated deposit totals are deposited instead of their
+            leaves, so the cost scales with the image size rather than the
+            number of leaves. The result only differs from the full
+            resolution image in how sub-pixel structure is distributed over
+            neighbouring pixels. Cannot be combined with ``weights``.
+            Defaults to False.
+        bounds : 2-element iterable of two-tuples, optional
+            The lower-left and upper-right corners of the window covered by
+            the image, defaults to the bounds of this node. Subtrees that
+            do not overlap the window are skipped, so zoomed-in renders only
+            visit the visible leaves.
+
+        Repeated renders of the same view can be memoized, see
+        ``enable_cache``.
         """
-        image = np.asarray(image)
+        names = self._field_names
+        image = _check_image(image, names)
+        weight_index = _weight_indices(names, weights)
+
+        if bounds is None:
+            bounds = np.array([self.left_edge, self.right_edge])
+        bounds = np.asarray(bounds, dtype='float64')
+        if bounds.shape != (2, 2) or (bounds[1] <= bounds[0]).any():
+            raise RuntimeError(
+                "Received bounds %s but expected [[x0, y0], [x1, y1]] with "
+                "x0 < x1 and y0 < y1" % (bounds.tolist(),))
 
-        if len(image.shape) != 2:
-            raise RuntimeError("Must pixelize onto 2D image")
+        if lod and weights:
+            raise RuntimeError(
+                "Weighted fields cannot be rendered with lod=True")
 
-        bounds = np.array([self.left_edge, self.right_edge])
+        if self._cache is None:
+            return self._render(image, bounds, area_weighted, nthreads,
+                                weight_index, lod)
+        # the mutation count keeps images rendered before a change made
+        # through another node of the tree from being reused
+        mutations = 0 if self._store is None else self._store.mutations
+        key = (image.shape, tuple(bounds.ravel()), bool(area_weighted),
+               bool(lod), frozenset((weights or {}).items()), mutations)
+        rendered = self._cache.get(key)
+        if rendered is None:
+            rendered = self._render(np.zeros(image.shape), bounds,
+                                    area_weighted, nthreads, weight_index,
+                                    lod)
+            self._cache.put(key, rendered)
+        image += rendered
+        return image
 
-        for leaf in self.leaves:
-            leaf._pixelize_subtree(image, bounds)
+    def _render(self, image, bounds, area_weighted, nthreads, weight_index,
+                lod):
+        """Deposit the leaves, or nodes with lod, overlapping the bounds"""
+        names = self._field_names
+        dd = (bounds[1] - bounds[0])/np.array(image.shape[-2:])
+        with _timed('quadtree.traverse', lod=lod) as info:
+            if lod:
+                left_edge, right_edge, deposit = self._lod_arrays(dd.min(),
+                                                                  bounds)
+            else:
+                left_edge, right_edge, deposit = self._leaf_arrays(
+                    weight_index, bounds)
+            info['num_nodes'] = left_edge.shape[0]
+        area = (right_edge - left_edge).prod(axis=-1)
+        values = deposit / area[:, None]
+
+        target = image
+        if deposit.shape[1] > weight_index.shape[0]:
+            target = np.zeros((deposit.shape[1],) + image.shape[-2:])
+        elif names is None:
+            values = values[:, 0]
+
+        with _timed('quadtree.pixelize', shape=image.shape,
+                    nthreads=nthreads):
+            _deposit_leaves(target, (left_edge - bounds[0])/dd,
+                            (right_edge - bounds[0])/dd, values,
+                            area_weighted, nthreads)
+
+        if target is not image:
+            _resolve_weights(target, image, weight_index)
+
+        return image
+
+    def enable_cache(self, max_bytes=_CACHE_BYTES):
+        """Memoize the images rendered by pixelize
 
-    def _pixelize_subtree(self, image, bounds):
-        dd = (bounds[1] - bounds[0])/np.array(image.shape)
+        Images are cached by image shape, bounds, ``area_weighted``,
+        ``lod`` and ``weights``, so repeated renders of the same view are
+        added to the image without traversing the tree. Images rendered
+        before particles are inserted, removed or updated through any node
+        of the tree are never reused. The cache is cleared by mutations
+        through this node, otherwise the stale images are evicted as the
+        cache fills.
 
-        i0 = int((self.left_edge[0] - bounds[0][0])/dd[0])
-        j0 = int((self.left_edge[1] - bounds[0][1])/dd[1])
+        Parameters
+        ----------
+        max_bytes : int, optional
+            The memory budget of the cached images, least recently used
+            images are evicted first. Defaults to 256 MiB.
+        """
+        self._cache = _ArrayCache(max_bytes)
 
-        i1 = int((self.right_edge[0] - bounds[0][0])/dd[0])
-        j1 = int((self.right_edge[1] - bounds[0][1])/dd[1])
+    def disable_cache(self):
+        """Stop memoizing pixelize and release the cached images"""
+        self._cache = None
 
-        deposit = self.deposit_field[:self.num_particles].sum() / self.area
+    def _invalidate_cache(self):
+        if self._store is not None:
+            self._store.mutations += 1
+        if self._cache is not None:
+            self._cache.clear()
+
+    @property
+    def _field_names(self):
+        if self._store is None:
+            return None
+        return self._store.field_names
+
+    def _visible_nodes(self, window=None, pixel_size=0):
+        """Yield the leaves overlapping a window in depth-first order
+
+        Subtrees outside ``window``, which defaults to the bounds of this
+        node, are skipped. Nodes no larger than ``pixel_size`` are yielded
+        instead of their leaves.
+        """
+        if window is None:
+            window = (self.left_edge, self.right_edge)
+        x0, y0 = window[0]
+        x1, y1 = window[1]
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            (le_x, le_y), (re_x, re_y) = node.left_edge, node.right_edge
+            if le_x >= x1 or le_y >= y1 or re_x <= x0 or re_y <= y0:
+                continue
+            if node.is_leaf or 2*node.half_width <= pixel_size:
+                yield node
+            else:
+                stack.extend(reversed(list(node.children)))
 
-        image[i0:i1, j0:j1] += deposit
+    def _lod_arrays(self, pixel_size, window=None):
+        """Gather the edges and aggregated deposit totals of the visible
+        leaves and of the visible nodes no larger than ``pixel_size``"""
+        nodes = [node for node in self._visible_nodes(window, pixel_size)
+                 if node.num_particles > 0]
+
+        nfields = _num_fields(self._field_names)
+        center = np.array([node.center for node in nodes]).reshape(-1, 2)
+        half_width = np.array([node.half_width for node in nodes])
+        totals = np.array([node._totals for node in nodes]).reshape(-1,
+                                                                    nfields)
+        return (center - half_width[:, None], center + half_width[:, None],
+                totals)
+
+    def _leaf_arrays(self, weight_index=None, window=None):
+        """Gather the edges and deposit sums of all leaves into arrays
+
+        The deposit sums have shape ``(nleaves, ncolumns)``, with one column
+        per field followed by the weight fields if ``weight_index`` has
+        weighted fields, see fields._apply_weights. Only the leaves
+        overlapping ``window`` are gathered, see _visible_nodes.
+        """
+        leaves = list(self._visible_nodes(window))
+
+        center = np.array([leaf.center for leaf in leaves])
+        half_width = np.array([leaf.half_width for leaf in leaves])
+        counts = np.array([leaf.num_particles for leaf in leaves])
+
+        nfields = _num_fields(self._field_names)
+        if weight_index is None:
+            weight_index = np.full(nfields, -1, dtype=np.intp)
+        ncolumns = _apply_weights(np.zeros((nfields, 0)),
+                                  weight_index).shape[0]
+
+        deposit = np.zeros((len(leaves), ncolumns))
+        occupied = np.nonzero(counts)[0]
+        if occupied.size > 0:
+            fields = np.concatenate(
+                [leaves[i]._field_values() for i in occupied], axis=1)
+            fields = _apply_weights(fields, weight_index)
+            starts = np.concatenate(([0], np.cumsum(counts[occupied])[:-1]))
+            deposit[occupied] = np.add.reduceat(fields, starts, axis=1,
+                                                dtype='float64').T
+
+        return (center - half_width[:, None], center + half_width[:, None],
+                deposit)
 
     def insert(self, positions, deposit_field=None):
         """Insert particles into the quadtree
@@ -103,9 +559,23 @@ class ParticleQuadTreeNode(object):
         ----------
         positions : 2 element iterable or iterable of 2-element iterables
             Positions of the particles to be inserted.
-        deposit_field : iterable, optional
+        deposit_field : iterable or dict, optional
             Field to be deposited and pixelized. Must have the same number of
-            elements as the number of positions.
+            elements as the number of positions. Several fields are given
+            either as a ``(nparticles, nfields)`` array or as a dict of
+            named fields, they are stored as one array per field. All
+            inserts into a tree must provide the same fields.
+
+        With index storage the tree keeps references to ``positions`` and
+        ``deposit_field`` rather than copies, so they must not be modified
+        afterwards, and only a single insert is allowed.
+
+        Returns
+        -------
+        The ids of the inserted particles. Particles are numbered
+        consecutively in the order they are inserted into the tree, the ids
+        identify particles in ``remove``, ``update_positions`` and
+        ``update_field``.
         """
         positions = np.asarray(positions)
         if len(positions.shape) == 1:
@@ -113,60 +583,640 @@ class ParticleQuadTreeNode(object):
 
         nparticles = positions.shape[0]
 
-        if deposit_field is not None and nparticles != deposit_field.shape[0]:
+        names, columns = _field_columns(deposit_field, nparticles)
+        positions, columns = self._convert(positions, columns)
+        self._check_positions(positions)
+        self._invalidate_cache()
+
+        order = np.arange(nparticles)
+
+        if self.storage == 'index':
+            if self._store is not None or self.num_particles > 0:
+                raise RuntimeError(
+                    "Particles can only be inserted once into a tree with "
+                    "index storage")
+            self._store = _ParticleStore(positions, columns, order, names)
+            self._store.next_id = nparticles
+            self._allocate_fields(self._store.nfields)
+            with _timed('quadtree.insert', num_particles=nparticles,
+                        storage=self.storage):
+                self._insert_range(positions, columns, None, order, 0,
+                                   nparticles, self._column_totals(columns))
+            return order.copy()
+
+        if self._store is None:
+            self._store = _ParticleStore()
+        store = self._store
+        if self.num_particles == 0:
+            store.field_names = names
+            self._allocate_fields(store.nfields)
+        elif columns is not None and names != store.field_names:
             raise RuntimeError(
-                "Received %s deposit_field entries but received %s particle "
-                "positions" % (deposit_field.shape[0], nparticles))
+                "Received deposit fields %s but the tree stores deposit "
+                "fields %s" % (names, store.field_names))
+        ids = np.arange(store.next_id, store.next_id + nparticles)
+        store.next_id += nparticles
+        if store.locations is not None:
+            store.locations = np.concatenate(
+                (store.locations, np.empty(nparticles, dtype=object)))
+            store.slots = np.concatenate(
+                (store.slots, np.empty(nparticles, dtype=np.intp)))
+
+        with _timed('quadtree.insert', num_particles=nparticles,
+                    storage=self.storage):
+            self._insert_range(positions, columns, ids, order, 0, nparticles,
+                               self._column_totals(columns))
+        return ids
 
+    def _convert(self, positions, columns):
+        """Convert particles to the dtype of the tree
+
+        The particles are classified into quadrants after the conversion,
+        so they end up in the leaf matching their stored position. Index
+        storage trees without a dtype adopt the dtype of the positions.
+        """
+        if self.dtype is None:
+            self.dtype = positions.dtype
+            return positions, columns
+        positions = np.asarray(positions, dtype=self.dtype)
+        if columns is not None:
+            columns = [np.asarray(column, dtype=self.dtype)
+                       for column in columns]
+        return positions, columns
+
+    def _check_positions(self, positions):
         if positions.shape[-1] != 2:
             raise RuntimeError(
-                "Received %sD positions %s but expected 2D positions"
-                % (positions.shape,))
+                "Received %sD positions but expected 2D positions"
+                % (positions.shape[-1],))
 
         # check if particle is inside this node
-        if not ((positions > self.left_edge).all() and
-                (positions < self.right_edge).all()):
+        for start in range(0, positions.shape[0], _CHUNK_SIZE):
+            chunk = positions[start:start + _CHUNK_SIZE]
+            if not ((chunk > self.left_edge).all() and
+                    (chunk < self.right_edge).all()):
+                raise RuntimeError(
+                    "positions outside node with left_edge=%s and "
+                    "right_edge=%s" % (self.left_edge, self.right_edge))
+
+    def build(self, positions, deposit_field=None, nworkers=1):
+        """Insert particles into an empty tree using a pool of processes
+
+        The particles are partitioned over the top levels of the tree in
+        this process, then the subtrees below are built concurrently by
+        ``nworkers`` processes and attached to the tree. The particle
+        arrays are shared with the workers through shared memory rather
+        than pickled, only the finished subtrees are sent back. The
+        resulting tree is identical to inserting all particles at once.
+
+        Parameters
+        ----------
+        positions : iterable of 2-element iterables
+            Positions of the particles to be inserted.
+        deposit_field : iterable or dict, optional
+            Field to be deposited and pixelized, see ``insert``.
+        nworkers : int, optional
+            The number of worker processes, with a single worker this is
+            the same as ``insert``. Defaults to 1.
+
+        Returns
+        -------
+        The ids of the inserted particles, see ``insert``.
+        """
+        if self._store is not None or self.num_particles > 0:
             raise RuntimeError(
-                "positions outside node with left_edge=%s and right_edge=%s"
-                % (self.left_edge, self.right_edge))
+                "build requires an empty tree, use insert to add particles "
+                "to a tree")
 
+        positions = np.asarray(positions)
+        nparticles = positions.shape[0]
+        if nworkers <= 1 or nparticles <= self.leaf_size:
+            return self.insert(positions, deposit_field)
+
+        names, columns = _field_columns(deposit_field, nparticles)
+        self._invalidate_cache()
+        if self.storage == 'copy':
+            # the shared copies are converted instead
+            self._check_positions(np.asarray(positions, dtype=self.dtype))
+        else:
+            positions, columns = self._convert(positions, columns)
+            self._check_positions(positions)
+
+        # split the tree deep enough to keep every worker busy
+        levels = 1
+        while 4**levels < 4*nworkers:
+            levels += 1
+
+        with _timed('quadtree.build', num_particles=nparticles,
+                    nworkers=nworkers, storage=self.storage):
+            with _SharedArrays() as shared:
+                self._build_shared(shared, positions, columns, names,
+                                   levels, nworkers)
+
+        return np.arange(nparticles)
+
+    def _build_shared(self, shared, positions, columns, names, levels,
+                      nworkers):
+        """Build the tree with positions, fields and indices copied into
+        ``shared``, see ``build``"""
+        nparticles = positions.shape[0]
+        dtype = self.dtype if self.storage == 'copy' else None
+        shared_positions = shared.add('positions', positions, dtype)
+        shared_columns = None
+        if columns is not None:
+            shared_columns = [shared.add('field%d' % f, column, dtype)
+                              for f, column in enumerate(columns)]
+        order = shared.add('order', np.arange(nparticles))
+        ids = None
+        if self.storage == 'copy':
+            ids = shared.add('ids', np.arange(nparticles))
+
+        if self.storage == 'index':
+            self._store = _ParticleStore(positions, columns, None, names)
+        else:
+            self._store = _ParticleStore(field_names=names)
+        self._store.next_id = nparticles
+        self._allocate_fields(self._store.nfields)
+
+        tasks = []
+        self._split_range(shared_positions, shared_columns, ids, order, 0,
+                          nparticles, self._column_totals(shared_columns),
+                          levels, tasks)
+
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(nworkers, initializer=_attach_shared,
+                                 initargs=(shared.specs,)) as pool:
+            futures = [
+                pool.submit(_build_subtree, node.center, node.half_width,
+                            self.leaf_size, self.storage, self.dtype, names,
+                            start, stop, totals)
+                for node, start, stop, totals in tasks]
+            for (node, _, _, _), future in zip(tasks, futures):
+                node._attach(self._from_arrays(
+                    future.result(), self.leaf_size, self.storage,
+                    self._store, self.dtype))
+
+        if self.storage == 'index':
+            # the workers partitioned their ranges of the shared index
+            self._store.index = np.array(order)
+
+    def _split_range(self, positions, deposit_field, ids, order, start,
+                     stop, totals, levels, tasks):
+        """Insert ``positions[order[start:stop]]`` down to ``levels``
+        below this node
+
+        The ranges of the nodes ``levels`` below this node that still need
+        to be refined are appended to ``tasks`` instead of being inserted.
+        """
+        nparticles = stop - start
+        if nparticles <= self.leaf_size:
+            self._insert_range(positions, deposit_field, ids, order, start,
+                               stop, totals)
+            return
+        if levels == 0:
+            tasks.append((self, start, stop, totals))
+            return
+
+        self.num_particles = nparticles
+        self._totals += totals
+        self._positions = None
+        self._deposit_field = None
+        self._ids = None
+        for direction, child_start, child_stop, child_totals in self._split(
+                positions, deposit_field, order, start, stop):
+            self._child(direction)._split_range(
+                positions, deposit_field, ids, order, child_start,
+                child_stop, child_totals, levels - 1, tasks)
+
+    def _attach(self, subtree):
+        """Take over the particles and children of a subtree built for this
+        node by another process"""
+        for name in self.__slots__:
+            if name != '_cache':
+                setattr(self, name, getattr(subtree, name))
+
+    def _allocate_fields(self, nfields):
+        self._totals = np.zeros(nfields)
+        if self.storage == 'copy':
+            self._deposit_field = np.empty((nfields, self.leaf_size),
+                                           dtype=self.dtype)
+
+    def _column_totals(self, columns):
+        if columns is None:
+            return np.zeros(self._store.nfields)
+        return np.array([column.sum(dtype='float64') for column in columns])
+
+    def insert_chunks(self, source, deposit_field=None,
+                      chunk_size=_CHUNK_SIZE, track_memory=False):
+        """Insert particles incrementally from an out-of-core source
+
+        Only one chunk of particles is held in memory at a time, on top of
+        the tree itself. The resulting tree is identical to inserting all
+        particles at once.
+
+        Parameters
+        ----------
+        source : array-like or iterable
+            Either an array-like of positions supporting slicing, e.g. a
+            ``np.memmap`` or an h5py dataset, which is read in chunks of
+            ``chunk_size`` particles, or an iterable yielding
+            ``(positions, deposit_field)`` tuples.
+        deposit_field : array-like, optional
+            The field to deposit, sliced alongside ``source`` when
+            ``source`` is array-like. Must be None if ``source`` yields
+            tuples.
+        chunk_size : int, optional
+            The number of particles read at a time from an array-like
+            source.
+        track_memory : bool, optional
+            If True, trace python and numpy allocations with tracemalloc
+            while inserting. If tracemalloc is already tracing, its peak is
+            left untouched.
+
+        Returns
+        -------
+        If ``track_memory`` is True, the peak traced memory in bytes while
+        inserting, above the memory traced beforehand, otherwise None. If
+        tracemalloc was already tracing this is an upper bound, as a
+        higher peak traced earlier is counted too.
+        """
+        if track_memory:
+            started = not tracemalloc.is_tracing()
+            if started:
+                tracemalloc.start()
+            traced = tracemalloc.get_traced_memory()[0]
+
+        try:
+            for positions, chunk_field in _iter_chunks(
+                    source, deposit_field, chunk_size):
+                self.insert(positions, chunk_field)
+                del positions, chunk_field
+            if track_memory:
+                return tracemalloc.get_traced_memory()[1] - traced
+        finally:
+            if track_memory and started:
+                tracemalloc.stop()
+
+    def _insert_range(self, positions, deposit_field, ids, order, start,
+                      stop, totals):
+        """Insert the particles ``positions[order[start:stop]]``
+
+        ``deposit_field`` is None or a list with the values of each field
+        and ``totals`` holds the sum of each field over the inserted
+        particles, which is added to the aggregated totals of the node.
+
+        ``order`` is partitioned in place as the particles are pushed down
+        the tree, so each child only receives a range of indices and the
+        particle data are copied exactly once, into the leaf that finally
+        stores them. With index storage nothing is copied and leaves record
+        their range of ``order``, otherwise ``ids[order[start:stop]]`` are
+        the ids of the inserted particles.
+        """
+        nparticles = stop - start
+        if nparticles == 0:
+            return
         cur_np = self.num_particles
         self.num_particles += nparticles
+        self._totals += totals
 
-        if self.num_particles <= _NODE_CAPACITY:
-            self.positions[cur_np: cur_np + nparticles] = positions
-            if deposit_field is not None:
-                self.deposit_field[cur_np: cur_np + nparticles] = deposit_field
+        if self.num_particles <= self.leaf_size:
+            if self.storage == 'index':
+                self._start = start
+                return
+            inds = order[start:stop]
+            self._positions[cur_np: cur_np + nparticles] = positions[inds]
+            if deposit_field is None:
+                self._deposit_field[:, cur_np: cur_np + nparticles] = 0
+            else:
+                for field, column in zip(self._deposit_field, deposit_field):
+                    field[cur_np: cur_np + nparticles] = column[inds]
+            self._ids[cur_np: cur_np + nparticles] = ids[inds]
+            if self._store.locations is not None:
+                self._store.locations[ids[inds]] = self
+                self._store.slots[ids[inds]] = np.arange(
+                    cur_np, cur_np + nparticles)
             return
 
-        if self.is_leaf:
-            positions = np.vstack((self.positions[:cur_np], positions))
-            if deposit_field is not None:
-                deposit_field = np.concatenate(
-                    (self.deposit_field[:cur_np], deposit_field))
-            self.positions = None
-            self.deposit_field = None
-
-        # adding another particle requires refining the tree
-        center = self.center
-        for direction in _Direction:
-            pos_gt_cen = (positions > center).astype(int)
-            inds = (pos_gt_cen == direction.value).all(axis=-1).nonzero()[0]
-            if deposit_field is not None:
-                dep_field = deposit_field[inds]
-            else:
-                dep_field = None
-            self._insert_child(direction, positions[inds], dep_field)
+        if self.is_leaf and cur_np > 0:
+            # push the particles already stored in this leaf down into the
+            # new children ahead of the incoming particles
+            old_positions = self._positions[:cur_np]
+            old_deposit_field = list(self._deposit_field[:, :cur_np])
+            old_ids = self._ids[:cur_np]
+            self._positions = None
+            self._deposit_field = None
+            self._ids = None
+            self._partition(old_positions, old_deposit_field, old_ids,
+                            np.arange(cur_np), 0, cur_np)
+
+        self._positions = None
+        self._deposit_field = None
+        self._ids = None
 
-    def _insert_child(self, direction, positions, deposit_field):
+        self._partition(positions, deposit_field, ids, order, start, stop)
+
+    def _partition(self, positions, deposit_field, ids, order, start, stop):
+        for direction, child_start, child_stop, child_totals in self._split(
+                positions, deposit_field, order, start, stop):
+            self._child(direction)._insert_range(
+                positions, deposit_field, ids, order, child_start,
+                child_stop, child_totals)
+
+    def _split(self, positions, deposit_field, order, start, stop):
+        """Group ``order[start:stop]`` by quadrant
+
+        Returns the direction, index range and field totals of each
+        quadrant.
+        """
+        # classify each particle by quadrant once, then reorder the index
+        # range with a single stable sort so each quadrant is contiguous
+        inds = order[start:stop]
+        quadrant = _quadrants(positions, inds, self.center)
+        totals = _quadrant_totals(deposit_field, inds, quadrant,
+                                  self._totals.shape[0])
+        order[start:stop] = inds[np.argsort(quadrant, kind='stable')]
+        bounds = start + np.cumsum(np.bincount(quadrant, minlength=4))
+        return zip(_Direction, np.concatenate(([start], bounds[:-1])),
+                   bounds, totals)
+
+    def _child(self, direction):
+        """The child in ``direction``, created if needed"""
         child_name = direction.name.lower()
         child_node = getattr(self, child_name)
         if child_node is None:
             offset = _offsets[direction]
             child_node = ParticleQuadTreeNode(
-                self.center + self.half_width/2 * offset, self.half_width/2)
+                self.center + self.half_width/2 * offset, self.half_width/2,
+                leaf_size=self.leaf_size, storage=self.storage,
+                dtype=self.dtype)
+            child_node._store = self._store
+            if self._store.nfields != 1:
+                child_node._allocate_fields(self._store.nfields)
             setattr(self, child_name, child_node)
-        child_node.insert(positions, deposit_field)
+        return child_node
+
+    def _check_dynamic(self):
+        if self.storage != 'copy':
+            raise RuntimeError(
+                "Dynamic updates require a tree with copy storage")
+
+    def _leaf_locations(self):
+        """The leaf holding each particle id, None for removed particles
+
+        The slot of each particle in the buffers of its leaf is tracked
+        alongside in ``self._store.slots``.
+        """
+        store = self._store
+        if store is None:
+            return np.empty(0, dtype=object)
+        if store.locations is None:
+            locations = np.empty(store.next_id, dtype=object)
+            slots = np.empty(store.next_id, dtype=np.intp)
+            for leaf in self.leaves:
+                ids = leaf._ids[:leaf.num_particles]
+                locations[ids] = leaf
+                slots[ids] = np.arange(ids.shape[0])
+            store.locations = locations
+            store.slots = slots
+        return store.locations
+
+    def _check_ids(self, locations, ids):
+        """Check ids are unique and known before a tree is modified"""
+        unique, counts = np.unique(ids, return_counts=True)
+        if (counts > 1).any():
+            raise RuntimeError("Received duplicate particle ids %s"
+                               % (unique[counts > 1],))
+        known = (unique >= 0) & (unique < locations.shape[0])
+        known[known] = [locations[pid] is not None
+                        for pid in unique[known]]
+        if not known.all():
+            raise RuntimeError("Unknown particle ids %s"
+                               % (unique[~known],))
+
+    def _leaf_groups(self, locations, ids):
+        """Group known particle ids by the leaf holding them
+
+        Returns
+        -------
+        leaves : list
+            The distinct leaves holding the particles.
+        groups : list of ndarray
+            The positions in ``ids`` of the particles of each leaf.
+        slots : ndarray
+            The slot of each particle in the buffers of its leaf.
+        """
+        index = {}
+        leaf_index = np.fromiter(
+            (index.setdefault(leaf, len(index)) for leaf in locations[ids]),
+            dtype=np.intp, count=ids.shape[0])
+        return (list(index), _group_by(leaf_index, len(index)),
+                self._store.slots[ids])
+
+    def _add_to_paths(self, centers, changes, counts, locations=None):
+        """Add per-leaf changes to every node above the leaves
+
+        Each node on the path down to the leaf centered on ``centers[i]``
+        gains ``changes[i]`` in its field totals and ``counts[i]`` in its
+        particle count. Each touched node is visited once. If
+        ``locations`` is given, touched internal nodes left with at most
+        ``leaf_size`` particles are merged back into a leaf.
+        """
+        if centers.shape[0] == 1:
+            self._totals += changes[0]
+            self.num_particles += int(counts[0])
+        else:
+            self._totals += changes.sum(axis=0)
+            self.num_particles += int(counts.sum())
+        if self.is_leaf:
+            return
+        above = centers > self.center
+        quadrant = above[:, 0] + 2*above[:, 1]
+        for q, group in enumerate(_group_by(quadrant, 4)):
+            if group.shape[0]:
+                getattr(self, _child_names[q])._add_to_paths(
+                    centers[group], changes[group], counts[group], locations)
+        # keep the invariant that a node is refined if and only if it holds
+        # more than leaf_size particles, so the tree has the same shape as
+        # one freshly built from the same particles
+        if locations is not None and self.num_particles <= self.leaf_size:
+            self._collapse(locations)
+
+    def _remove_ids(self, locations, ids):
+        """Remove known particles, one pass over the leaves holding them
+
+        Returns
+        -------
+        The ``(nfields, len(ids))`` deposit field values of the removed
+        particles.
+        """
+        store = self._store
+        leaves, groups, slots = self._leaf_groups(locations, ids)
+        values = np.empty((store.nfields, ids.shape[0]), dtype=self.dtype)
+        counts = np.empty(len(leaves), dtype=np.intp)
+        for i, (leaf, group) in enumerate(zip(leaves, groups)):
+            n = leaf.num_particles
+            removed = slots[group]
+            values[:, group] = leaf._deposit_field[:, removed]
+            keep = np.ones(n, dtype=bool)
+            keep[removed] = False
+            m = n - removed.shape[0]
+            leaf._positions[:m] = leaf._positions[:n][keep]
+            leaf._deposit_field[:, :m] = leaf._deposit_field[:, :n][:, keep]
+            leaf._ids[:m] = leaf._ids[:n][keep]
+            leaf._positions[m:n] = np.nan
+            store.slots[leaf._ids[:m]] = np.arange(m)
+            counts[i] = -removed.shape[0]
+        locations[ids] = None
+
+        self._add_to_paths(_leaf_centers(leaves),
+                           -_group_sums(values, groups), counts, locations)
+        return values
+
+    def _collapse(self, locations):
+        """Turn an underfull internal node back into a leaf"""
+        positions = np.full((self.leaf_size, 2), np.nan, dtype=self.dtype)
+        deposit_field = np.empty((self._store.nfields, self.leaf_size),
+                                 dtype=self.dtype)
+        ids = np.empty(self.leaf_size, dtype='int64')
+
+        n = 0
+        for leaf in self.leaves:
+            k = leaf.num_particles
+            positions[n:n + k] = leaf._positions[:k]
+            deposit_field[:, n:n + k] = leaf._deposit_field[:, :k]
+            ids[n:n + k] = leaf._ids[:k]
+            n += k
+
+        self._positions = positions
+        self._deposit_field = deposit_field
+        self._ids = ids
+        for name in _child_names:
+            setattr(self, name, None)
+        locations[ids[:n]] = self
+        self._store.slots[ids[:n]] = np.arange(n)
+
+    def remove(self, ids):
+        """Remove particles from the quadtree
+
+        Must be called on the root node. Nodes left with at most
+        ``leaf_size`` particles are merged back into a single leaf.
+
+        Parameters
+        ----------
+        ids : int or iterable of ints
+            The ids of the particles to remove, as returned by ``insert``.
+        """
+        self._check_dynamic()
+        ids = np.atleast_1d(np.asarray(ids, dtype='int64'))
+        locations = self._leaf_locations()
+        self._check_ids(locations, ids)
+        self._invalidate_cache()
+        self._remove_ids(locations, ids)
+
+    def update_positions(self, ids, new_positions):
+        """Move particles to new positions
+
+        Must be called on the root node. Particles that stay inside their
+        leaf are found with one vectorized test against the edges of their
+        leaves and updated in place, one leaf at a time. Only particles
+        that cross a leaf boundary are removed and reinserted, merging and
+        refining nodes as needed. The cost is therefore dominated by the
+        number of leaves holding updated particles and by the number of
+        migrating particles, rather than by the size of the tree.
+
+        Parameters
+        ----------
+        ids : int or iterable of ints
+            The ids of the particles to move, as returned by ``insert``.
+        new_positions : 2 element iterable or iterable of 2-element iterables
+            The new positions of the particles.
+        """
+        self._check_dynamic()
+        ids = np.atleast_1d(np.asarray(ids, dtype='int64'))
+        new_positions = np.asarray(new_positions, dtype=self.dtype)
+        if len(new_positions.shape) == 1:
+            new_positions = np.asarray([new_positions])
+
+        if new_positions.shape != (ids.shape[0], 2):
+            raise RuntimeError(
+                "Received new positions with shape %s but expected (%s, 2)"
+                % (new_positions.shape, ids.shape[0]))
+
+        if not ((new_positions > self.left_edge).all() and
+                (new_positions < self.right_edge).all()):
+            raise RuntimeError(
+                "positions outside node with left_edge=%s and right_edge=%s"
+                % (self.left_edge, self.right_edge))
+
+        locations = self._leaf_locations()
+        self._check_ids(locations, ids)
+        self._invalidate_cache()
+        leaves, groups, slots = self._leaf_groups(locations, ids)
+        order = np.concatenate(groups + [np.empty(0, dtype=np.intp)])
+        sizes = [group.shape[0] for group in groups]
+        center = np.empty((ids.shape[0], 2))
+        center[order] = np.repeat(_leaf_centers(leaves), sizes, axis=0)
+        half_width = np.empty(ids.shape[0])
+        half_width[order] = np.repeat(
+            [leaf.half_width for leaf in leaves], sizes)
+
+        # particles within rounding error of their leaf edges are treated
+        # as migrating, which is always correct
+        margin = 1e-12*(np.abs(self.center).max() + self.half_width)
+        stays = (np.abs(new_positions - center) <
+                 (half_width - margin)[:, None]).all(axis=-1)
+        for leaf, group in zip(leaves, groups):
+            group = group[stays[group]]
+            leaf._positions[slots[group]] = new_positions[group]
+
+        migrating = np.nonzero(~stays)[0]
+        if migrating.shape[0] == 0:
+            return
+
+        values = self._remove_ids(locations, ids[migrating])
+        self._insert_range(new_positions[migrating], list(values),
+                           ids[migrating], np.arange(migrating.shape[0]), 0,
+                           migrating.shape[0],
+                           values.sum(axis=1, dtype='float64'))
+
+    def update_field(self, ids, values):
+        """Update the deposit field of particles
+
+        Parameters
+        ----------
+        ids : int or iterable of ints
+            The ids of the particles to update, as returned by ``insert``.
+        values : float, iterable of floats or dict
+            The new deposit field values, given in the same form as the
+            deposit field passed to ``insert``.
+        """
+        self._check_dynamic()
+        ids = np.atleast_1d(np.asarray(ids, dtype='int64'))
+        if not isinstance(values, dict):
+            values = np.asarray(values, dtype='float64')
+            if len(values.shape) == 0 or (len(values.shape) == 1 and
+                                          self._field_names is not None):
+                values = values[None]
+        names, columns = _field_columns(values, ids.shape[0])
+        if names != self._field_names:
+            raise RuntimeError(
+                "Received deposit fields %s but the tree stores deposit "
+                "fields %s" % (names, self._field_names))
+
+        locations = self._leaf_locations()
+        self._check_ids(locations, ids)
+        self._invalidate_cache()
+        values = np.array(columns, dtype=self.dtype)
+        leaves, groups, slots = self._leaf_groups(locations, ids)
+        old_values = np.empty_like(values)
+        for leaf, group in zip(leaves, groups):
+            slot = slots[group]
+            old_values[:, group] = leaf._deposit_field[:, slot]
+            leaf._deposit_field[:, slot] = values[:, group]
+        changes = (_group_sums(values, groups) -
+                   _group_sums(old_values, groups))
+        self._add_to_paths(_leaf_centers(leaves), changes,
+                           np.zeros(len(leaves), dtype=np.intp))
 
     @property
     def children(self):
@@ -177,11 +1227,15 @@ class ParticleQuadTreeNode(object):
 
     @property
     def leaves(self):
-        if self.is_leaf:
-            yield self
-        for child in self.children:
-            for leaf in child.leaves:
-                yield leaf
+        # depth-first traversal with an explicit stack, avoiding a chain of
+        # nested generators for deep trees
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.is_leaf:
+                yield node
+            else:
+                stack.extend(reversed(list(node.children)))
 
     @property
     def area(self):
@@ -201,31 +1255,539 @@ class ParticleQuadTreeNode(object):
 
     @property
     def is_leaf(self):
-        return self.positions is not None
+        # refining a node always creates all four children
+        return self.southwest is None
 
-    def _plot_subtree(self, fig, axes):
-        patch = Rectangle(self.left_edge, self.half_width*2, self.half_width*2,
-                          fill=False)
-        axes.add_patch(patch)
+    @property
+    def deposit_total(self):
+        """The sum of the deposit field over all particles in this node,
+        one value per field for trees with several deposit fields"""
+        if self._field_names is None:
+            return self._totals[0]
+        return self._totals
 
-        if self.is_leaf:
-            positions = self.positions[:self.num_particles]
-            axes.scatter(positions[:, 0], positions[:, 1], s=.2, color='k',
-                         marker='o')
-
-        for child in self.children:
-            child._plot_subtree(fig, axes)
-
-    def plot(self, filename=None, fig=None, axes=None):
-        """Plot this quadtree node and its subtree"""
-        fig = plt.figure(figsize=(4, 4))
-        axes = fig.add_axes([.01, .01, .98, .98])
-        axes.set_aspect('equal')
-        plt.axis('off')
-        plt.xlim((0, 1))
-        plt.ylim((0, 1))
-        self._plot_subtree(fig, axes)
-        if filename is None:
-            plt.show()
+    def stats(self):
+        """Summarize the structure and memory use of this subtree
+
+        Returns
+        -------
+        dict
+            ``num_particles``, ``num_nodes`` and ``num_leaves``;
+            ``depth_histogram``, the number of leaves at each depth below
+            this node; ``occupancy_histogram``, the number of leaves
+            holding 0, 1, 2, ... particles; and the bytes used by the
+            ``position_bytes``, ``deposit_bytes``, ``index_bytes`` (particle
+            ids or the permutation index) and ``geometry_bytes`` (node
+            centers, edges and deposit totals) buffers. With index storage
+            the particle arrays shared by the whole tree are counted.
+        """
+        depths = []
+        occupancy = []
+        nbytes = dict.fromkeys(
+            ('position_bytes', 'deposit_bytes', 'index_bytes',
+             'geometry_bytes'), 0)
+        stack = [(self, 0)]
+        num_nodes = 0
+        while stack:
+            node, depth = stack.pop()
+            num_nodes += 1
+            for array in (node.center, node._totals, node._left_edge,
+                          node._right_edge):
+                if array is not None:
+                    nbytes['geometry_bytes'] += np.asarray(array).nbytes
+            if not node.is_leaf:
+                stack.extend((child, depth + 1) for child in node.children)
+                continue
+            depths.append(depth)
+            occupancy.append(node.num_particles)
+            if node.storage == 'copy':
+                nbytes['position_bytes'] += node._positions.nbytes
+                nbytes['deposit_bytes'] += node._deposit_field.nbytes
+                nbytes['index_bytes'] += node._ids.nbytes
+
+        store = self._store
+        if self.storage == 'index' and store is not None:
+            nbytes['position_bytes'] = store.positions.nbytes
+            nbytes['deposit_bytes'] = sum(
+                column.nbytes for column in store.deposit_field or ())
+            if store.index is not None:
+                nbytes['index_bytes'] = store.index.nbytes
+
+        return dict(nbytes,
+                    num_particles=self.num_particles,
+                    num_nodes=num_nodes,
+                    num_leaves=len(depths),
+                    depth_histogram=np.bincount(depths),
+                    occupancy_histogram=np.bincount(occupancy))
+
+    def _gather(self, array):
+        if not self.is_leaf or array is None:
+            return None
+        index = self._store.index
+        if index is None:
+            return np.asarray(array[self._start:self._start +
+                                    self.num_particles])
+        return np.asarray(
+            array[index[self._start:self._start + self.num_particles]])
+
+    @property
+    def positions(self):
+        """The positions of the particles in this leaf, None for internal
+        nodes. With copy storage this is the leaf's buffer, of which the
+        first ``num_particles`` rows are used."""
+        if self.storage == 'copy':
+            return self._positions
+        if self._store is None:
+            return np.empty((0, 2))
+        return self._gather(self._store.positions)
+
+    @property
+    def deposit_field(self):
+        """The deposit field of the particles in this leaf, None for
+        internal nodes. With copy storage this is the leaf's buffer, of
+        which the first ``num_particles`` entries are used. For trees with
+        several deposit fields this has one row per field."""
+        if not self.is_leaf:
+            return None
+        if self.storage == 'copy':
+            fields = self._deposit_field
         else:
-            plt.savefig(filename, dpi=400)
+            fields = self._field_values()
+        if self._field_names is None:
+            return fields[0]
+        return fields
+
+    def _field_values(self):
+        """The ``(nfields, num_particles)`` deposit fields of this leaf"""
+        n = self.num_particles
+        if self.storage == 'copy':
+            return self._deposit_field[:, :n]
+        store = self._store
+        if store is None or store.deposit_field is None:
+            return np.zeros((_num_fields(self._field_names), n))
+        fields = np.empty((len(store.deposit_field), n),
+                          dtype=np.result_type(*store.deposit_field))
+        for field, column in zip(fields, store.deposit_field):
+            field[:] = self._gather(column)
+        return fields
+
+    def _leaf_ids(self):
+        """The ids of the particles stored in this leaf"""
+        n = self.num_particles
+        if self.storage == 'copy':
+            return self._ids[:n]
+        index = self._store.index
+        if index is None:
+            return np.arange(self._start, self._start + n)
+        return index[self._start:self._start + n]
+
+    def _query_pairs(self, nqueries, overlaps, contains):
+        """Find all (query, particle) pairs matching a batch of queries
+
+        The tree is traversed once for the whole batch. Every node carries
+        the queries that may match particles inside it, ``overlaps(left_edge,
+        right_edge, queries)`` selects the queries that may overlap a node's
+        (closed) bounds, so each subtree is pruned for all queries at once.
+        At leaves ``contains(positions, queries)`` returns the
+        ``(len(queries), num_particles)`` matrix of matching pairs.
+
+        Returns
+        -------
+        queries, ids, positions : ndarray
+            The query index, particle id and particle position of each
+            matching pair.
+        """
+        query_parts = [np.empty(0, dtype=np.intp)]
+        id_parts = [np.empty(0, dtype=np.intp)]
+        position_parts = [np.empty((0, 2))]
+
+        stack = [(self, np.arange(nqueries))]
+        while stack:
+            node, queries = stack.pop()
+            if node.num_particles == 0:
+                continue
+            queries = queries[overlaps(node.left_edge, node.right_edge,
+                                       queries)]
+            if queries.size == 0:
+                continue
+            if not node.is_leaf:
+                stack.extend((child, queries)
+                             for child in reversed(list(node.children)))
+                continue
+            positions = node.positions[:node.num_particles]
+            q, j = np.nonzero(contains(positions, queries))
+            query_parts.append(queries[q])
+            id_parts.append(node._leaf_ids()[j])
+            position_parts.append(positions[j])
+
+        return (np.concatenate(query_parts),
+                np.concatenate(id_parts).astype(np.intp),
+                np.concatenate(position_parts))
+
+    def query_box(self, left_edge, right_edge):
+        """Find the particles inside each of a batch of boxes
+
+        Parameters
+        ----------
+        left_edge, right_edge : iterable of 2-element iterables
+            The lower-left and upper-right corners of the boxes. Particles
+            on the box boundaries are included.
+
+        Returns
+        -------
+        offsets, indices : ndarray
+            The ids of the particles in box ``i`` are
+            ``indices[offsets[i]:offsets[i + 1]]``, in increasing order.
+        """
+        left_edge = _as_points(left_edge)
+        right_edge = _as_points(right_edge)
+        if left_edge.shape != right_edge.shape:
+            raise RuntimeError(
+                "Received %s left edges but %s right edges"
+                % (left_edge.shape[0], right_edge.shape[0]))
+
+        def overlaps(node_left_edge, node_right_edge, queries):
+            return ((left_edge[queries] <= node_right_edge).all(axis=-1) &
+                    (right_edge[queries] >= node_left_edge).all(axis=-1))
+
+        def contains(positions, queries):
+            return ((positions >= left_edge[queries, None]).all(axis=-1) &
+                    (positions <= right_edge[queries, None]).all(axis=-1))
+
+        queries, ids, _ = self._query_pairs(left_edge.shape[0], overlaps,
+                                            contains)
+        return _csr(left_edge.shape[0], queries, ids)
+
+    def _radius_pairs(self, points, radius):
+        radius2 = radius**2
+
+        def overlaps(node_left_edge, node_right_edge, queries):
+            p = points[queries]
+            d = np.maximum(np.maximum(node_left_edge - p, p - node_right_edge),
+                           0)
+            return (d**2).sum(axis=-1) <= radius2[queries]
+
+        def contains(positions, queries):
+            d = positions - points[queries, None]
+            return (d**2).sum(axis=-1) <= radius2[queries, None]
+
+        return self._query_pairs(points.shape[0], overlaps, contains)
+
+    def query_radius(self, points, radius):
+        """Find the particles within a distance of each of a batch of points
+
+        Parameters
+        ----------
+        points : 2 element iterable or iterable of 2-element iterables
+            The query points.
+        radius : float or iterable of floats
+            The search radius, either shared by all points or one per
+            point. Particles at exactly ``radius`` are included.
+
+        Returns
+        -------
+        offsets, indices : ndarray
+            The ids of the particles near point ``i`` are
+            ``indices[offsets[i]:offsets[i + 1]]``, in increasing order.
+        """
+        points = _as_points(points)
+        radius = np.broadcast_to(np.asarray(radius, dtype='float64'),
+                                 points.shape[:1])
+        queries, ids, _ = self._radius_pairs(points, radius)
+        return _csr(points.shape[0], queries, ids)
+
+    def query_knn(self, points, k=1):
+        """Find the k nearest particles of each of a batch of points
+
+        Each point starts from a search radius estimated from the mean
+        particle density, the radius of the points with fewer than ``k``
+        particles in range is doubled until all points are resolved, so
+        every round is a single batched radius query.
+
+        Parameters
+        ----------
+        points : 2 element iterable or iterable of 2-element iterables
+            The query points.
+        k : int, optional
+            The number of neighbours to find. Defaults to 1.
+
+        Returns
+        -------
+        distances, indices : ndarray
+            The ``(npoints, k)`` distances to and ids of the neighbours of
+            each point, sorted by distance. If the tree holds fewer than
+            ``k`` particles the missing neighbours have an infinite
+            distance and an id of -1.
+        """
+        points = _as_points(points)
+        npoints = points.shape[0]
+        distances = np.full((npoints, k), np.inf)
+        indices = np.full((npoints, k), -1, dtype=np.intp)
+        if self.num_particles == 0 or npoints == 0:
+            return distances, indices
+
+        # a radius beyond which every particle is in range of every point
+        corners = np.array([self.left_edge, self.right_edge])
+        max_radius = np.sqrt((np.maximum(np.abs(points - corners[0]),
+                                         np.abs(points - corners[1]))**2)
+                             .sum(axis=-1))
+        ntarget = min(k, self.num_particles)
+        radius = np.full(npoints, np.sqrt(
+            ntarget*self.area/(np.pi*self.num_particles)))
+
+        pending = np.arange(npoints)
+        while pending.size > 0:
+            radius[pending] = np.minimum(radius[pending], max_radius[pending])
+            queries, ids, positions = self._radius_pairs(points[pending],
+                                                         radius[pending])
+            counts = np.bincount(queries, minlength=pending.shape[0])
+            done = counts >= ntarget
+
+            keep = done[queries]
+            queries, ids = queries[keep], ids[keep]
+            dist = np.sqrt(((positions[keep] -
+                             points[pending[queries]])**2).sum(axis=-1))
+            order = np.lexsort((ids, dist, queries))
+            queries, ids, dist = queries[order], ids[order], dist[order]
+            first = np.cumsum(counts*done) - counts*done
+            rank = np.arange(queries.shape[0]) - first[queries]
+            nearest = rank < k
+            rows = pending[queries[nearest]]
+            distances[rows, rank[nearest]] = dist[nearest]
+            indices[rows, rank[nearest]] = ids[nearest]
+
+            pending = pending[~done]
+            radius[pending] *= 2
+
+        return distances, indices
+
+    def save(self, path):
+        """Save the tree to a directory of flat arrays
+
+        The nodes are stored in depth-first order as arrays of centers,
+        half-widths, particle counts, deposit totals and child indices,
+        followed by the particle positions and deposit fields sorted by
+        leaf so every leaf owns a contiguous range of particles.
+
+        Parameters
+        ----------
+        path : string
+            The directory to save the tree to, created if needed.
+        """
+        nodes = self._subtree_nodes()
+        arrays = self._node_arrays(nodes)
+
+        # particle data keep the dtype they are stored in
+        dtype = deposit_dtype = self.dtype or np.dtype('float64')
+        store = self._store
+        if self.storage == 'index' and store is not None and \
+                store.deposit_field:
+            deposit_dtype = np.result_type(*store.deposit_field)
+
+        positions = _open_array(path, 'positions', (self.num_particles, 2),
+                                dtype)
+        names = self._field_names
+        deposit_field = _open_array(path, 'deposit_field',
+                                    (_num_fields(names), self.num_particles),
+                                    deposit_dtype)
+        arrays['start'] = self._pack_leaves(nodes, positions, deposit_field)
+        del positions, deposit_field
+
+        _save_arrays(
+            path, 'ParticleQuadTreeNode',
+            dict(arrays, positions=True, deposit_field=True),
+            leaf_size=int(self.leaf_size),
+            field_names=None if names is None else list(names))
+
+    def _subtree_nodes(self):
+        """All nodes of this subtree in depth-first order"""
+        nodes = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(reversed(list(node.children)))
+        return nodes
+
+    def _node_arrays(self, nodes):
+        """The centers, half-widths, particle counts, deposit totals and
+        child indices of ``nodes``, see ``_from_arrays``"""
+        node_index = {id(node): i for i, node in enumerate(nodes)}
+        children = np.full((len(nodes), 4), -1, dtype='int64')
+        for i, node in enumerate(nodes):
+            if not node.is_leaf:
+                children[i] = [node_index[id(getattr(node, name))]
+                               for name in _child_names]
+        return {
+            'center': np.array([node.center for node in nodes],
+                               dtype='float64'),
+            'half_width': np.array([node.half_width for node in nodes],
+                                   dtype='float64'),
+            'num_particles': np.array([node.num_particles for node in nodes],
+                                      dtype='int64'),
+            'totals': np.array([node._totals for node in nodes]),
+            'children': children}
+
+    def _pack_leaves(self, nodes, positions, deposit_field, ids=None):
+        """Copy the particles of the leaves among ``nodes`` into contiguous
+        ranges of flat arrays, returning the start of each node's range"""
+        start = np.zeros(len(nodes), dtype='int64')
+        offset = 0
+        for i, node in enumerate(nodes):
+            if not node.is_leaf:
+                continue
+            n = node.num_particles
+            start[i] = offset
+            positions[offset:offset + n] = node.positions[:n]
+            deposit_field[:, offset:offset + n] = node._field_values()
+            if ids is not None:
+                ids[offset:offset + n] = node._ids[:n]
+            offset += n
+        return start
+
+    @classmethod
+    def _from_arrays(cls, arrays, leaf_size, storage, store, dtype):
+        """Create the nodes described by the arrays of ``_node_arrays``
+
+        With index storage ``arrays['start']`` is the start of each leaf's
+        range of the store's index. With copy storage it is the start of
+        each leaf's range of the ``positions``, ``deposit_field`` and
+        ``ids`` arrays, which are copied into the leaf buffers.
+
+        Returns
+        -------
+        The first node, the root of the subtree.
+        """
+        center = np.asarray(arrays['center'])
+        half_width = np.asarray(arrays['half_width'])
+        num_particles = np.asarray(arrays['num_particles'])
+        start = np.asarray(arrays['start'])
+        children = np.asarray(arrays['children'])
+        totals = arrays['totals']
+
+        is_leaf = children[:, 0] < 0
+        if storage == 'copy':
+            # the leaf buffers are rows of blocks filled in one pass
+            leaves = np.nonzero(is_leaf)[0]
+            counts = num_particles[leaves]
+            row = np.repeat(np.arange(leaves.shape[0]), counts)
+            column = np.arange(row.shape[0]) - np.repeat(
+                np.cumsum(counts) - counts, counts)
+            source = np.repeat(start[leaves], counts) + column
+            positions = np.full((leaves.shape[0], leaf_size, 2), np.nan,
+                                dtype=dtype)
+            positions[row, column] = arrays['positions'][source]
+            deposit_field = np.empty(
+                (leaves.shape[0], store.nfields, leaf_size), dtype=dtype)
+            deposit_field[row, :, column] = arrays['deposit_field'][
+                :, source].T
+            ids = np.empty((leaves.shape[0], leaf_size), dtype='int64')
+            ids[row, column] = arrays['ids'][source]
+            leaf_row = np.cumsum(is_leaf) - 1
+
+        # python scalars are much cheaper to index than numpy arrays
+        counts = num_particles.tolist()
+        widths = half_width.tolist()
+        starts = start.tolist()
+        leaf_flags = is_leaf.tolist()
+        nodes = []
+        for i in range(center.shape[0]):
+            node = cls.__new__(cls)
+            node._positions = None
+            node._deposit_field = None
+            node._ids = None
+            node.num_particles = counts[i]
+            node._totals = totals[i]
+            node.center = np.array(center[i])
+            node.half_width = widths[i]
+            node.leaf_size = leaf_size
+            node.storage = storage
+            node.dtype = dtype
+            node._store = store
+            node._start = 0
+            node._left_edge = None
+            node._right_edge = None
+            node._cache = None
+            node.southwest = node.southeast = None
+            node.northwest = node.northeast = None
+            if storage == 'index':
+                node._start = starts[i]
+            elif leaf_flags[i]:
+                row = leaf_row[i]
+                node._positions = positions[row]
+                node._deposit_field = deposit_field[row]
+                node._ids = ids[row]
+            nodes.append(node)
+
+        for i in np.nonzero(children[:, 0] >= 0)[0]:
+            for name, child in zip(_child_names, children[i]):
+                setattr(nodes[i], name, nodes[child])
+
+        return nodes[0]
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a tree saved with ``save``
+
+        The loaded tree uses index storage with the saved particle arrays,
+        so with ``mmap=True`` no particle data is read until leaves are
+        accessed and processes loading the same tree share its pages.
+
+        Parameters
+        ----------
+        path : string
+            The directory the tree was saved to.
+        mmap : bool, optional
+            If True (the default) the particle arrays are memory-mapped
+            read-only, otherwise they are read into memory.
+        """
+        metadata, arrays = _load_arrays(path, 'ParticleQuadTreeNode', mmap)
+
+        names = metadata['field_names']
+        store = _ParticleStore(arrays['positions'],
+                               list(arrays['deposit_field']),
+                               field_names=None if names is None
+                               else tuple(names))
+        store.next_id = arrays['positions'].shape[0]
+
+        return cls._from_arrays(arrays, metadata['leaf_size'], 'index',
+                                store, arrays['positions'].dtype)
+
+    def _plot_arrays(self):
+        """The outlines of the leaves as line segments and the positions
+        of all particles in this subtree"""
+        leaves = list(self._visible_nodes())
+        left_edge = np.array([leaf.left_edge for leaf in leaves])
+        right_edge = np.array([leaf.right_edge for leaf in leaves])
+        positions = [leaf.positions[:leaf.num_particles] for leaf in leaves]
+        return (_box_segments(left_edge, right_edge),
+                np.concatenate(positions).reshape(-1, 2))
+
+    def plot(self, filename=None, fig=None, axes=None, rgba=False,
+             shape=(1024, 1024)):
+        """Plot this quadtree node and its subtree
+
+        The outlines of all leaves are drawn as a single line collection
+        and all particles with a single scatter call.
+
+        Parameters
+        ----------
+        filename : string, optional
+            The file to save the plot to, the plot is shown if None.
+        fig, axes : matplotlib figure and axes, optional
+            Axes to draw into instead of a new figure.
+        rgba : bool, optional
+            If True no matplotlib artists are created, instead the plot is
+            rasterized into a ``(ny, nx, 4)`` uint8 RGBA array which is
+            returned and, if ``filename`` is given, saved with ``imsave``.
+            This takes seconds even for very large trees.
+        shape : 2-element tuple, optional
+            The number of pixels along the x and y axes of the RGBA array.
+        """
+        segments, positions = self._plot_arrays()
+        bounds = (self.left_edge, self.right_edge)
+        if rgba:
+            return _save_rgba(
+                _rasterize_rgba(bounds, shape, segments, positions),
+                filename)
+        _plot_segments(segments, positions, bounds, filename, axes)
@@ -0,0 +1,84 @@
+"""Flat on-disk storage for built trees and meshes
+
+A saved structure is a directory holding one ``.npy`` file per array and a
+``meta.json`` file describing the structure. Arrays are loaded with
+``np.load(mmap_mode='r')`` so loading is nearly free and processes loading
+the same structure share its pages through the page cache.
+"""
+import json
+import os
+
+import numpy as np
+
+_FORMAT_VERSION = 1
+_METADATA_FILE = 'meta.json'
+
+
+def _array_path(path, name):
+    return os.path.join(path, name + '.npy')
+
+
+def _open_array(path, name, shape, dtype='float64'):
+    """Create a writable array in a save directory, filled incrementally
+
+    This avoids assembling large arrays in memory before writing them.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return np.lib.format.open_memmap(_array_path(path, name), mode='w+',
+                                     dtype=dtype, shape=shape)
+
+
+def _save_arrays(path, kind, arrays, **attributes):
+    """Save arrays and metadata describing a structure of type ``kind``
+
+    Entries of ``arrays`` that are None are not written, arrays already
+    written with ``_open_array`` are passed by name with the value True.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    names = []
+    for name, array in sorted(arrays.items()):
+        if array is None:
+            continue
+        if array is not True:
+            np.save(_array_path(path, name), np.asarray(array))
+        names.append(name)
+
+    metadata = dict(attributes, format=kind, version=_FORMAT_VERSION,
+                    arrays=names)
+    with open(os.path.join(path, _METADATA_FILE), 'w') as f:
+        json.dump(metadata, f, indent=2, sort_keys=True)
+
+
+def _load_arrays(path, kind, mmap=True):
+    """Load the metadata and arrays of a structure saved by _save_arrays
+
+    Returns
+    -------
+    metadata : dict
+        The attributes passed to _save_arrays.
+    arrays : dict
+        The saved arrays by name, memory-mapped read-only if ``mmap`` is
+        True.
+    """
+    metadata_path = os.path.join(path, _METADATA_FILE)
+    if not os.path.exists(metadata_path):
+        raise RuntimeError("No saved structure found at '%s'" % (path,))
+    with open(metadata_path) as f:
+        metadata = json.load(f)
+
+    if metadata.get('format') != kind:
+        raise RuntimeError(
+            "'%s' contains a saved %s, expected a saved %s"
+            % (path, metadata.get('format'), kind))
+    if metadata.get('version') != _FORMAT_VERSION:
+        raise RuntimeError(
+            "'%s' was saved with format version %s, expected version %s"
+            % (path, metadata.get('version'), _FORMAT_VERSION))
+
+    mmap_mode = 'r' if mmap else None
+    arrays = {}
+    for name in metadata.pop('arrays'):
+        arrays[name] = np.load(_array_path(path, name), mmap_mode=mmap_mode)
+    return metadata, arrays
@@ -0,0 +1,41 @@
+import numpy as np
+
+from qtree.cache import _ArrayCache, _LRUCache
+
+
+def test_lru_cache():
+    cache = _LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    # 'b' is now the least recently used value
+    cache.put('c', 3)
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+
+    cache.put('a', 4)
+    assert len(cache) == 2 and cache.get('a') == 4
+
+    cache.clear()
+    assert len(cache) == 0 and cache.size == 0
+
+
+def test_array_cache():
+    cache = _ArrayCache(max_bytes=3*800)
+    arrays = [np.zeros(100) for _ in range(4)]
+    for i, array in enumerate(arrays[:3]):
+        cache.put(i, array)
+    assert cache.size == 3*800
+    assert not arrays[0].flags.writeable
+
+    assert cache.get(0) is arrays[0]
+    cache.put(3, arrays[3])
+    assert cache.get(1) is None
+    assert sorted(cache._values) == [0, 2, 3]
+    assert cache.size == 3*800
+
+    # arrays larger than the budget are not cached
+    cache.put(4, np.zeros(400))
+    assert cache.get(4) is None
+    assert len(cache) == 3
@@ -0,0 +1,62 @@
+import subprocess
+import sys
+
+_HEAVY_MODULES = ['matplotlib', 'scipy', 'scipy.spatial', 'cykdtree']
+
+# generous upper bound on the cold import time of qtree relative to numpy,
+# this is exceeded if numpy, matplotlib or scipy are imported eagerly again
+_MAX_IMPORT_RATIO = 0.5
+
+
+def _run(code, *options):
+    return subprocess.run(
+        [sys.executable] + list(options) + ['-c', code],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+
+
+def _imported_modules(*statements):
+    """The modules imported by a fresh interpreter running statements"""
+    code = "\n".join(("import sys",) + statements +
+                     ("print(' '.join(sorted(sys.modules)))",))
+    return _run(code).stdout.split()
+
+
+def _cumulative_import_times(code):
+    """The cumulative import time of each top level module imported by
+    code in a fresh interpreter"""
+    result = _run(code, '-X', 'importtime')
+
+    # lines look like "import time:  self [us] | cumulative | module",
+    # with the module names of nested imports indented
+    times = {}
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if (len(fields) == 3 and fields[1].strip().isdigit() and
+                not fields[2].startswith('  ')):
+            times[fields[2].strip()] = int(fields[1])
+    return times
+
+
+def test_import():
+    modules = _imported_modules("import qtree")
+
+    for name in _HEAVY_MODULES:
+        assert name not in modules
+
+
+def test_import_time():
+    # comparing with numpy keeps the bound meaningful on slow machines
+    times = _cumulative_import_times("import qtree\nimport numpy")
+
+    assert times['qtree'] < _MAX_IMPORT_RATIO * times['numpy']
+
+
+def test_lazy_imports():
+    modules = _imported_modules("import qtree",
+                                "qtree.ParticleQuadTreeNode",
+                                "qtree.ParticleVoronoiMesh",
+                                "qtree.ParticleProjectionKDTree")
+
+    for name in _HEAVY_MODULES:
+        assert name not in modules
@@ -0,0 +1,48 @@
+import logging
+
+import numpy as np
+import pytest
+
+from qtree import (ParticleQuadTreeNode, add_timing_hook, log_timings,
+                   remove_timing_hook)
+
+
+def test_timing_hooks():
+    np.random.seed(0x4d3d3d3)
+    positions = np.random.random((1000, 2))
+
+    calls = []
+    hook = add_timing_hook(
+        lambda phase, elapsed, info: calls.append((phase, elapsed, info)))
+    try:
+        tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+        tree.insert(positions, np.ones(1000))
+        tree.pixelize(np.zeros((16, 16)))
+    finally:
+        remove_timing_hook(hook)
+
+    phases = [phase for phase, _, _ in calls]
+    assert phases == ['quadtree.insert', 'quadtree.traverse',
+                      'quadtree.pixelize']
+    assert all(elapsed >= 0 for _, elapsed, _ in calls)
+    assert calls[0][2]['num_particles'] == 1000
+    assert calls[1][2]['num_nodes'] == len(list(tree.leaves))
+
+    # removed hooks are no longer called
+    tree.pixelize(np.zeros((16, 16)))
+    assert len(calls) == 3
+    with pytest.raises(RuntimeError):
+        remove_timing_hook(hook)
+
+
+def test_log_timings(caplog):
+    hook = log_timings(level=logging.DEBUG)
+    try:
+        with caplog.at_level(logging.DEBUG, logger='qtree'):
+            tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+            tree.insert(np.random.random((100, 2)))
+    finally:
+        remove_timing_hook(hook)
+
+    assert any('quadtree.insert' in record.getMessage()
+               for record in caplog.records)
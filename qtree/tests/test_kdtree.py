@@ -0,0 +1,173 @@
+import shutil
+import tempfile
+
+import numpy as np
+import pytest
+
+from qtree.kdtree import (ParticleKDTree, ParticleProjectionKDTree,
+                          ParticleSliceKDTree, _kdtree_cache, _SlabIndex,
+                          build_kdtree)
+
+
+def _require_cykdtree():
+    cykdtree = pytest.importorskip('cykdtree')
+    try:
+        cykdtree.PyKDTree(np.full((1, 3), 0.5), np.zeros(3), np.ones(3),
+                          amr_nested=True)
+    except TypeError:
+        pytest.skip("cykdtree does not support amr_nested")
+
+
+def _positions(input_npart):
+    np.random.seed(0x4d3d3d3)
+    return np.random.random((input_npart, 3))
+
+
+def test_project():
+    _require_cykdtree()
+    input_npart = 2000
+    positions = _positions(input_npart)
+    masses = np.random.random(input_npart)
+
+    tree = ParticleProjectionKDTree(positions, 'z', np.zeros(3), np.ones(3),
+                                    periodic=(False, False, False))
+
+    for shape in [(64, 64), (37, 53)]:
+        image = tree.project(masses, np.zeros(shape))
+
+        # leaves are deposited in proportion to their overlap with each
+        # pixel, so the integral of the image recovers the total mass
+        pixel_area = 1.0 / (shape[0] * shape[1])
+        np.testing.assert_allclose(image.sum() * pixel_area, masses.sum())
+
+    # the weighted average of a constant field is that constant
+    temperature = np.full(input_npart, 3.0)
+    image = tree.project(temperature, np.zeros((64, 64)), weight=masses)
+    assert (image != 0).any()
+    np.testing.assert_allclose(image[image != 0], 3.0)
+
+    serial = tree.project(masses, np.zeros((300, 257)))
+    threaded = tree.project(masses, np.zeros((300, 257)), nthreads=4)
+    assert (serial == threaded).all()
+
+
+def test_slab_index():
+    np.random.seed(0x4d3d3d3)
+    left_edge = np.random.random(500)
+    right_edge = left_edge + np.random.random(500)*0.2
+    index = _SlabIndex(left_edge, right_edge)
+
+    # include the edges themselves, which are the slab boundaries
+    coords = np.concatenate((np.random.uniform(-0.1, 1.3, 200),
+                             left_edge[:50], right_edge[:50]))
+    for coord in coords:
+        expected = np.nonzero((left_edge < coord) &
+                              (coord <= right_edge))[0]
+        np.testing.assert_array_equal(index.query(coord), expected)
+
+
+def test_slice_stack():
+    _require_cykdtree()
+    input_npart = 2000
+    positions = _positions(input_npart)
+    masses = np.random.random(input_npart)
+
+    tree = ParticleSliceKDTree(positions, 'z', 0.5, np.zeros(3), np.ones(3),
+                               periodic=(False, False, False))
+
+    left_edge, right_edge, _, _ = tree._leaf_arrays()
+    for coord in [0.1, 0.5, 0.77]:
+        expected = np.nonzero((left_edge[:, 2] < coord) &
+                              (coord <= right_edge[:, 2]))[0]
+        np.testing.assert_array_equal(tree.slab_index().query(coord),
+                                      expected)
+
+    coords = np.linspace(0.05, 0.95, 7)
+    stack = tree.slice_stack(coords, masses, (64, 48))
+    assert stack.shape == (7, 64, 48)
+    for image, coord in zip(stack, coords):
+        np.testing.assert_array_equal(
+            image, tree.slice(coord, masses, np.zeros((64, 48))))
+
+
+def test_build_kdtree_cache():
+    _require_cykdtree()
+    _kdtree_cache.clear()
+    positions = _positions(1000)
+    bounds = np.zeros(3), np.ones(3)
+
+    tree = build_kdtree(positions, *bounds)
+    # equal positions hit the cache even if they are a different array
+    assert build_kdtree(positions.copy(), *bounds) is tree
+    assert build_kdtree(positions, *bounds, cache=False) is not tree
+    assert build_kdtree(positions, *bounds, leafsize=8) is not tree
+
+    projection = ParticleProjectionKDTree(positions, 'x', *bounds,
+                                          cache=True)
+    view = ParticleSliceKDTree(positions, 'y', 0.5, *bounds, cache=True)
+    assert projection.tree is tree and view.tree is tree
+
+    # the least recently used tree is evicted once the cache is full
+    _kdtree_cache.clear()
+    trees = [build_kdtree(positions, *bounds, leafsize=leafsize)
+             for leafsize in [8, 16, 32, 64]]
+    assert len(_kdtree_cache) == _kdtree_cache.max_size
+    assert build_kdtree(positions, *bounds, leafsize=8) is trees[0]
+    build_kdtree(positions, *bounds, leafsize=128)
+    assert len(_kdtree_cache) == _kdtree_cache.max_size
+    assert build_kdtree(positions, *bounds, leafsize=8) is trees[0]
+    assert build_kdtree(positions, *bounds, leafsize=16) is not trees[1]
+    _kdtree_cache.clear()
+
+
+def test_save_load():
+    _require_cykdtree()
+    input_npart = 2000
+    positions = _positions(input_npart)
+    masses = np.random.random(input_npart)
+
+    tree = ParticleKDTree(positions, np.zeros(3), np.ones(3),
+                          periodic=(False, False, False))
+    projection = tree.projection_view('z').project(masses,
+                                                   np.zeros((64, 64)))
+    slices = tree.slice_view('x', 0.3).slice_stack([0.3, 0.6], masses,
+                                                   (64, 64))
+
+    tmpdir = tempfile.mkdtemp()
+    tree.save(tmpdir)
+    for mmap in [True, False]:
+        loaded = ParticleKDTree.load(tmpdir, mmap=mmap)
+        assert loaded.kdtree is None
+        assert loaded.num_particles == input_npart
+        np.testing.assert_array_equal(
+            loaded.projection_view('z').project(masses, np.zeros((64, 64))),
+            projection)
+        np.testing.assert_array_equal(
+            loaded.slice_view('x', 0.3).slice_stack([0.3, 0.6], masses,
+                                                    (64, 64)),
+            slices)
+        del loaded
+    shutil.rmtree(tmpdir)
+
+
+def test_stats():
+    _require_cykdtree()
+    input_npart = 2000
+    positions = _positions(input_npart)
+
+    tree = ParticleKDTree(positions, np.zeros(3), np.ones(3),
+                          periodic=(False, False, False))
+    stats = tree.stats()
+
+    assert stats['num_particles'] == input_npart
+    assert stats['num_nodes'] == 2*stats['num_leaves'] - 1
+    occupancy = stats['occupancy_histogram']
+    assert occupancy.sum() == stats['num_leaves']
+    assert (occupancy*np.arange(occupancy.shape[0])).sum() == input_npart
+    assert stats['index_bytes'] == tree.idx.nbytes
+
+    # slab indices count towards the geometry, views share the tree stats
+    geometry_bytes = stats['geometry_bytes']
+    view = tree.slice_view('z', 0.5)
+    view.slab_index()
+    assert view.stats()['geometry_bytes'] > geometry_bytes
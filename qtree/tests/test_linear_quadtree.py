@@ -0,0 +1,88 @@
+import numpy as np
+from qtree import ParticleLinearQuadTree, ParticleQuadTreeNode
+
+
+def _positions(input_npart):
+    np.random.seed(0x4d3d3d3)
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    return np.clip(positions, 0, 1.0)
+
+
+def test_linear_quadtree():
+    input_npart = 1000
+    positions = _positions(input_npart)
+
+    tree = ParticleLinearQuadTree([0.5, 0.5], 0.5)
+
+    tree.insert(positions)
+
+    npart = 0
+
+    for leaf in tree.leaves:
+        npart += leaf.num_particles
+
+    assert npart == input_npart
+
+
+def test_linear_quadtree_deposit_field():
+    input_npart = 1000
+    positions = _positions(input_npart)
+
+    masses = np.ones(input_npart)
+
+    tree = ParticleLinearQuadTree([0.5, 0.5], 0.5)
+
+    tree.insert(positions, masses)
+
+    mass = 0
+
+    for leaf in tree.leaves:
+        mass += leaf.deposit_field[:leaf.num_particles].sum()
+
+    assert mass == input_npart
+
+
+def test_linear_leaf_area():
+    positions = _positions(1000)
+
+    tree = ParticleLinearQuadTree([0.5, 0.5], 0.5)
+
+    tree.insert(positions)
+
+    area = 0
+
+    for leaf in tree.leaves:
+        area += leaf.area
+
+    assert area == 1
+
+
+def test_linear_quadtree_matches_node_tree():
+    input_npart = 1000
+    positions = _positions(input_npart)
+    masses = np.random.random(input_npart)
+
+    node_tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+    node_tree.insert(positions, masses)
+
+    linear_tree = ParticleLinearQuadTree([0.5, 0.5], 0.5)
+    linear_tree.insert(positions[:400], masses[:400])
+    linear_tree.insert(positions[400:], masses[400:])
+
+    node_leaves = list(node_tree.leaves)
+    linear_leaves = list(linear_tree.leaves)
+
+    assert len(node_leaves) == len(linear_leaves)
+
+    for node_leaf, linear_leaf in zip(node_leaves, linear_leaves):
+        assert (node_leaf.center == linear_leaf.center).all()
+        assert node_leaf.half_width == linear_leaf.half_width
+        assert node_leaf.num_particles == linear_leaf.num_particles
+
+    node_image = np.zeros((64, 64))
+    node_tree.pixelize(node_image)
+    linear_image = np.zeros((64, 64))
+    linear_tree.pixelize(linear_image)
+
+    np.testing.assert_allclose(node_image, linear_image, rtol=1e-10,
+                               atol=1e-10*node_image.max())
@@ -1,4 +1,10 @@
+import os
+import shutil
+import tempfile
+import tracemalloc
+
 import numpy as np
+import pytest
 from qtree import ParticleQuadTreeNode
 
 
@@ -56,3 +62,638 @@ def test_leaf_area():
         area += leaf.area
 
     assert area == 1
+
+
+def test_quadtree_leaf_size():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0, 1.0)
+
+    masses = np.arange(input_npart, dtype='float64')
+
+    tree = ParticleQuadTreeNode([0.5, 0.5], 0.5, leaf_size=16)
+
+    # insert in two batches so full leaves have to spill into children
+    tree.insert(positions[:10], masses[:10])
+    tree.insert(positions[10:], masses[10:])
+
+    npart = 0
+    deposited = []
+
+    for leaf in tree.leaves:
+        assert leaf.leaf_size == 16
+        assert leaf.num_particles <= 16
+        leaf_positions = leaf.positions[:leaf.num_particles]
+        assert (leaf_positions > leaf.left_edge).all()
+        assert (leaf_positions <= leaf.right_edge).all()
+        npart += leaf.num_particles
+        deposited.append(leaf.deposit_field[:leaf.num_particles])
+
+    assert npart == input_npart
+    assert (np.sort(np.concatenate(deposited)) == masses).all()
+
+
+def test_pixelize_area_weighted():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0, 1.0)
+
+    masses = np.ones(input_npart)
+
+    tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+
+    tree.insert(positions, masses)
+
+    for shape in [(16, 16), (37, 53), (512, 512)]:
+        image = np.zeros(shape)
+        tree.pixelize(image, area_weighted=True)
+
+        # every leaf is deposited in proportion to its overlap with each
+        # pixel, so the integral of the image recovers the total mass
+        pixel_area = 1.0 / (shape[0] * shape[1])
+        np.testing.assert_allclose(image.sum() * pixel_area, input_npart)
+
+    # when pixels are smaller than the smallest leaf both modes agree
+    truncated = np.zeros((512, 512))
+    tree.pixelize(truncated)
+    weighted = np.zeros((512, 512))
+    tree.pixelize(weighted, area_weighted=True)
+    np.testing.assert_allclose(truncated, weighted)
+
+
+def test_pixelize_nthreads():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0, 1.0)
+
+    masses = np.random.random(input_npart)
+
+    tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+
+    tree.insert(positions, masses)
+
+    for area_weighted in [False, True]:
+        serial = np.zeros((300, 257))
+        tree.pixelize(serial, area_weighted=area_weighted)
+        threaded = np.zeros((300, 257))
+        tree.pixelize(threaded, area_weighted=area_weighted, nthreads=4)
+        assert (serial == threaded).all()
+
+
+def test_pixelize_float32_image():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0, 1.0)
+
+    masses = np.random.random(input_npart)
+
+    tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+
+    tree.insert(positions, masses)
+
+    for nthreads in [1, 4]:
+        image = np.zeros((64, 64))
+        tree.pixelize(image, nthreads=nthreads)
+        image32 = np.ones((64, 64), dtype='float32')
+        tree.pixelize(image32, nthreads=nthreads)
+        assert image32.dtype == np.float32
+        np.testing.assert_allclose(image32, image + 1, rtol=1e-6)
+
+
+def test_insert_chunks():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0, 1.0)
+
+    masses = np.random.random(input_npart)
+
+    tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+    tree.insert(positions, masses)
+
+    tmpdir = tempfile.mkdtemp()
+    np.save(os.path.join(tmpdir, 'positions.npy'), positions)
+    np.save(os.path.join(tmpdir, 'masses.npy'), masses)
+    positions_mmap = np.load(os.path.join(tmpdir, 'positions.npy'),
+                             mmap_mode='r')
+    masses_mmap = np.load(os.path.join(tmpdir, 'masses.npy'), mmap_mode='r')
+
+    mmap_tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+    peak = mmap_tree.insert_chunks(positions_mmap, masses_mmap,
+                                   chunk_size=64, track_memory=True)
+    assert peak > 0
+
+    # the peak of a caller already tracing is left untouched
+    tracemalloc.start()
+    try:
+        np.ones(10**6)
+        caller_peak = tracemalloc.get_traced_memory()[1]
+        assert caller_peak >= 8*10**6
+        ParticleQuadTreeNode([0.5, 0.5], 0.5).insert_chunks(
+            positions_mmap, masses_mmap, chunk_size=64, track_memory=True)
+        assert tracemalloc.get_traced_memory()[1] >= caller_peak
+    finally:
+        tracemalloc.stop()
+
+    chunks = ((positions[i:i + 100], masses[i:i + 100])
+              for i in range(0, input_npart, 100))
+    iter_tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+    assert iter_tree.insert_chunks(chunks) is None
+
+    shutil.rmtree(tmpdir)
+
+    for other in [mmap_tree, iter_tree]:
+        leaves = list(tree.leaves)
+        other_leaves = list(other.leaves)
+        assert len(leaves) == len(other_leaves)
+        for leaf, other_leaf in zip(leaves, other_leaves):
+            n = leaf.num_particles
+            assert n == other_leaf.num_particles
+            assert (leaf.positions[:n] == other_leaf.positions[:n]).all()
+            assert (leaf.deposit_field[:n] ==
+                    other_leaf.deposit_field[:n]).all()
+
+
+def test_index_storage():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0, 1.0)
+
+    masses = np.random.random(input_npart)
+
+    tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+    tree.insert(positions, masses)
+
+    tmpdir = tempfile.mkdtemp()
+    np.save(os.path.join(tmpdir, 'positions.npy'), positions)
+    np.save(os.path.join(tmpdir, 'masses.npy'), masses)
+    positions_mmap = np.load(os.path.join(tmpdir, 'positions.npy'),
+                             mmap_mode='r')
+    masses_mmap = np.load(os.path.join(tmpdir, 'masses.npy'), mmap_mode='r')
+
+    index_tree = ParticleQuadTreeNode([0.5, 0.5], 0.5, storage='index')
+    index_tree.insert(positions_mmap, masses_mmap)
+
+    leaves = list(tree.leaves)
+    index_leaves = list(index_tree.leaves)
+    assert len(leaves) == len(index_leaves)
+    for leaf, index_leaf in zip(leaves, index_leaves):
+        n = leaf.num_particles
+        assert n == index_leaf.num_particles
+        assert index_leaf.positions.shape == (n, 2)
+        assert (leaf.positions[:n] == index_leaf.positions).all()
+        assert (leaf.deposit_field[:n] == index_leaf.deposit_field).all()
+
+    image = tree.pixelize(np.zeros((64, 64)))
+    index_image = index_tree.pixelize(np.zeros((64, 64)))
+    np.testing.assert_allclose(image, index_image)
+
+    with pytest.raises(RuntimeError):
+        index_tree.insert(positions_mmap[:10], masses_mmap[:10])
+
+    with pytest.raises(RuntimeError):
+        ParticleQuadTreeNode([0.5, 0.5], 0.5, storage='view')
+
+    del positions_mmap, masses_mmap, index_tree, index_leaves
+    shutil.rmtree(tmpdir)
+
+
+def test_dynamic_updates():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.uniform(0.05, 0.95, size=(input_npart, 2))
+    masses = np.random.random(input_npart)
+
+    tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+    ids = tree.insert(positions, masses)
+    assert (ids == np.arange(input_npart)).all()
+
+    # small displacements for most particles, a few jump across the domain
+    positions = positions + np.random.normal(scale=0.01,
+                                             size=positions.shape)
+    positions[:50] = np.random.uniform(0.05, 0.95, size=(50, 2))
+    tree.update_positions(ids, positions)
+
+    masses[::3] = np.random.random(masses[::3].shape)
+    tree.update_field(ids[::3], masses[::3])
+
+    removed = np.random.choice(input_npart, 400, replace=False)
+    tree.remove(removed)
+    keep = np.setdiff1d(ids, removed)
+
+    with pytest.raises(RuntimeError):
+        tree.remove(removed[:1])
+
+    fresh = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+    fresh.insert(positions[keep], masses[keep])
+
+    assert tree.num_particles == keep.shape[0]
+    np.testing.assert_allclose(tree._totals, fresh._totals)
+    leaves = list(tree.leaves)
+    fresh_leaves = list(fresh.leaves)
+    assert len(leaves) == len(fresh_leaves)
+    for leaf, fresh_leaf in zip(leaves, fresh_leaves):
+        n = leaf.num_particles
+        assert n == fresh_leaf.num_particles
+        order = np.argsort(leaf.deposit_field[:n])
+        fresh_order = np.argsort(fresh_leaf.deposit_field[:n])
+        assert (leaf.positions[:n][order] ==
+                fresh_leaf.positions[:n][fresh_order]).all()
+        assert (leaf.deposit_field[:n][order] ==
+                fresh_leaf.deposit_field[:n][fresh_order]).all()
+
+    # particles that stay inside their leaves are updated in place
+    num_leaves = len(leaves)
+    tree.update_positions(keep, positions[keep])
+    assert len(list(tree.leaves)) == num_leaves
+    tree.remove([])
+
+    new_ids = tree.insert([0.25, 0.25], np.array([1.0]))
+    assert (new_ids == [input_npart]).all()
+
+
+def test_rejected_updates():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 200
+    positions = np.random.uniform(0.05, 0.95, size=(input_npart, 2))
+    masses = np.random.random(input_npart)
+
+    tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+    ids = tree.insert(positions, masses)
+    tree.remove(ids[:10])
+    image = tree.pixelize(np.zeros((64, 64)))
+
+    # duplicate or unknown ids are rejected before the tree is modified
+    new_positions = np.random.uniform(0.05, 0.95, size=(2, 2))
+    for bad_ids in [[30, 30], [30, 5], [30, input_npart]]:
+        with pytest.raises(RuntimeError):
+            tree.remove(np.array(bad_ids))
+        with pytest.raises(RuntimeError):
+            tree.update_positions(np.array(bad_ids), new_positions)
+        with pytest.raises(RuntimeError):
+            tree.update_field(np.array(bad_ids), np.zeros(2))
+        assert tree.num_particles == input_npart - 10
+        np.testing.assert_array_equal(tree.pixelize(np.zeros((64, 64))),
+                                      image)
+
+
+def test_save_load():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0, 1.0)
+
+    masses = np.random.random(input_npart)
+
+    tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+    tree.insert(positions, masses)
+
+    tmpdir = tempfile.mkdtemp()
+    tree.save(tmpdir)
+
+    for mmap in [True, False]:
+        loaded = ParticleQuadTreeNode.load(tmpdir, mmap=mmap)
+        assert loaded.num_particles == tree.num_particles
+        leaves = list(tree.leaves)
+        loaded_leaves = list(loaded.leaves)
+        assert len(leaves) == len(loaded_leaves)
+        for leaf, loaded_leaf in zip(leaves, loaded_leaves):
+            n = leaf.num_particles
+            assert n == loaded_leaf.num_particles
+            assert (leaf.center == loaded_leaf.center).all()
+            assert (leaf.positions[:n] == loaded_leaf.positions).all()
+            assert (leaf.deposit_field[:n] == loaded_leaf.deposit_field).all()
+
+        image = tree.pixelize(np.zeros((64, 64)))
+        loaded_image = loaded.pixelize(np.zeros((64, 64)))
+        assert (image == loaded_image).all()
+
+    del loaded, loaded_leaves
+    shutil.rmtree(tmpdir)
+
+
+def test_queries():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0.01, 0.99)
+
+    tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+    ids = tree.insert(positions)
+
+    points = np.random.random((50, 2))
+    dist = np.sqrt(((points[:, None] - positions[None])**2).sum(axis=-1))
+
+    offsets, indices = tree.query_radius(points, 0.05)
+    for i in range(points.shape[0]):
+        expected = ids[dist[i] <= 0.05]
+        assert (indices[offsets[i]:offsets[i + 1]] == expected).all()
+
+    left_edge = points - 0.05
+    right_edge = points + np.random.random((50, 2))*0.1
+    offsets, indices = tree.query_box(left_edge, right_edge)
+    for i in range(points.shape[0]):
+        inside = ((positions >= left_edge[i]).all(axis=-1) &
+                  (positions <= right_edge[i]).all(axis=-1))
+        assert (indices[offsets[i]:offsets[i + 1]] == ids[inside]).all()
+
+    distances, indices = tree.query_knn(points, k=5)
+    expected = np.argsort(dist, axis=-1, kind='stable')[:, :5]
+    assert (indices == ids[expected]).all()
+    np.testing.assert_allclose(
+        distances, np.take_along_axis(dist, expected, axis=-1))
+
+    distances, indices = tree.query_knn(points[:3], k=input_npart + 1)
+    assert (indices[:, -1] == -1).all()
+    assert np.isinf(distances[:, -1]).all()
+    assert (np.sort(indices[:, :-1], axis=-1) == ids).all()
+
+
+def test_multiple_fields():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0.01, 0.99)
+
+    mass = np.random.random(input_npart)
+    temperature = np.random.random(input_npart)*1e4
+
+    images = []
+    for field in [mass, temperature, mass*temperature]:
+        tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+        tree.insert(positions, field)
+        images.append(tree.pixelize(np.zeros((64, 64))))
+
+    for storage in ['copy', 'index']:
+        tree = ParticleQuadTreeNode([0.5, 0.5], 0.5, storage=storage)
+        tree.insert(positions, {'mass': mass, 'temperature': temperature})
+        stack = tree.pixelize(np.zeros((2, 64, 64)))
+        np.testing.assert_allclose(stack[0], images[0])
+        np.testing.assert_allclose(stack[1], images[1])
+
+        stack = tree.pixelize(np.zeros((2, 64, 64)),
+                              weights={'temperature': 'mass'})
+        np.testing.assert_allclose(stack[0], images[0])
+        covered = images[0] != 0
+        np.testing.assert_allclose(stack[1][covered],
+                                   images[2][covered] / images[0][covered])
+
+        with pytest.raises(RuntimeError):
+            tree.pixelize(np.zeros((64, 64)))
+
+    tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+    tree.insert(positions, np.column_stack((mass, temperature)))
+    stack = tree.pixelize(np.zeros((2, 64, 64)))
+    np.testing.assert_allclose(stack[1], images[1])
+
+
+def test_pixelize_lod():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 10000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0.01, 0.99)
+
+    masses = np.random.random(input_npart)
+
+    tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+    ids = tree.insert(positions, masses)
+    np.testing.assert_allclose(tree.deposit_total, masses.sum())
+
+    tree.update_field(ids[:10], np.ones(10))
+    tree.remove(ids[10:20])
+    masses[:10] = 1
+    np.testing.assert_allclose(tree.deposit_total, masses[20:].sum() + 10)
+    for node in [tree.southwest, tree.northeast.northeast]:
+        leaf_sum = sum(leaf.deposit_field[:leaf.num_particles].sum()
+                       for leaf in node.leaves)
+        np.testing.assert_allclose(node.deposit_total, leaf_sum)
+
+    image = tree.pixelize(np.zeros((16, 16)), area_weighted=True)
+    lod_image = tree.pixelize(np.zeros((16, 16)), area_weighted=True,
+                              lod=True)
+    # nodes smaller than a pixel are aligned with the pixel grid
+    np.testing.assert_allclose(lod_image, image)
+    assert len(tree._lod_arrays(1/16)[0]) < len(list(tree.leaves))
+
+
+def test_pixelize_window():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0.01, 0.99)
+
+    masses = np.random.random(input_npart)
+
+    tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+    tree.insert(positions, masses)
+
+    image = tree.pixelize(np.zeros((64, 64)), area_weighted=True)
+    window = [[0.25, 0.375], [0.5, 0.625]]
+    window_image = tree.pixelize(np.zeros((16, 16)), area_weighted=True,
+                                 bounds=window)
+    np.testing.assert_allclose(window_image, image[16:32, 24:40])
+
+    visible = list(tree._visible_nodes(np.array(window)))
+    assert 0 < len(visible) < len(list(tree.leaves))
+
+    with pytest.raises(RuntimeError):
+        tree.pixelize(np.zeros((16, 16)), bounds=[[0.5, 0.5], [0.25, 0.75]])
+
+
+def test_plot():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0.01, 0.99)
+
+    tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+    tree.insert(positions)
+
+    segments, points = tree._plot_arrays()
+    assert segments.shape == (4*len(list(tree.leaves)), 2, 2)
+    np.testing.assert_array_equal(np.sort(points, axis=0),
+                                  np.sort(positions, axis=0))
+
+    with tempfile.NamedTemporaryFile(suffix='.png') as fp:
+        tree.plot(fp.name)
+
+    rgba = tree.plot(rgba=True, shape=(256, 128))
+    assert rgba.shape == (128, 256, 4)
+    assert rgba.dtype == np.uint8
+    # the outline of the root node is drawn along the image borders
+    assert (rgba[0, :, :3] == 0).all() and (rgba[:, 0, :3] == 0).all()
+    assert (rgba[..., :3] == 255).any()
+
+
+def test_stats():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0.01, 0.99)
+
+    for storage in ['copy', 'index']:
+        tree = ParticleQuadTreeNode([0.5, 0.5], 0.5, storage=storage)
+        tree.insert(positions, np.ones(input_npart))
+        stats = tree.stats()
+
+        leaves = list(tree.leaves)
+        assert stats['num_particles'] == input_npart
+        assert stats['num_leaves'] == len(leaves)
+        # every refined node has four children
+        assert stats['num_nodes'] == (4*stats['num_leaves'] - 1) // 3
+        assert stats['depth_histogram'].sum() == len(leaves)
+        occupancy = stats['occupancy_histogram']
+        assert occupancy.sum() == len(leaves)
+        assert (occupancy*np.arange(occupancy.shape[0])).sum() == input_npart
+        assert stats['position_bytes'] >= positions.nbytes
+        assert stats['geometry_bytes'] > 0
+
+
+def test_build():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 2000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0.01, 0.99)
+
+    fields = {'mass': np.random.random(input_npart),
+              'temperature': np.random.random(input_npart)}
+
+    for storage in ['copy', 'index']:
+        serial = ParticleQuadTreeNode([0.5, 0.5], 0.5, storage=storage)
+        serial.insert(positions, fields)
+        tree = ParticleQuadTreeNode([0.5, 0.5], 0.5, storage=storage)
+        ids = tree.build(positions, fields, nworkers=2)
+        np.testing.assert_array_equal(ids, np.arange(input_npart))
+
+        leaves = list(tree.leaves)
+        serial_leaves = list(serial.leaves)
+        assert len(leaves) == len(serial_leaves)
+        for leaf, serial_leaf in zip(leaves, serial_leaves):
+            n = leaf.num_particles
+            assert n == serial_leaf.num_particles
+            np.testing.assert_array_equal(leaf.center, serial_leaf.center)
+            np.testing.assert_array_equal(leaf.positions[:n],
+                                          serial_leaf.positions[:n])
+            np.testing.assert_array_equal(leaf._leaf_ids(),
+                                          serial_leaf._leaf_ids())
+            np.testing.assert_array_equal(leaf.deposit_total,
+                                          serial_leaf.deposit_total)
+
+        image = tree.pixelize(np.zeros((2, 32, 32)), lod=True)
+        serial_image = serial.pixelize(np.zeros((2, 32, 32)), lod=True)
+        np.testing.assert_array_equal(image, serial_image)
+
+        if storage == 'copy':
+            # the built tree supports dynamic updates
+            tree.remove(ids[:10])
+            assert tree.num_particles == input_npart - 10
+
+    with pytest.raises(RuntimeError):
+        tree.build(positions, nworkers=2)
+
+
+def test_dtype():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0.01, 0.99)
+    masses = np.random.random(input_npart)
+
+    for storage in ['copy', 'index']:
+        tree = ParticleQuadTreeNode([0.5, 0.5], 0.5, storage=storage)
+        tree.insert(positions, masses)
+        tree32 = ParticleQuadTreeNode([0.5, 0.5], 0.5, storage=storage,
+                                      dtype='float32')
+        tree32.insert(positions, masses)
+
+        leaf = next(iter(tree32.leaves))
+        assert leaf.positions.dtype == np.float32
+        assert leaf.deposit_field.dtype == np.float32
+        assert (2*tree32.stats()['position_bytes'] ==
+                tree.stats()['position_bytes'])
+        # deposit totals are accumulated in float64
+        assert tree32._totals.dtype == np.float64
+        np.testing.assert_allclose(tree32.deposit_total,
+                                   masses.astype('float32').sum(
+                                       dtype='float64'))
+
+        image = tree.pixelize(np.zeros((64, 64)))
+        image32 = tree32.pixelize(np.zeros((64, 64)))
+        assert image32.dtype == np.float64
+        np.testing.assert_allclose(image32, image, rtol=1e-6)
+
+        tmpdir = tempfile.mkdtemp()
+        tree32.save(tmpdir)
+        assert np.load(os.path.join(tmpdir, 'positions.npy'),
+                       mmap_mode='r').dtype == np.float32
+        loaded = ParticleQuadTreeNode.load(tmpdir)
+        assert loaded.dtype == np.float32
+        np.testing.assert_array_equal(
+            loaded.pixelize(np.zeros((64, 64))), image32)
+        del loaded
+        shutil.rmtree(tmpdir)
+
+    # index storage keeps the dtype of the caller's arrays by default
+    tree = ParticleQuadTreeNode([0.5, 0.5], 0.5, storage='index')
+    tree.insert(positions.astype('float32'))
+    assert tree.dtype == np.float32
+
+
+def test_pixelize_cache():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0.01, 0.99)
+    masses = np.random.random(input_npart)
+
+    tree = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+    ids = tree.insert(positions, masses)
+    cached = ParticleQuadTreeNode([0.5, 0.5], 0.5)
+    cached.enable_cache()
+    cached.insert(positions, masses)
+
+    views = [{}, {'lod': True}, {'area_weighted': True},
+             {'bounds': [[0.25, 0.25], [0.75, 0.75]]}]
+    for _ in range(2):
+        for kwargs in views:
+            np.testing.assert_array_equal(
+                cached.pixelize(np.ones((64, 64)), **kwargs),
+                tree.pixelize(np.ones((64, 64)), **kwargs))
+    assert len(cached._cache) == len(views)
+
+    # mutations invalidate the cached images
+    for updated in [tree, cached]:
+        updated.update_field(ids[:10], np.zeros(10))
+        updated.update_positions(ids[10:20], positions[20:30])
+        updated.remove(ids[30:40])
+    assert len(cached._cache) == 0
+    np.testing.assert_array_equal(cached.pixelize(np.zeros((64, 64))),
+                                  tree.pixelize(np.zeros((64, 64))))
+
+    # as do mutations through other nodes of the tree
+    for updated in [tree, cached]:
+        updated.northeast.insert([0.9, 0.9], np.array([1.0]))
+    np.testing.assert_array_equal(cached.pixelize(np.zeros((64, 64))),
+                                  tree.pixelize(np.zeros((64, 64))))
+    cached.northeast.enable_cache()
+    cached.northeast.pixelize(np.zeros((64, 64)))
+    for updated in [tree, cached]:
+        updated.update_field(ids[50:60], np.zeros(10))
+    np.testing.assert_array_equal(
+        cached.northeast.pixelize(np.zeros((64, 64))),
+        tree.northeast.pixelize(np.zeros((64, 64))))
+
+    # least recently used images are evicted beyond the memory budget
+    cached.enable_cache(max_bytes=2*64*64*8)
+    for shape in [(64, 64), (64, 48), (48, 64)]:
+        cached.pixelize(np.zeros(shape))
+    assert len(cached._cache) == 2
+    assert cached._cache.size <= 2*64*64*8
+
+    cached.disable_cache()
+    assert cached._cache is None
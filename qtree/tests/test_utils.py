@@ -0,0 +1,62 @@
+import numpy as np
+
+from qtree.utils import _points_in_poly, _rasterize_polygons
+
+
+def test_rasterize_polygons():
+    # a square and a concave L-shaped polygon
+    verts = np.array([
+        [0.1, 0.1], [0.5, 0.1], [0.5, 0.5], [0.1, 0.5],
+        [0.6, 0.1], [0.9, 0.1], [0.9, 0.3], [0.7, 0.3], [0.7, 0.9],
+        [0.6, 0.9],
+    ])
+    offsets = np.array([0, 4, 10], dtype=np.intp)
+    values = np.array([1.0, 2.0])
+
+    x0, dx, y0, dy = 0.01, 0.02, 0.0125, 0.025
+    x, y = np.meshgrid(x0 + np.arange(50)*dx, y0 + np.arange(40)*dy,
+                       indexing='ij')
+    expected = (values[0]*_points_in_poly(verts[:4].copy(), x, y) +
+                values[1]*_points_in_poly(verts[4:].copy(), x, y))
+
+    for nthreads in [1, 4]:
+        image = np.zeros((50, 40))
+        _rasterize_polygons(image, verts, offsets, values, x0, dx, y0, dy,
+                            nthreads)
+        assert (image == expected).all()
+
+    # the vertices of this test are far from pixel centers, so float32
+    # vertices rasterize identically
+    verts32 = verts.astype('float32')
+    expected32 = (
+        values[0]*_points_in_poly(verts32[:4].copy(), x.astype('float32'),
+                                  y.astype('float32')) +
+        values[1]*_points_in_poly(verts32[4:].copy(), x.astype('float32'),
+                                  y.astype('float32')))
+    assert (expected32 == expected).all()
+    image = np.zeros((50, 40))
+    _rasterize_polygons(image, verts32, offsets, values, x0, dx, y0, dy)
+    assert (image == expected).all()
+
+
+def test_rasterize_shared_edges():
+    # pairs of triangles sharing an edge through pixel centers, which the
+    # two triangles traverse in opposite directions
+    np.random.seed(0x4d3d3d3)
+    n = 300
+    dx = dy = 1.0 / n
+    x0 = y0 = dx / 2
+    offsets = np.array([0, 3], dtype=np.intp)
+    for _ in range(50):
+        i0, j0 = np.random.randint(20, 60, 2)
+        i1, j1 = np.random.randint(200, 280, 2)
+        a = [x0 + i0*dx, y0 + j0*dy]
+        c = [x0 + i1*dx, y0 + j1*dy]
+        claims = np.zeros((n, n))
+        for triangle in ([a, [0.97, 0.03], c], [a, c, [0.03, 0.97]]):
+            image = np.zeros((n, n))
+            _rasterize_polygons(image, np.array(triangle), offsets,
+                                np.ones(1), x0, dx, y0, dy)
+            claims += image
+        # every pixel belongs to at most one of the triangles
+        assert claims.max() == 1
@@ -1,4 +1,5 @@
 import numpy as np
+import shutil
 import tempfile
 
 from qtree.voronoi import ParticleVoronoiMesh
@@ -16,3 +17,234 @@ def test_voronoi():
 
     with tempfile.NamedTemporaryFile() as fp:
         mesh.plot(fp.name)
+
+
+def test_voronoi_pixelize_nearest():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0, 1.0)
+
+    masses = np.ones(input_npart)
+
+    mesh = ParticleVoronoiMesh(positions, masses, [[0, 0], [1, 1]])
+
+    nearest = mesh.pixelize(np.zeros((128, 128)))
+    polygon = mesh.pixelize(np.zeros((128, 128)), method='polygon')
+
+    assert (nearest != 0).any()
+    # pixel centers are only assigned differently if they are equidistant
+    # from two particles
+    assert (nearest == polygon).mean() > 0.999
+
+
+def test_voronoi_pixelize_nthreads():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0, 1.0)
+
+    masses = np.random.random(input_npart)
+
+    mesh = ParticleVoronoiMesh(positions, masses, [[0, 0], [1, 1]])
+
+    for method in ['nearest', 'polygon']:
+        serial = mesh.pixelize(np.zeros((300, 300)), method=method)
+        threaded = mesh.pixelize(np.zeros((300, 300)), method=method,
+                                 nthreads=4)
+        assert (serial == threaded).all()
+
+
+def test_voronoi_pixelize_nthreads_large():
+    # pixels on the edges shared by many cells are claimed by one cell
+    # only, so the order cells are rasterized in does not matter
+    np.random.seed(0x4d3d3d3)
+    input_npart = 20000
+    positions = np.random.random((input_npart, 2))
+    masses = np.random.random(input_npart)
+
+    mesh = ParticleVoronoiMesh(positions, masses, [[0, 0], [1, 1]])
+
+    serial = mesh.pixelize(np.zeros((700, 700)), method='polygon')
+    threaded = mesh.pixelize(np.zeros((700, 700)), method='polygon',
+                             nthreads=4)
+    assert (serial == threaded).all()
+
+
+def test_voronoi_save_load():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0, 1.0)
+
+    masses = np.ones(input_npart)
+
+    mesh = ParticleVoronoiMesh(positions, masses, [[0, 0], [1, 1]])
+
+    tmpdir = tempfile.mkdtemp()
+    mesh.save(tmpdir)
+    loaded = ParticleVoronoiMesh.load(tmpdir)
+
+    np.testing.assert_array_equal(mesh.cell_areas, loaded.cell_areas)
+    for method in ['nearest', 'polygon']:
+        image = mesh.pixelize(np.zeros((64, 64)), method=method)
+        loaded_image = loaded.pixelize(np.zeros((64, 64)), method=method)
+        np.testing.assert_array_equal(image, loaded_image)
+
+    del loaded
+    shutil.rmtree(tmpdir)
+
+
+def test_voronoi_multiple_fields():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0, 1.0)
+
+    mass = np.random.random(input_npart)
+    temperature = np.random.random(input_npart)*1e4
+    bounds = [[0, 0], [1, 1]]
+
+    mesh = ParticleVoronoiMesh(positions, mass, bounds)
+    multi_mesh = ParticleVoronoiMesh(
+        positions, {'mass': mass, 'temperature': temperature}, bounds)
+
+    for method in ['nearest', 'polygon']:
+        image = mesh.pixelize(np.zeros((64, 64)), method=method)
+        stack = multi_mesh.pixelize(np.zeros((2, 64, 64)), method=method)
+        np.testing.assert_array_equal(stack[0], image)
+
+        stack = multi_mesh.pixelize(np.zeros((2, 64, 64)), method=method,
+                                    weights={'temperature': 'mass'})
+        areas = multi_mesh.cell_areas
+        covered = image != 0
+        # each pixel shows the temperature of the cell it lies in
+        assert np.isin(stack[1][covered],
+                       temperature[~np.isnan(areas)]).all()
+
+
+def test_voronoi_pixelize_window():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.normal(loc=0.5, scale=0.1, size=(input_npart, 2))
+    positions = np.clip(positions, 0, 1.0)
+
+    masses = np.ones(input_npart)
+
+    mesh = ParticleVoronoiMesh(positions, masses, [[0, 0], [1, 1]])
+    scaled_mesh = ParticleVoronoiMesh(2*positions, masses, [[0, 0], [2, 2]])
+
+    for method in ['nearest', 'polygon']:
+        image = mesh.pixelize(np.zeros((64, 64)), method=method)
+        window_image = mesh.pixelize(np.zeros((16, 16)), method=method,
+                                     bounds=[[0.25, 0.375], [0.5, 0.625]])
+        np.testing.assert_array_equal(window_image, image[16:32, 24:40])
+
+        # the pixel grid follows the bounds of the mesh
+        scaled_image = scaled_mesh.pixelize(np.zeros((64, 64)),
+                                            method=method)
+        np.testing.assert_allclose(4*scaled_image, image)
+
+
+def test_voronoi_clipped_cells():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.random((input_npart, 2))
+
+    masses = np.ones(input_npart)
+
+    mesh = ParticleVoronoiMesh(positions, masses, [[0, 0], [1, 1]])
+
+    # every cell is clipped to the bounds, so the cells tile the bounds
+    assert not np.isnan(mesh.cell_areas).any()
+    np.testing.assert_allclose(mesh.cell_areas.sum(), 1.0)
+
+    for method in ['nearest', 'polygon']:
+        image = mesh.pixelize(np.zeros((64, 64)), method=method)
+        assert (image != 0).all()
+
+    # cells of particles outside the bounds are not pixelized
+    window_mesh = ParticleVoronoiMesh(positions, masses,
+                                      [[0.25, 0.25], [0.75, 0.75]])
+    outside = ((positions < 0.25) | (positions > 0.75)).any(axis=-1)
+    assert np.isnan(window_mesh.cell_areas[outside]).all()
+    assert not np.isnan(window_mesh.cell_areas[~outside]).any()
+
+
+def test_voronoi_plot_rgba():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.random((input_npart, 2))
+
+    mesh = ParticleVoronoiMesh(positions, np.ones(input_npart),
+                               [[0, 0], [1, 1]])
+
+    rgba = mesh.plot(rgba=True, shape=(128, 128))
+    assert rgba.shape == (128, 128, 4)
+    assert (rgba[..., :3] == 0).any() and (rgba[..., :3] == 255).any()
+
+
+def test_voronoi_stats():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.random((input_npart, 2))
+
+    mesh = ParticleVoronoiMesh(positions, np.ones(input_npart),
+                               [[0.25, 0.25], [0.75, 0.75]])
+    stats = mesh.stats()
+
+    outside = ((positions < 0.25) | (positions > 0.75)).any(axis=-1)
+    assert stats['num_particles'] == input_npart
+    assert stats['num_skipped'] == outside.sum()
+    assert stats['num_cells'] == input_npart - outside.sum()
+    assert 0 < stats['num_unbounded'] < stats['num_clipped']
+    assert stats['position_bytes'] == positions.nbytes
+    assert stats['deposit_bytes'] == input_npart*8
+    assert stats['num_vertices'] > 0 and stats['geometry_bytes'] > 0
+
+
+def test_voronoi_dtype():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.random((input_npart, 2))
+    masses = np.random.random(input_npart)
+
+    mesh = ParticleVoronoiMesh(positions, masses, [[0, 0], [1, 1]])
+    mesh32 = ParticleVoronoiMesh(positions, masses, [[0, 0], [1, 1]],
+                                 dtype='float32')
+
+    assert mesh32.points.dtype == np.float32
+    assert mesh32._polygons[2].dtype == np.float32
+    assert 2*mesh32.stats()['position_bytes'] == mesh.stats()[
+        'position_bytes']
+
+    for method in ['nearest', 'polygon']:
+        image = mesh.pixelize(np.zeros((64, 64)), method=method)
+        image32 = mesh32.pixelize(np.zeros((64, 64)), method=method)
+        assert image32.dtype == np.float64
+        np.testing.assert_allclose(image32, image, rtol=1e-5)
+
+
+def test_voronoi_pixelize_cache():
+    np.random.seed(0x4d3d3d3)
+    input_npart = 1000
+    positions = np.random.random((input_npart, 2))
+    fields = {'mass': np.random.random(input_npart),
+              'temperature': np.random.random(input_npart)}
+
+    mesh = ParticleVoronoiMesh(positions, fields, [[0, 0], [1, 1]])
+    cached = ParticleVoronoiMesh(positions, fields, [[0, 0], [1, 1]])
+    cached.enable_cache()
+
+    for method in ['nearest', 'polygon']:
+        for weights in [None, {'temperature': 'mass'}, None]:
+            np.testing.assert_array_equal(
+                cached.pixelize(np.zeros((2, 64, 64)), method=method,
+                                weights=weights),
+                mesh.pixelize(np.zeros((2, 64, 64)), method=method,
+                              weights=weights))
+    # one pixel to cell assignment per method, shared by all weights
+    assert len(cached._cache) == 2
+
+    cached.disable_cache()
+    assert cached._cache is None
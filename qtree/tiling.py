@@ -0,0 +1,126 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from qtree.utils import _deposit_rectangles
+
+_TILE_SIZE = 128
+
+
+def _tile_bins(left_edge, right_edge, shape, tile_size=_TILE_SIZE):
+    """Assign rectangles to the image tiles they overlap
+
+    Parameters
+    ----------
+    left_edge, right_edge : ndarray
+        The ``(n, 2)`` corners of the rectangles in pixel units.
+    shape : 2-element tuple
+        The shape of the image.
+    tile_size : int
+        The number of pixels along each side of a tile.
+
+    Returns
+    -------
+    offsets, indices : ndarray
+        The rectangles overlapping tile ``t`` are
+        ``indices[offsets[t]:offsets[t+1]]``, in increasing order. Tiles
+        are numbered in C order over the grid of tiles.
+    """
+    shape = np.asarray(shape)
+    ntiles = -(-shape // tile_size)
+
+    inside = ((right_edge > 0).all(axis=-1) &
+              (left_edge < shape).all(axis=-1))
+    rects = np.nonzero(inside)[0]
+
+    t0 = np.clip(np.floor(left_edge[rects] / tile_size).astype('int64'),
+                 0, ntiles - 1)
+    t1 = np.clip(np.floor(right_edge[rects] / tile_size).astype('int64'),
+                 0, ntiles - 1)
+    span = t1 - t0 + 1
+    npairs = span.prod(axis=-1)
+
+    # expand every rectangle into one (rectangle, tile) pair per tile it
+    # overlaps, then group the pairs by tile with a stable sort so the
+    # rectangles of each tile stay in their original order
+    pair_rect = np.repeat(np.arange(rects.shape[0]), npairs)
+    local = (np.arange(pair_rect.shape[0]) -
+             np.repeat(np.cumsum(npairs) - npairs, npairs))
+    tx = t0[pair_rect, 0] + local // span[pair_rect, 1]
+    ty = t0[pair_rect, 1] + local % span[pair_rect, 1]
+    tile_id = tx * ntiles[1] + ty
+
+    order = np.argsort(tile_id, kind='stable')
+    offsets = np.zeros(ntiles.prod() + 1, dtype='int64')
+    offsets[1:] = np.cumsum(np.bincount(tile_id, minlength=ntiles.prod()))
+
+    return offsets, rects[pair_rect[order]]
+
+
+def _render_tiles(render, shape, nthreads, left_edge=None, right_edge=None,
+                  tile_size=_TILE_SIZE):
+    """Render an image tile by tile on a pool of threads
+
+    ``render(i0, i1, j0, j1, indices)`` is called for every tile
+    ``image[i0:i1, j0:j1]`` with the indices of the rectangles that may
+    overlap it, tiles that no rectangle overlaps are skipped. If no
+    rectangles are given ``indices`` is None and every tile is rendered.
+    ``render`` must release the GIL to run concurrently and may only write
+    to pixels inside its tile. With ``nthreads=1`` the whole image is
+    rendered in a single call.
+    """
+    if nthreads == 1:
+        indices = None
+        if left_edge is not None:
+            indices = np.arange(left_edge.shape[0])
+        render(0, shape[0], 0, shape[1], indices)
+        return
+
+    nty = -(-shape[1] // tile_size)
+    ntiles = -(-shape[0] // tile_size) * nty
+
+    if left_edge is not None:
+        offsets, indices = _tile_bins(left_edge, right_edge, shape,
+                                      tile_size)
+
+    def render_tile(tile):
+        tile_indices = None
+        if left_edge is not None:
+            if offsets[tile] == offsets[tile + 1]:
+                return
+            tile_indices = indices[offsets[tile]:offsets[tile + 1]]
+        i0 = (tile // nty) * tile_size
+        j0 = (tile % nty) * tile_size
+        render(i0, min(i0 + tile_size, shape[0]),
+               j0, min(j0 + tile_size, shape[1]), tile_indices)
+
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        # consume the results so exceptions raised in a tile propagate
+        list(pool.map(render_tile, range(ntiles)))
+
+
+def _deposit_leaves(image, left_edge, right_edge, values, area_weighted,
+                    nthreads):
+    """Deposit rectangles given in pixel units, optionally tile by tile
+
+    ``image`` may also be a ``(nfields, nx, ny)`` stack of images with
+    ``(nrectangles, nfields)`` values. Images that are not float64 are
+    rendered into a float64 scratch image that is then added to them.
+    """
+    if image.dtype != np.float64:
+        scratch = np.zeros(image.shape)
+        _deposit_leaves(scratch, left_edge, right_edge, values,
+                        area_weighted, nthreads)
+        image += scratch
+        return
+
+    if nthreads == 1:
+        _deposit_rectangles(image, left_edge, right_edge, values,
+                            area_weighted)
+        return
+
+    def render(i0, i1, j0, j1, indices):
+        _deposit_rectangles(image, left_edge[indices], right_edge[indices],
+                            values[indices], area_weighted, i0, i1, j0, j1)
+
+    _render_tiles(render, image.shape[-2:], nthreads, left_edge, right_edge)
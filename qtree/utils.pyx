@@ -1,9 +1,15 @@
 import numpy as np
 cimport numpy as np
+cimport cython
+from cython cimport floating
+from cython.parallel cimport prange
+from libc.math cimport floor, ceil
+from libc.stdlib cimport malloc, free
 
-def _points_in_poly(np.float64_t[:, :] verts, np.float64_t[:, :] px,
-                    np.float64_t[:, :] py):
+def _points_in_poly(floating[:, :] verts, floating[:, :] px,
+                    floating[:, :] py):
     # see https://stackoverflow.com/a/2922778/1382869
+    # the vertices and points are either all float32 or all float64
     cdef np.intp_t[:, :] c
     cdef np.intp_t  i, j, k
 
@@ -18,3 +24,203 @@ def _points_in_poly(np.float64_t[:, :] verts, np.float64_t[:, :] px,
                         (verts[i-1, 1] - verts[i, 1])) + verts[i, 0])):
                     c[j, k] += 1
     return np.asarray(c) % 2
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def _deposit_rectangles(image,
+                        const floating[:, :] left_edge,
+                        const floating[:, :] right_edge,
+                        values, bint area_weighted=False,
+                        np.intp_t i_start=0, np.intp_t i_stop=-1,
+                        np.intp_t j_start=0, np.intp_t j_stop=-1):
+    # left_edge and right_edge are rectangle corners in pixel units. If
+    # area_weighted is set each pixel receives the value weighted by the
+    # fraction of the pixel covered by the rectangle, otherwise the edges
+    # are truncated to integers and covered pixels receive the full value.
+    # image is either a single (nx, ny) image with one value per rectangle
+    # or a (nfields, nx, ny) stack with (nrectangles, nfields) values, all
+    # fields are deposited in the same pass over the rectangles.
+    # Only pixels inside image[i_start:i_stop, j_start:j_stop] are written,
+    # a negative stop means the end of the image.
+    # The edges may be float32 or float64, deposits always accumulate in
+    # double precision: images of any other type are deposited into a
+    # float64 scratch image that is then added to them.
+    image = np.asarray(image)
+    values = np.asarray(values, dtype='float64')
+    if image.ndim == 2:
+        image = image[None]
+        values = values[:, None]
+    target = image
+    if image.dtype != np.float64:
+        target = np.zeros(image.shape)
+    cdef np.float64_t[:, :, :] stack = target
+    cdef const np.float64_t[:, :] field_values = values
+    cdef np.intp_t nx = stack.shape[1]
+    cdef np.intp_t ny = stack.shape[2]
+
+    if i_stop < 0 or i_stop > nx:
+        i_stop = nx
+    if j_stop < 0 or j_stop > ny:
+        j_stop = ny
+
+    with nogil:
+        _deposit_rectangles_kernel(stack, left_edge, right_edge,
+                                   field_values, area_weighted, i_start,
+                                   i_stop, j_start, j_stop)
+
+    if target is not image:
+        image += target
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _deposit_rectangles_kernel(np.float64_t[:, :, :] image,
+                                     const floating[:, :] left_edge,
+                                     const floating[:, :] right_edge,
+                                     const np.float64_t[:, :] values,
+                                     bint area_weighted,
+                                     np.intp_t i_start, np.intp_t i_stop,
+                                     np.intp_t j_start,
+                                     np.intp_t j_stop) nogil:
+    cdef np.intp_t n, f, i, j, i0, i1, j0, j1
+    cdef np.intp_t nfields = values.shape[1]
+    cdef np.float64_t x0, x1, y0, y1, wx, wy
+
+    for n in range(values.shape[0]):
+        x0 = left_edge[n, 0]
+        y0 = left_edge[n, 1]
+        x1 = right_edge[n, 0]
+        y1 = right_edge[n, 1]
+        if area_weighted:
+            i0 = <np.intp_t>floor(x0)
+            j0 = <np.intp_t>floor(y0)
+            i1 = <np.intp_t>ceil(x1)
+            j1 = <np.intp_t>ceil(y1)
+        else:
+            i0 = <np.intp_t>x0
+            j0 = <np.intp_t>y0
+            i1 = <np.intp_t>x1
+            j1 = <np.intp_t>y1
+        i0 = max(i0, i_start)
+        j0 = max(j0, j_start)
+        i1 = min(i1, i_stop)
+        j1 = min(j1, j_stop)
+        for i in range(i0, i1):
+            if area_weighted:
+                wx = min(x1, i + 1) - max(x0, i)
+            else:
+                wx = 1
+            for j in range(j0, j1):
+                if area_weighted:
+                    wy = min(y1, j + 1) - max(y0, j)
+                else:
+                    wy = 1
+                for f in range(nfields):
+                    image[f, i, j] += values[n, f] * wx * wy
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def _rasterize_polygons(image,
+                        const floating[:, :] verts,
+                        const np.intp_t[:] offsets,
+                        values,
+                        np.float64_t x0, np.float64_t dx,
+                        np.float64_t y0, np.float64_t dy,
+                        int nthreads=1,
+                        np.intp_t i_start=0, np.intp_t i_stop=-1,
+                        np.intp_t j_start=0, np.intp_t j_stop=-1):
+    # Polygon p is made of the vertices verts[offsets[p]:offsets[p+1]].
+    # Pixel (i, j) has its center at (x0 + i*dx, y0 + j*dy) and is set to
+    # values[p] if the center is inside polygon p, using the same even-odd
+    # crossing rule as _points_in_poly. Each polygon only visits the
+    # scanlines that intersect its bounding box and fills the spans between
+    # pairs of edge crossings, so the cost scales with the polygon area
+    # rather than the image area. Crossings are computed from the lower
+    # vertex of each edge, so polygons sharing an edge find bitwise equal
+    # crossings whatever the direction they traverse it in, and the
+    # half-open spans then assign every pixel of a tessellation to at most
+    # one polygon. Polygons are therefore rasterized in parallel.
+    # As in _deposit_rectangles image may be a (nfields, nx, ny) stack with
+    # (npolygons, nfields) values and the vertices may be float32 or
+    # float64.
+    # Only pixels inside image[i_start:i_stop, j_start:j_stop] are written,
+    # a negative stop means the end of the image.
+    image = np.asarray(image)
+    values = np.asarray(values)
+    if image.ndim == 2:
+        image = image[None]
+        values = values[:, None]
+    cdef np.float64_t[:, :, :] stack = image
+    cdef const np.float64_t[:, :] field_values = values
+    cdef np.intp_t p, f, k, m, j, i, j0, j1, i0, start, nv, ncross, a, b
+    cdef np.intp_t nfields = field_values.shape[1]
+    cdef np.intp_t nx = stack.shape[1]
+    cdef np.intp_t ny = stack.shape[2]
+    cdef np.float64_t y, ymin, ymax, xc, xa, xb
+    cdef np.float64_t *cross
+    cdef np.intp_t failed = 0
+
+    if i_stop < 0 or i_stop > nx:
+        i_stop = nx
+    if j_stop < 0 or j_stop > ny:
+        j_stop = ny
+
+    for p in prange(offsets.shape[0] - 1, nogil=True, schedule='dynamic',
+                    num_threads=nthreads):
+        start = offsets[p]
+        nv = offsets[p + 1] - start
+        if nv < 3:
+            continue
+        ymin = verts[start, 1]
+        ymax = verts[start, 1]
+        for k in range(start + 1, start + nv):
+            ymin = min(ymin, verts[k, 1])
+            ymax = max(ymax, verts[k, 1])
+        j0 = max(<np.intp_t>ceil((ymin - y0)/dy) - 1, j_start)
+        j1 = min(<np.intp_t>floor((ymax - y0)/dy) + 2, j_stop)
+        cross = <np.float64_t *>malloc(nv * sizeof(np.float64_t))
+        if cross == NULL:
+            failed += 1
+            continue
+        for j in range(j0, j1):
+            y = y0 + j*dy
+            ncross = 0
+            for k in range(nv):
+                a = start + k
+                b = start + (k + nv - 1) % nv
+                if (verts[a, 1] > y) != (verts[b, 1] > y):
+                    if verts[b, 1] < verts[a, 1]:
+                        a, b = b, a
+                    xc = ((verts[b, 0] - verts[a, 0]) *
+                          (y - verts[a, 1]) /
+                          (verts[b, 1] - verts[a, 1]) + verts[a, 0])
+                    # insertion sort, polygons have few crossings per row
+                    m = ncross
+                    while m > 0 and cross[m - 1] > xc:
+                        cross[m] = cross[m - 1]
+                        m = m - 1
+                    cross[m] = xc
+                    ncross = ncross + 1
+            # a pixel center px is inside if an odd number of crossings
+            # satisfy px < xc, i.e. cross[2*m] <= px < cross[2*m + 1]
+            for k in range(0, ncross - 1, 2):
+                xa = cross[k]
+                xb = cross[k + 1]
+                i0 = max(<np.intp_t>ceil((xa - x0)/dx) - 1, i_start)
+                for i in range(i0, i_stop):
+                    if x0 + i*dx >= xb:
+                        break
+                    if x0 + i*dx >= xa:
+                        for f in range(nfields):
+                            stack[f, i, j] = field_values[p, f]
+        free(cross)
+
+    if failed:
+        raise MemoryError(
+            "Could not allocate the scanline crossings of %s polygons"
+            % (failed,))
@@ -1,106 +1,519 @@
+import itertools
+
 import numpy as np
-from matplotlib import pyplot as plt
-from matplotlib.collections import LineCollection
-from scipy.spatial import Voronoi
 
-from qtree.utils import _points_in_poly
+from qtree.cache import _CACHE_BYTES, _ArrayCache
+from qtree.fields import _check_image, _field_columns, _weight_indices
+from qtree.instrumentation import _timed
+from qtree.plotting import _plot_segments, _rasterize_rgba, _save_rgba
+from qtree.serialization import _load_arrays, _save_arrays
+from qtree.tiling import _render_tiles
+from qtree.utils import _rasterize_polygons
+
+
+def _polygon_subset(offsets, vertices, indices):
+    """The CSR offsets and vertices of a subset of polygons"""
+    starts = offsets[indices]
+    counts = offsets[indices + 1] - starts
+    subset_offsets = np.zeros(indices.shape[0] + 1, dtype=np.intp)
+    subset_offsets[1:] = np.cumsum(counts)
+    subset_vertices = vertices[
+        np.repeat(starts - subset_offsets[:-1], counts) +
+        np.arange(subset_offsets[-1])]
+    return subset_offsets, subset_vertices
+
+
+def _following(offsets, nvertices):
+    """The index of the next vertex of each vertex of CSR polygons"""
+    following = np.arange(1, nvertices + 1)
+    nonempty = offsets[1:] > offsets[:-1]
+    following[offsets[1:][nonempty] - 1] = offsets[:-1][nonempty]
+    return following
+
+
+def _clip_polygons(offsets, vertices, axis, value, sign):
+    """Clip CSR polygons to the half-plane ``sign*(x[axis] - value) <= 0``
+
+    A single Sutherland-Hodgman pass over the edges of all polygons at
+    once. Every edge emits its start vertex if it is inside the half-plane
+    and its intersection with the clipping line if it crosses it, polygons
+    that end up outside the half-plane become empty. Intersections are
+    computed from the inside end of each edge, so neighbouring polygons,
+    which traverse their shared edge in opposite directions, get bitwise
+    equal vertices.
+    """
+    start = vertices
+    end = vertices[_following(offsets, vertices.shape[0])]
+    ds = sign*(start[:, axis] - value)
+    de = sign*(end[:, axis] - value)
+    inside = ds <= 0
+    crossing = inside != (de <= 0)
+
+    edge_offsets = np.zeros(vertices.shape[0] + 1, dtype=np.intp)
+    edge_offsets[1:] = np.cumsum(inside.astype(np.intp) + crossing)
+    clipped = np.empty((edge_offsets[-1], 2))
+    clipped[edge_offsets[:-1][inside]] = start[inside]
+    forward = inside[crossing]
+    inner = np.where(forward[:, None], start[crossing], end[crossing])
+    outer = np.where(forward[:, None], end[crossing], start[crossing])
+    d_inner = np.where(forward, ds[crossing], de[crossing])
+    d_outer = np.where(forward, de[crossing], ds[crossing])
+    t = (d_inner / (d_inner - d_outer))[:, None]
+    intersections = inner + t*(outer - inner)
+    intersections[:, axis] = value
+    clipped[edge_offsets[:-1][crossing] + inside[crossing]] = intersections
+
+    return edge_offsets[offsets], clipped
+
+
+def _polygon_areas(offsets, vertices):
+    """The shoelace areas of CSR polygons"""
+    x, y = vertices.T
+    following = _following(offsets, vertices.shape[0])
+    cross = x*y[following] - x[following]*y
+    polygon = np.repeat(np.arange(offsets.shape[0] - 1), np.diff(offsets))
+    return 0.5*np.abs(np.bincount(polygon, weights=cross,
+                                  minlength=offsets.shape[0] - 1))
+
+
+def _polygon_bounds(offsets, vertices):
+    """The lower-left and upper-right corners of non-empty CSR polygons"""
+    if vertices.shape[0] == 0:
+        return np.empty((0, 2)), np.empty((0, 2))
+    return (np.minimum.reduceat(vertices, offsets[:-1], axis=0),
+            np.maximum.reduceat(vertices, offsets[:-1], axis=0))
+
+
+def _rasterize(image, offsets, vertices, lo, hi, values, grid, nthreads):
+    """Rasterize polygons with bounding boxes ``lo``, ``hi`` onto a stack"""
+    def render(i0, i1, j0, j1, indices):
+        if indices is not None:
+            tile_offsets, tile_vertices = _polygon_subset(offsets, vertices,
+                                                          indices)
+            _rasterize_polygons(image, tile_vertices, tile_offsets,
+                                values[indices], *grid, nthreads=1,
+                                i_start=i0, i_stop=i1, j_start=j0, j_stop=j1)
+        else:
+            _rasterize_polygons(image, vertices, offsets, values, *grid)
+
+    if nthreads == 1:
+        render(0, image.shape[1], 0, image.shape[2], None)
+        return
+
+    # bounding boxes of the cells in pixel units, pixel i covers
+    # [i, i + 1), padded by a pixel to be conservative
+    x0, dx, y0, dy = grid
+    origin = np.array([x0, y0])
+    spacing = np.array([dx, dy])
+    left_edge = (lo - origin)/spacing - 0.5
+    right_edge = (hi - origin)/spacing + 1.5
+
+    _render_tiles(render, image.shape[1:], nthreads, left_edge, right_edge)
 
 
 class ParticleVoronoiMesh(object):
 
-    def __init__(self, positions, deposit_field, bounds):
+    def __init__(self, positions, deposit_field, bounds, dtype='float64'):
         """A voronoi mesh generated from particle positions
 
         Parameters
         ----------
         positions : iterable of 2-element iterables
             Positions of the particles to be inserted.
-        deposit_field : iterable, optional
+        deposit_field : iterable or dict, optional
             Field to be deposited and pixelized. Must have the same
-            number of elements as the number of positions.
+            number of elements as the number of positions. Several fields
+            are given either as a ``(nparticles, nfields)`` array or as a
+            dict of named fields.
         bounds : 2-element iterable of two-tuples
             The coordinates of the lower-left and upper-right corners
-            of the bounds of the mesh. Particles outside the bounds are
-            discarded.
+            of the bounds of the mesh. Every cell is clipped to the
+            bounds, particles outside the bounds are discarded.
+        dtype : numpy dtype, optional
+            The floating point type of the stored particle positions,
+            deposit fields and cell vertices, e.g. ``'float32'`` to halve
+            their memory use. The diagram itself is computed in float64
+            and cell areas and pixelized values are always float64.
         """
         positions = np.asarray(positions)
         self.num_particles = nparticles = positions.shape[0]
         self.bounds = bounds = np.asarray(bounds)
+        self.dtype = np.dtype(dtype)
 
-        if deposit_field is not None and nparticles != deposit_field.shape[0]:
-            raise RuntimeError(
-                "Received %s deposit_field entries but received %s particle "
-                "positions" % (deposit_field.shape[0], nparticles))
+        self.field_names, columns = _field_columns(deposit_field, nparticles)
 
         if positions.shape[-1] != 2:
             raise RuntimeError(
-                "Received %sD positions %s but expected 2D positions"
-                % (positions.shape,))
+                "Received %sD positions but expected 2D positions"
+                % (positions.shape[-1],))
+
+        from scipy.spatial import Voronoi
+
+        # four far away points enclose every particle so all cells are
+        # bounded, they are further from any point inside the bounds than
+        # the particles so the cells are unchanged inside the bounds
+        lo = np.minimum(positions.min(axis=0), bounds[0])
+        hi = np.maximum(positions.max(axis=0), bounds[1])
+        span = (hi - lo).max()
+        far = 0.5*(lo + hi) + 10*span*np.array(
+            [(-1, -1), (1, -1), (-1, 1), (1, 1)])
+
+        with _timed('voronoi.build', num_particles=nparticles):
+            self.voro = voro = Voronoi(np.concatenate((positions, far)))
+            self.points = voro.points[:nparticles].astype(self.dtype,
+                                                          copy=False)
+            self.deposit_field = deposit_field
+            self._fields = None
+            if columns is not None:
+                self._fields = np.array(columns, dtype=self.dtype)
+
+            ridges = (voro.ridge_points < nparticles).all(axis=-1)
+            self.segments = voro.vertices[
+                np.array(voro.ridge_vertices)[ridges]]
+
+            # the cells bordering the far points are the unbounded cells
+            # of the voronoi diagram of the particles alone
+            hull = voro.ridge_points[~ridges].ravel()
+            self._num_unbounded = np.unique(hull[hull < nparticles]).shape[0]
+
+            self._clip_cells()
+        self._point_tree = None
+        self._cache = None
+
+    def _clip_cells(self):
+        """Clip every cell to the bounds and cache its geometry
+
+        The clipped polygons of the particles inside the bounds are stored
+        as flat CSR arrays together with their areas and bounding boxes,
+        so pixelizations at any resolution reuse them. Cells of particles
+        outside the bounds get a NaN area and are never pixelized.
+        """
+        voro = self.voro
+        regions = [voro.regions[r]
+                   for r in voro.point_region[:self.num_particles]]
+        offsets = np.zeros(len(regions) + 1, dtype=np.intp)
+        offsets[1:] = np.cumsum([len(region) for region in regions])
+        vertices = voro.vertices[np.fromiter(
+            itertools.chain.from_iterable(regions), dtype=np.intp,
+            count=offsets[-1])]
+
+        for axis in range(2):
+            offsets, vertices = _clip_polygons(
+                offsets, vertices, axis, self.bounds[0, axis], -1)
+            offsets, vertices = _clip_polygons(
+                offsets, vertices, axis, self.bounds[1, axis], 1)
 
-        self.voro = voro = Voronoi(positions)
-        self.deposit_field = deposit_field
+        areas = _polygon_areas(offsets, vertices)
+        points = voro.points[:self.num_particles]
+        inside = ((points >= self.bounds[0]) &
+                  (points <= self.bounds[1])).all(axis=-1)
+        cells = np.nonzero(inside & (areas > 0))[0]
 
-        ridge_verts = np.array(voro.ridge_vertices)
-        ridge_verts = ridge_verts[(ridge_verts != -1).all(axis=-1)]
-        self.segments = voro.vertices[ridge_verts]
+        self.cell_areas = np.full(self.num_particles, np.nan)
+        self.cell_areas[cells] = areas[cells]
+        offsets, vertices = _polygon_subset(offsets, vertices, cells)
+        vertices = vertices.astype(self.dtype, copy=False)
+        self._polygons = cells, offsets, vertices
+        self._cell_bbox = _polygon_bounds(offsets, vertices)
 
-    def pixelize(self, image):
+    def pixelize(self, image, method='nearest', nthreads=1, weights=None,
+                 bounds=None):
         """pixelize the deposit_field onto an image
 
         Parameters
         ----------
-        image : 2D array
-            Image to pixelize onto
+        image : 2D array or 3D array
+            Image to pixelize onto. If the mesh has several deposit fields
+            this is a ``(nfields, nx, ny)`` stack of images, filled in a
+            single pass.
+        method : string, optional
+            How pixels are assigned to voronoi cells. ``'nearest'`` (the
+            default) assigns each pixel to the cell of the particle nearest
+            to the pixel center using a single batched KDTree query.
+            ``'polygon'`` rasterizes the polygon of every cell and is kept
+            as a reference implementation. In both cases pixels in the
+            cells of particles outside the bounds are left untouched.
+        nthreads : int, optional
+            If larger than 1 the image is split into tiles that are
+            rendered concurrently on a pool of ``nthreads`` threads. The
+            result is bitwise identical to the serial result. Defaults to 1.
+        weights : dict, optional
+            Maps field names to the names of fields they are averaged
+            with, e.g. ``{'temperature': 'mass'}``. Every pixel lies in a
+            single cell, so a weighted field shows the value of the cell,
+            pixels in cells without any weight are left untouched.
+        bounds : 2-element iterable of two-tuples, optional
+            The lower-left and upper-right corners of the window covered by
+            the image, defaults to the bounds of the mesh. Pixel ``(i, j)``
+            samples the window at the center of the pixel. Cells whose
+            bounding box misses the window are skipped.
+
+        Pixels are first assigned to cells, then the cell values are
+        gathered into the image. The assignments of repeated views can be
+        memoized, see ``enable_cache``.
         """
-        image = np.asarray(image)
+        image = _check_image(image, self.field_names)
+        stack = image if len(image.shape) == 3 else image[None]
 
-        if len(image.shape) != 2:
-            raise RuntimeError("Must pixelize onto 2D image")
+        if bounds is None:
+            bounds = self.bounds
+        bounds = np.asarray(bounds, dtype='float64')
+        if bounds.shape != (2, 2) or (bounds[1] <= bounds[0]).any():
+            raise RuntimeError(
+                "Received bounds %s but expected [[x0, y0], [x1, y1]] with "
+                "x0 < x1 and y0 < y1" % (bounds.tolist(),))
 
-        voro = self.voro
-        regions = voro.regions
-        bounds = self.bounds
+        if method not in ('nearest', 'polygon'):
+            raise RuntimeError(
+                "Unknown pixelization method '%s', expected 'nearest' or "
+                "'polygon'" % (method,))
 
-        dx = 1/image.shape[0]
-        dy = 1/image.shape[1]
+        values = self._cell_values(weights)
 
-        xb = bounds[1, 0] - bounds[0, 0] - dx
-        yb = bounds[1, 1] - bounds[0, 1] - dy
+        with _timed('voronoi.pixelize', method=method, shape=image.shape,
+                    nthreads=nthreads):
+            cell_map = self._cell_map(stack.shape[1:], bounds, method,
+                                      nthreads)
+            covered = cell_map >= 0
+            cell = cell_map[covered]
+            for layer, field in zip(stack, values.T):
+                pixel_values = field[cell]
+                layer[covered] = np.where(np.isnan(pixel_values),
+                                          layer[covered], pixel_values)
 
-        xlin = np.arange(image.shape[0])/(image.shape[0] - 1) * xb + dx/2
-        ylin = np.arange(image.shape[1])/(image.shape[1] - 1) * yb + dy/2
+        return image
 
-        x, y = np.meshgrid(xlin, ylin)
+    def enable_cache(self, max_bytes=_CACHE_BYTES):
+        """Memoize the assignment of pixels to cells done by pixelize
 
-        for i, point_coord in enumerate(voro.points):
-            region_idx = voro.point_region[i]
-            region = regions[region_idx]
-            if -1 in region or len(region) == 0:
-                continue
-            vertices = voro.vertices[region]
-            vx = vertices[:, 0]
-            vy = vertices[:, 1]
-            area = 0.5*np.abs(np.dot(vx, np.roll(vy, 1)) -
-                              np.dot(vy, np.roll(vx, 1)))
-            in_poly = _points_in_poly(vertices, x, y)
-            image[np.where(in_poly)] = self.deposit_field[i] / area
+        Assignments are cached by image shape, bounds and method, so
+        repeated renders of the same view, including renders of other
+        fields or weights, only gather the cell values into the image.
 
-        return image
+        Parameters
+        ----------
+        max_bytes : int, optional
+            The memory budget of the cached assignments, least recently
+            used assignments are evicted first. Defaults to 256 MiB.
+        """
+        self._cache = _ArrayCache(max_bytes)
+
+    def disable_cache(self):
+        """Stop memoizing pixelize and release the cached assignments"""
+        self._cache = None
+
+    def _cell_map(self, shape, bounds, method, nthreads):
+        """The index of the cell containing each pixel center, -1 for
+        pixels outside of every rendered cell"""
+        key = (shape, tuple(bounds.ravel()), method)
+        if self._cache is not None:
+            cell_map = self._cache.get(key)
+            if cell_map is not None:
+                return cell_map
 
-    def plot(self, filename=None):
-        """Plot the mesh"""
-        fig = plt.figure(figsize=(4, 4))
-        axes = fig.add_axes([.01, .01, .98, .98])
-        axes.set_aspect('equal')
-        plt.axis('off')
-        lc = LineCollection(self.segments, color='k', linewidths=0.5)
-        axes.add_collection(lc)
-        positions = self.voro.points
-        axes.scatter(positions[:, 0], positions[:, 1], s=.2, color='k',
-                     marker='o')
-        plt.xlim((0, 1))
-        plt.ylim((0, 1))
-        if filename is None:
-            plt.show()
+        grid = self._pixel_grid(shape, bounds)
+        if method == 'nearest':
+            cell_map = self._cell_map_nearest(shape, grid, nthreads)
         else:
-            plt.savefig(filename, dpi=400)
+            cell_map = self._cell_map_polygon(shape, grid, nthreads)
+
+        if self._cache is not None:
+            self._cache.put(key, cell_map)
+        return cell_map
+
+    def _cell_values(self, weights):
+        """The ``(nparticles, nfields)`` value of every field in each cell,
+        NaN for the cells of particles outside the bounds"""
+        if self._fields is None:
+            raise RuntimeError("The mesh has no deposit_field to pixelize")
+        fields = self._fields
+        values = fields / self.cell_areas
+
+        weight_index = _weight_indices(self.field_names, weights)
+        weighted = weight_index >= 0
+        if weighted.any():
+            weight = fields[weight_index[weighted]]
+            values[weighted] = np.where(
+                (weight != 0) & ~np.isnan(self.cell_areas), fields[weighted],
+                np.nan)
+
+        return values.T
+
+    def _pixel_grid(self, shape, bounds):
+        """The first pixel center and the pixel spacing along each axis"""
+        dx, dy = (bounds[1] - bounds[0]) / np.array(shape)
+        return bounds[0, 0] + dx/2, dx, bounds[0, 1] + dy/2, dy
+
+    def _cell_map_nearest(self, shape, grid, nthreads):
+        if self._point_tree is None:
+            from scipy.spatial import cKDTree
+            self._point_tree = cKDTree(self.points)
+
+        x0, dx, y0, dy = grid
+        cell_map = np.empty(shape, dtype=np.intp)
+
+        def render(i0, i1, j0, j1, indices):
+            x, y = np.meshgrid(x0 + np.arange(i0, i1)*dx,
+                               y0 + np.arange(j0, j1)*dy, indexing='ij')
+            _, nearest = self._point_tree.query(
+                np.column_stack((x.ravel(), y.ravel())))
+            cell_map[i0:i1, j0:j1] = nearest.reshape(x.shape)
+
+        _render_tiles(render, shape, nthreads)
+        return cell_map
+
+    def _cell_polygons(self):
+        """The clipped vertices of the rendered cells as flat CSR arrays"""
+        return self._polygons
+
+    def _cell_bounds(self):
+        """The bounding boxes of the rendered cells"""
+        if self._cell_bbox is None:
+            _, offsets, vertices = self._polygons
+            self._cell_bbox = _polygon_bounds(offsets, vertices)
+        return self._cell_bbox
+
+    def _cell_map_polygon(self, shape, grid, nthreads):
+        cells, offsets, vertices = self._cell_polygons()
+        lo, hi = self._cell_bounds()
+
+        # skip the cells whose bounding box misses every pixel center
+        x0, dx, y0, dy = grid
+        first = np.array([x0, y0])
+        last = first + (np.array(shape) - 1)*np.array([dx, dy])
+        visible = np.nonzero((hi >= first).all(axis=-1) &
+                             (lo <= last).all(axis=-1))[0]
+        offsets, vertices = _polygon_subset(offsets, vertices, visible)
+        lo, hi = lo[visible], hi[visible]
+
+        # rasterize the cell indices, exact in float64
+        target = np.full((1,) + tuple(shape), -1.0)
+        _rasterize(target, offsets, vertices, lo, hi,
+                   cells[visible].astype('float64')[:, None], grid, nthreads)
+        return target[0].astype(np.intp)
+
+    def stats(self):
+        """Summarize the geometry and memory use of the mesh
+
+        Returns
+        -------
+        dict
+            ``num_particles``; ``num_vertices`` of the clipped cells;
+            ``num_cells`` that are pixelized; ``num_unbounded`` cells,
+            which are unbounded in the voronoi diagram and only rendered
+            thanks to clipping; ``num_clipped`` cells touching the bounds;
+            ``num_skipped`` cells that are never pixelized because their
+            particle lies outside the bounds or coincides with another
+            particle; and the bytes used by the ``position_bytes``,
+            ``deposit_bytes`` and ``geometry_bytes`` (ridge segments, cell
+            areas and clipped cells) buffers.
+        """
+        cells, offsets, vertices = self._polygons
+        lo, hi = self._cell_bounds()
+        clipped = ((lo <= self.bounds[0]) | (hi >= self.bounds[1])).any(
+            axis=-1)
+        geometry = (self.segments, self.cell_areas, cells, offsets,
+                    vertices, lo, hi)
+        return {
+            'num_particles': self.num_particles,
+            'num_vertices': vertices.shape[0],
+            'num_cells': cells.shape[0],
+            'num_unbounded': self._num_unbounded,
+            'num_clipped': int(clipped.sum()),
+            'num_skipped': self.num_particles - cells.shape[0],
+            'position_bytes': self.points.nbytes,
+            'deposit_bytes': 0 if self._fields is None else
+            self._fields.nbytes,
+            'geometry_bytes': sum(array.nbytes for array in geometry),
+        }
+
+    def save(self, path):
+        """Save the mesh to a directory of flat arrays
+
+        Besides the particles and deposit field this stores the ridge
+        segments, the cell areas and the vertices of the bounded cells as
+        CSR arrays, which is everything needed to pixelize and plot the
+        mesh.
+
+        Parameters
+        ----------
+        path : string
+            The directory to save the mesh to, created if needed.
+        """
+        cells, offsets, vertices = self._cell_polygons()
+        names = self.field_names
+        _save_arrays(path, 'ParticleVoronoiMesh',
+                     {'points': self.points,
+                      'deposit_field': self._fields,
+                      'bounds': self.bounds,
+                      'segments': self.segments,
+                      'cell_areas': self.cell_areas,
+                      'cells': cells,
+                      'cell_offsets': offsets,
+                      'cell_vertices': vertices},
+                     field_names=None if names is None else list(names),
+                     num_unbounded=int(self._num_unbounded))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a mesh saved with ``save`` without recomputing it
+
+        The loaded mesh has no ``voro`` attribute, only the arrays needed
+        to pixelize and plot it.
+
+        Parameters
+        ----------
+        path : string
+            The directory the mesh was saved to.
+        mmap : bool, optional
+            If True (the default) the arrays are memory-mapped read-only,
+            otherwise they are read into memory.
+        """
+        metadata, arrays = _load_arrays(path, 'ParticleVoronoiMesh', mmap)
+        mesh = cls.__new__(cls)
+        mesh.voro = None
+        mesh.points = arrays['points']
+        mesh.dtype = mesh.points.dtype
+        mesh.num_particles = mesh.points.shape[0]
+
+        names = metadata['field_names']
+        fields = arrays.get('deposit_field')
+        mesh._fields = fields
+        mesh.field_names = None if names is None else tuple(names)
+        if fields is None or names is None:
+            mesh.deposit_field = None if fields is None else fields[0]
+        elif isinstance(names[0], int):
+            mesh.deposit_field = fields.T
+        else:
+            mesh.deposit_field = dict(zip(names, fields))
+        mesh.bounds = np.asarray(arrays['bounds'])
+        mesh.segments = arrays['segments']
+        mesh.cell_areas = arrays['cell_areas']
+        mesh._num_unbounded = metadata.get('num_unbounded')
+        mesh._point_tree = None
+        mesh._cache = None
+        mesh._cell_bbox = None
+        mesh._polygons = (arrays['cells'], arrays['cell_offsets'],
+                          arrays['cell_vertices'])
+        return mesh
+
+    def plot(self, filename=None, rgba=False, shape=(1024, 1024)):
+        """Plot the mesh
+
+        Parameters
+        ----------
+        filename : string, optional
+            The file to save the plot to, the plot is shown if None.
+        rgba : bool, optional
+            If True no matplotlib artists are created, instead the plot is
+            rasterized into a ``(ny, nx, 4)`` uint8 RGBA array which is
+            returned and, if ``filename`` is given, saved with ``imsave``.
+        shape : 2-element tuple, optional
+            The number of pixels along the x and y axes of the RGBA array.
+        """
+        if rgba:
+            return _save_rgba(
+                _rasterize_rgba(self.bounds, shape, self.segments,
+                                self.points), filename)
+        _plot_segments(self.segments, self.points, self.bounds, filename,
+                       linewidths=0.5)
@@ -1,11 +1,46 @@
+import os
+import shutil
+import subprocess
+import sysconfig
+import tempfile
+
 from setuptools import setup, find_packages
 from setuptools.extension import Extension
 from Cython.Build import cythonize
 import numpy as np
 
+
+def check_for_openmp():
+    """Returns True if the C compiler accepts -fopenmp"""
+    cc = os.environ.get('CC', sysconfig.get_config_var('CC') or 'cc')
+    tmpdir = tempfile.mkdtemp()
+    source = os.path.join(tmpdir, 'test_openmp.c')
+    with open(source, 'w') as f:
+        f.write("#include <omp.h>\n"
+                "int main(void) { return omp_get_max_threads() < 1; }\n")
+    try:
+        with open(os.devnull, 'w') as devnull:
+            exit_code = subprocess.call(
+                cc.split() + ['-fopenmp', source, '-o',
+                              os.path.join(tmpdir, 'test_openmp')],
+                stdout=devnull, stderr=devnull)
+    except OSError:
+        exit_code = 1
+    finally:
+        shutil.rmtree(tmpdir)
+    return exit_code == 0
+
+
+if check_for_openmp():
+    omp_args = ['-fopenmp']
+else:
+    omp_args = []
+
 extensions = [
     Extension("qtree.utils", ["qtree/utils.pyx"],
-              include_dirs=[np.get_include()])
+              include_dirs=[np.get_include()],
+              extra_compile_args=omp_args,
+              extra_link_args=omp_args)
 ]
 
 setup(
@@ -24,15 +59,16 @@ setup(
 
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
     ],
     keywords="quadtree particle",
     packages=find_packages(),
+    python_requires='>=3.9',
     ext_modules=cythonize(extensions),
     install_requires=[],
 )